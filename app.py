@@ -10,7 +10,6 @@ import os
 import json
 import session_module as account_mg
 import chat_module as chatMD
-from flask_session import Session
 from datetime import timedelta, timezone
 import datetime
 from route_mount import *
@@ -27,15 +26,24 @@ import mimetypes
 import base64
 from urllib.parse import urlparse
 from werkzeug.utils import secure_filename
-from pricin_update import get_dexscreener_price, get_token_price_cached
+from pricin_update import get_price_service, PRICE_COLD_WAIT_SEC
 import jwt, requests, math
 import threading
 import re
-from solana_utils import get_token_balance_owner, verify_transfer_signature
+from solana_utils import get_token_balance_owner, verify_transfer_signature, get_rpc, get_balance_cache
 from update_charts import start_background_updater
+from ledger_module import get_ledger
+from cache_module import LRUTTLStore
+from snapshot_module import get_snapshot_store
+from rate_limit_module import website_rate_limiter_from_env
+from state_backend import get_state_backend, SharedLock
+from site_serving import get_site_server, precompress_site, PublishedSiteMiddleware
+from session_backend import configure_sessions
+from publish_module import plan_assets, localize_plan, stage_site, commit_site, remove_site, write_file_atomic, get_publish_queue, schedule_blob_gc
 
 app = Flask(__name__)
-app.config['SESSION_TYPE'] = 'filesystem'
+# Rate counters, chat affinity and (with Redis) Flask sessions shared across workers
+state_backend = get_state_backend()
 # Set to False for development over HTTP, otherwise session cookie is not sent.
 app.config['SESSION_COOKIE_SECURE'] = False
 app.config['SESSION_COOKIE_HTTPONLY'] = True
@@ -46,25 +54,50 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY_SERVER')
 def inject_getenv():
     return dict(getenv=os.getenv)
 
-Session(app)
+# Signed cookies by default, Redis with a shared state backend; see SESSION_BACKEND
+configure_sessions(app, state_backend)
 
 # Ensure temp_media exists
 os.makedirs(os.path.join('static', 'temp_media'), exist_ok=True)
 
-# Initialize database
-db_builder = AccountsDBTools(
-    user_db=os.getenv('USERDB'),
-    password_db=os.getenv('PASSWORDDB'),
-    host_db=os.getenv('DBHOST'),
-    port_db=os.getenv('PORTDB'),
-    database="strawberry_platform"
-)
+# Initialize database (shared pool; schema bootstrap runs once per process)
+db_builder = db.get_shared_db()
+ledger = get_ledger()
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return int(default)
+
+
+def _session_sizeof(run_session) -> int:
+    size = 4096  # thread handle, config, locks
+    for attr in ('current_document', 'return_html_object', 'return_html_final'):
+        size += len(getattr(run_session, attr, None) or '')
+    return size
+
+
 class ChatSessionManager:
-    def __init__(self):
-        self.ChatHistory = {}
+    """In-memory chat state, bounded by count, bytes and idle time.
+
+    Env: CHAT_MAX_SESSIONS (500), CHAT_HISTORY_MAX_ENTRIES (2000),
+    CHAT_HISTORY_MAX_BYTES (256 MiB), CHAT_HISTORY_TTL_SEC (3600), CHAT_SWEEP_INTERVAL_SEC (60).
+    Idle assistant sessions are closed by the sweeper; histories with unsaved
+    entries are written back to MySQL before they are evicted.
+
+    With a shared state backend the manager also publishes each chat's last
+    persisted seq (so a worker holding an older copy reloads it), the OpenAI
+    thread id (so any worker resumes the same thread) and a per-chat turn lock.
+    CHAT_STATE_TTL_SEC (7 days) bounds those keys; CHAT_TURN_LOCK_TTL_SEC (600).
+    """
+    def __init__(self, db_tools=None, snapshots=None, state=None):
+        self.db_tools = db_tools
+        self.state = state
+        self.state_ttl = _env_int('CHAT_STATE_TTL_SEC', str(7 * 24 * 3600))
+        self.turn_lock_ttl = _env_int('CHAT_TURN_LOCK_TTL_SEC', '600')
+        # Deployed pages live in the snapshot store; history entries keep only their hash.
+        self.snapshots = snapshots
         self.chat_module = {}
-        self.chattimes = {}
-        self.sessions_online = {}
         self.account_sessions_global = {}
         self.sesion_remove_inactive_time = 15*60 # 15 minutes
         self.hashAvalible = []
@@ -73,18 +106,257 @@ class ChatSessionManager:
         self.hash_sesions_index = []
         self.session_pricings = {}
         self.hash_invite_session_avalible = {}
+        max_sessions = _env_int('CHAT_MAX_SESSIONS', '500')
+        self.sessions_online = LRUTTLStore('sessions_online', max_entries=max_sessions,
+                                           ttl=self.sesion_remove_inactive_time,
+                                           sizeof=_session_sizeof, on_evict=self._close_session)
+        self.chattimes = LRUTTLStore('chattimes', max_entries=max_sessions, ttl=self.sesion_remove_inactive_time,
+                                     sizeof=lambda v: 8)
+        self.ChatHistory = LRUTTLStore('chat_history',
+                                       max_entries=_env_int('CHAT_HISTORY_MAX_ENTRIES', '2000'),
+                                       max_bytes=_env_int('CHAT_HISTORY_MAX_BYTES', str(256 * 1024 * 1024)),
+                                       ttl=_env_int('CHAT_HISTORY_TTL_SEC', '3600'),
+                                       on_evict=self._write_back_history)
+        # hashchat -> {'user_id': int, 'saved_seq': int, 'history': cached list}; entries above
+        # saved_seq are not in MySQL yet
+        self._history_meta = {}
+        self._meta_lock = threading.Lock()
+        self._sweeper = None
+
+    def normalize_history(self, history, hashchat=None):
+        """Give every entry a monotonic `seq` (legacy rows have none) and move inline deploy HTML to snapshots.
+
+        Interned entries are rewritten in chat_messages so the HTML is not loaded and hashed again.
+        """
+        last_seq = 0
+        renumbered = False
+        for entry in history:
+            if not isinstance(entry.get('seq'), int) or entry['seq'] <= last_seq:
+                entry['seq'] = last_seq + 1
+                renumbered = True
+            last_seq = entry['seq']
+        if self.snapshots:
+            interned = self.snapshots.intern_history(history, hashchat)
+            # Rows are keyed by seq: only rewrite them when the stored numbering was kept
+            if interned and hashchat and self.db_tools and not renumbered:
+                if self.db_tools.update_chat_messages(hashchat, interned):
+                    print(f"[chat_state] Moved {len(interned)} inline page(s) of {hashchat} to snapshots")
+        else:
+            for entry in history:
+                if entry.get('deploy_item') and entry.get('message') and not entry.get('deploy_ref'):
+                    entry['deploy_ref'] = hashlib.sha256(entry['message'].encode('utf-8')).hexdigest()
+        return history
+
+    def set_history(self, hashchat, history, user_id=None):
+        """Cache a history that is already persisted (freshly loaded or created)."""
+        history = self.normalize_history(history, hashchat)
+        saved_seq = self.last_seq(history)
+        # A copy that expired but was not swept yet may hold unsaved entries the DB copy lacks:
+        # write it back under its own meta and keep those entries.
+        stale = self.ChatHistory.pop(hashchat)
+        if stale is not None and stale is not history:
+            with self._meta_lock:
+                stale_meta = self._history_meta.get(hashchat)
+            self._write_back_history(hashchat, stale, 'reloaded')
+            if stale_meta and stale_meta['user_id'] in (None, user_id):
+                history.extend(m for m in stale if m['seq'] > saved_seq)
+                saved_seq = max(saved_seq, min(stale_meta['saved_seq'], self.last_seq(history)))
+        with self._meta_lock:
+            meta = self._history_meta.setdefault(hashchat, {'user_id': user_id, 'saved_seq': 0})
+            if user_id is not None:
+                meta['user_id'] = user_id
+            meta['saved_seq'] = saved_seq
+            meta['history'] = history
+        self.ChatHistory[hashchat] = history
+        self._publish_seq(hashchat, meta['saved_seq'])
+        return history
+
+    # --- cross-worker state (no-ops on the in-process backend) ---
+    def _shared(self) -> bool:
+        return self.state is not None and self.state.shared
+
+    def _publish_seq(self, hashchat, seq):
+        if self._shared() and seq:
+            try:
+                current = int(self.state.get(f"chat:{hashchat}:seq") or 0)
+                if seq > current:
+                    self.state.set(f"chat:{hashchat}:seq", seq, ttl=self.state_ttl)
+            except Exception as e:
+                print(f"[chat_state] Failed to publish seq for {hashchat}: {e}")
+
+    def cached_history(self, hashchat):
+        """The cached history, or None when absent or older than what another worker persisted."""
+        history = self.ChatHistory.get(hashchat)
+        if history is None or not self._shared():
+            return history
+        try:
+            remote = int(self.state.get(f"chat:{hashchat}:seq") or 0)
+        except Exception:
+            return history
+        if remote > self.last_seq(history):
+            with self._meta_lock:
+                self._history_meta.pop(hashchat, None)
+            self.ChatHistory.pop(hashchat)
+            return None
+        return history
+
+    def thread_for(self, hashchat):
+        """OpenAI thread id another worker already uses for this chat, if any."""
+        if not self._shared():
+            return None
+        try:
+            return self.state.get(f"chat:{hashchat}:thread")
+        except Exception:
+            return None
+
+    def remember_thread(self, hashchat, thread_id):
+        if self._shared() and thread_id:
+            try:
+                self.state.set(f"chat:{hashchat}:thread", thread_id, ttl=self.state_ttl)
+            except Exception as e:
+                print(f"[chat_state] Failed to store thread for {hashchat}: {e}")
+
+    def turn_lock(self, hashchat):
+        """Cross-worker lock for one chat turn, or None when state is per-process."""
+        if not self._shared():
+            return None
+        return SharedLock(self.state, f"chat:{hashchat}:turn", ttl=self.turn_lock_ttl)
+
+    def append_message(self, hashchat, entry, user_id=None):
+        """Append entry to the in-memory history with the next sequence number.
+
+        If the history was evicted meanwhile it is reloaded (eviction already wrote it back).
+        """
+        history = self.cached_history(hashchat)
+        if history is None:
+            loaded = self.db_tools.load_chat_history(hashchat, user_id) if (self.db_tools and user_id is not None) else None
+            history = self.set_history(hashchat, loaded or [], user_id)
+        entry['seq'] = (history[-1]['seq'] if history else 0) + 1
+        if entry.get('deploy_item') and entry.get('message'):
+            if self.snapshots:
+                base = next((m['deploy_ref'] for m in reversed(history) if m.get('deploy_ref')), None)
+                ref = self.snapshots.put(entry['message'], hashchat, base_hash=base)
+                if ref:
+                    entry.pop('message')
+                    entry['deploy_ref'] = ref
+                else:
+                    # Not persisted: keep the HTML inline (interned again on the next load)
+                    entry['deploy_ref'] = hashlib.sha256(entry['message'].encode('utf-8')).hexdigest()
+            else:
+                entry['deploy_ref'] = hashlib.sha256(entry['message'].encode('utf-8')).hexdigest()
+        history.append(entry)
+        self.ChatHistory.resize(hashchat)
+        return entry
+
+    def owner_of(self, hashchat):
+        with self._meta_lock:
+            meta = self._history_meta.get(hashchat)
+            return meta['user_id'] if meta else None
+
+    @staticmethod
+    def last_seq(history) -> int:
+        return history[-1]['seq'] if history else 0
+
+    def save_history(self, hashchat, user_id=None):
+        """Append the not-yet-persisted entries of hashchat to MySQL."""
+        history = self.ChatHistory.get(hashchat)
+        with self._meta_lock:
+            meta = self._history_meta.setdefault(hashchat, {'user_id': user_id, 'saved_seq': 0})
+            if user_id is not None:
+                meta['user_id'] = user_id
+        if history is None or meta['user_id'] is None or not self.db_tools:
+            return False
+        return self._persist(hashchat, meta, history)
+
+    def forget(self, hashchat=None, user_id=None):
+        """Drop cached state for a deleted chat (or every chat of user_id) without writing it back."""
+        with self._meta_lock:
+            if hashchat is not None:
+                targets = [hashchat]
+            else:
+                targets = [h for h, m in self._history_meta.items() if m['user_id'] == user_id]
+            for h in targets:
+                self._history_meta.pop(h, None)
+        for h in targets:
+            self.ChatHistory.pop(h)
+
+    def _persist(self, hashchat, meta, history):
+        pending = [m for m in history if m['seq'] > meta['saved_seq']]
+        if not pending:
+            return True
+        title = (history[0].get('message') or '')[:50] # First user message as title
+        if not self.db_tools.append_chat_messages(meta['user_id'], hashchat, title, pending):
+            return False
+        with self._meta_lock:
+            meta['saved_seq'] = max(meta['saved_seq'], pending[-1]['seq'])
+        self._publish_seq(hashchat, meta['saved_seq'])
+        return True
+
+    def _write_back_history(self, hashchat, history, reason):
+        with self._meta_lock:
+            meta = self._history_meta.get(hashchat)
+            if meta is not None and meta.get('history', history) is not history:
+                # The meta already describes a newer copy of this chat; its saved_seq is not ours
+                print(f"[chat_state] Skipping write-back of replaced history {hashchat} ({reason})")
+                return
+            self._history_meta.pop(hashchat, None)
+        if meta and meta['user_id'] is not None and self.db_tools and self.last_seq(history) > meta['saved_seq']:
+            print(f"[chat_state] Writing back dirty history {hashchat} before eviction ({reason})")
+            self._persist(hashchat, meta, history)
+
+    def _close_session(self, hashchat, run_session, reason):
+        self.chattimes.pop(hashchat)
+        try:
+            run_session.close()
+        except Exception as e:
+            print(f"[chat_state] Failed closing session {hashchat}: {e}")
+
+    def stats(self) -> dict:
+        stores = {s.name: s.stats() for s in (self.sessions_online, self.ChatHistory, self.chattimes)}
+        stores['resident_bytes'] = sum(v['bytes'] for v in stores.values())
+        return stores
+
+    def sweep(self):
+        evicted = self.sessions_online.sweep() + self.chattimes.sweep() + self.ChatHistory.sweep()
+        if evicted:
+            st = self.stats()
+            print(f"[chat_state] Evicted {evicted} idle entries; sessions={st['sessions_online']['entries']} "
+                  f"histories={st['chat_history']['entries']} resident_bytes={st['resident_bytes']}")
+        return evicted
+
+    def start_sweeper(self, interval=None):
+        if self._sweeper is not None:
+            return self._sweeper
+        interval = interval or _env_int('CHAT_SWEEP_INTERVAL_SEC', '60')
+
+        def worker():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep()
+                except Exception as e:
+                    print(f"[chat_state] Sweep error: {e}")
+
+        self._sweeper = threading.Thread(target=worker, daemon=True)
+        self._sweeper.start()
+        return self._sweeper
+
 
+chat_sessions = ChatSessionManager(db_builder, get_snapshot_store(), state_backend)
+chat_sessions.start_sweeper()
+publish_jobs = get_publish_queue(state_backend)
+site_server = get_site_server()
 
-chat_sessions = ChatSessionManager()
 # Global variables
 class GlobalVariables:
     def __init__(self):
-        # Rate limiting: per-website fixed 1-hour window counters
-        # { site_name: { 'window': epoch_floor_to_hour, 'count': int } }
-        self.web_rate_limiter = {}
-        self.web_rate_lock = threading.Lock()
+        # Rate limiting: per-website counters, sharded, with idle entries expired
+        self.web_rate_limiter = website_rate_limiter_from_env(state_backend)
 
 global_vars = GlobalVariables()
+# Published sites (/static/websites/) are answered in front of Flask: rate limit + file,
+# no session, request hooks or DB work
+app.wsgi_app = PublishedSiteMiddleware(app.wsgi_app, site_server, global_vars.web_rate_limiter)
 
 def get_user_language():
     return request.accept_languages.best_match(['en', 'es', 'zh'])
@@ -110,327 +382,6 @@ def sanitize_filename(name):
     return name.strip('-.') or 'site'
 
 
-# --- Helpers for publishing ---
-def _filename_from_url(u: str, default_prefix: str = 'asset') -> str:
-    try:
-        parsed = urlparse(u)
-        base = os.path.basename(parsed.path) if parsed.path else ''
-        if not base or '.' not in base:
-            base = f"{default_prefix}-" + ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-        return base
-    except Exception:
-        return f"{default_prefix}-" + ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-
-
-def _is_http_url(u: str) -> bool:
-    return isinstance(u, str) and (u.startswith('http://') or u.startswith('https://'))
-
-
-def _save_data_uri(data_uri: str, dest_dir: str, default_prefix: str) -> str:
-    try:
-        header, b64data = data_uri.split(',', 1)
-        # Extract mime
-        mime = 'application/octet-stream'
-        if ';' in header and header.startswith('data:'):
-            mime = header.split(';')[0][5:]
-        ext = mimetypes.guess_extension(mime) or '.bin'
-        fname = f"{default_prefix}-" + ''.join(random.choices(string.ascii_lowercase + string.digits, k=8)) + ext
-        os.makedirs(dest_dir, exist_ok=True)
-        with open(os.path.join(dest_dir, fname), 'wb') as f:
-            f.write(base64.b64decode(b64data))
-        return fname
-    except Exception:
-        return None
-
-
-def _download_file(url: str, dest_dir: str, default_prefix: str) -> str:
-    try:
-        os.makedirs(dest_dir, exist_ok=True)
-        fname = _filename_from_url(url, default_prefix)
-        dest_path = os.path.join(dest_dir, fname)
-        # If already exists, reuse existing file and avoid duplicate writes
-        if os.path.exists(dest_path):
-            return fname
-        r = requests.get(url, timeout=30)
-        r.raise_for_status()
-        with open(dest_path, 'wb') as f:
-            f.write(r.content)
-        return fname
-    except Exception as e:
-        print(f"Failed to download {url}: {e}")
-        return None
-
-
-def _resolve_temp_media_local_path(u: str) -> str | None:
-    """If the given URL points to /static/temp_media, return local filesystem path."""
-    try:
-        if not isinstance(u, str):
-            return None
-        # If absolute URL, extract path
-        path = u
-        if _is_http_url(u):
-            path = urlparse(u).path or ''
-        # Normalize potential prefixes
-        if path.startswith('/static/temp_media/'):
-            local_rel = path.lstrip('/')
-        elif path.startswith('static/temp_media/'):
-            local_rel = path
-        else:
-            return None
-        local_fs = os.path.join(*local_rel.split('/'))  # normalize separators
-        return local_fs if os.path.isfile(local_fs) else None
-    except Exception:
-        return None
-
-
-def analyze_images_needed(html: str, site_folder: str) -> int:
-    """Count how many new image files would be saved into site_folder.
-    Only counts <img src> and SVG <image href/xlink:href>. Does not count audio/video.
-    NOTE: This function is pure and MUST NOT create the destination folder to avoid
-    false positives when checking if a site already exists.
-    """
-    try:
-        soup = BeautifulSoup(html or '', 'html.parser')
-        dest_dir = site_folder
-        # IMPORTANT: Do NOT create dest_dir here. We only want to simulate whether files would be new.
-
-        def will_need_new_file(src: str) -> bool:
-            if not src:
-                return False
-            # data URI will always create a new file
-            if src.startswith('data:'):
-                return True
-            # temp_media
-            local_src = _resolve_temp_media_local_path(src)
-            if local_src:
-                fname = os.path.basename(local_src)
-                return not os.path.exists(os.path.join(dest_dir, fname))
-            # remote
-            if _is_http_url(src):
-                fname = _filename_from_url(src, 'img')
-                return not os.path.exists(os.path.join(dest_dir, fname))
-            return False
-
-        count = 0
-        # IMG tags
-        for tag in soup.find_all('img'):
-            src = tag.get('src')
-            if will_need_new_file(src):
-                count += 1
-        # SVG image tags
-        for tag in soup.find_all('image'):
-            href = tag.get('href') or tag.get('{http://www.w3.org/1999/xlink}href') or tag.get('xlink:href')
-            if will_need_new_file(href):
-                count += 1
-        return count
-    except Exception as e:
-        print(f"Error analyzing images: {e}")
-        return 0
-
-
-def localize_multimedia(html: str, site_folder: str, public_prefix: str) -> tuple[str, int]:
-    """
-    Downloads/moves multimedia assets into site_folder and rewrites URLs to public_prefix.
-    Also moves any files referenced from /static/temp_media into the site folder.
-    Returns (updated HTML string, images_moved_count) where images_moved_count includes only image assets (img, svg image).
-    Ensures that after publish/republish, all image references in HTML (including srcset and inline styles) point to the website folder.
-    Now also rewrites common lazy-load attributes (data-src, data-original, data-bg, data-background, data-image, data-srcset).
-    """
-    images_moved_count = 0
-    try:
-        soup = BeautifulSoup(html or '', 'html.parser')
-        dest_dir = site_folder
-
-        def is_already_site_url(src: str) -> bool:
-            if not isinstance(src, str) or not src:
-                return False
-            # Extract path for absolute URLs
-            path = src
-            if _is_http_url(src):
-                try:
-                    path = urlparse(src).path or ''
-                except Exception:
-                    path = src
-            # Normalize public prefix without leading slash
-            pp = public_prefix.lstrip('/') if isinstance(public_prefix, str) else ''
-            # Accept both with and without leading slash for the website folder
-            if path.startswith(public_prefix + '/') or path == public_prefix:
-                return True
-            if path.startswith(pp) or path.startswith('/' + pp):
-                return True
-            # Consider site-relative paths (e.g., images/foo.jpg, ./img/x.png, ../assets/y.webp)
-            # as already site content, as long as they are not explicitly temp_media or data URIs
-            if not _is_http_url(src) and not (path.startswith('/static/temp_media') or path.startswith('static/temp_media')):
-                if path.startswith('./') or path.startswith('../'):
-                    return True
-                # No leading slash and not data/absolute => likely site-relative
-                if not path.startswith('/') and not src.startswith('data:'):
-                    return True
-            return False
-
-        def copy_from_temp_or_download(src: str, default_prefix: str) -> str | None:
-            nonlocal images_moved_count
-            # Leave intact if it already points to the current website folder
-            if is_already_site_url(src):
-                return ''  # signal no change
-            moved = False
-            # First, try to resolve from temp_media
-            local_src = _resolve_temp_media_local_path(src)
-            if local_src:
-                try:
-                    os.makedirs(dest_dir, exist_ok=True)
-                    orig_name = os.path.basename(local_src)
-                    target = os.path.join(dest_dir, orig_name)
-                    before = set(os.listdir(dest_dir)) if os.path.isdir(dest_dir) else set()
-                    if not os.path.exists(target):
-                        # Move from temp_media so it won't be deleted at midnight
-                        shutil.move(local_src, target)
-                        moved = True
-                    # If exists, we reuse existing and do not move
-                    after = set(os.listdir(dest_dir)) if os.path.isdir(dest_dir) else set()
-                    if len(after - before) > 0:
-                        images_moved_count += 1
-                    return orig_name if (moved or os.path.exists(target)) else None
-                except Exception as e:
-                    print(f"Failed to move from temp_media {local_src}: {e}")
-            # Then, handle data URIs or remote URLs
-            if src and src.startswith('data:'):
-                before = set(os.listdir(dest_dir)) if os.path.isdir(dest_dir) else set()
-                fname = _save_data_uri(src, dest_dir, default_prefix)
-                after = set(os.listdir(dest_dir)) if os.path.isdir(dest_dir) else set()
-                if fname and len(after - before) > 0:
-                    images_moved_count += 1
-                return fname
-            if _is_http_url(src):
-                before = set(os.listdir(dest_dir)) if os.path.isdir(dest_dir) else set()
-                fname = _download_file(src, dest_dir, default_prefix)
-                after = set(os.listdir(dest_dir)) if os.path.isdir(dest_dir) else set()
-                if fname and len(after - before) > 0:
-                    images_moved_count += 1
-                return fname
-            return None
-
-        def rewrite_style_urls(style_val: str) -> str:
-            # Replace url(...) occurrences inside inline styles
-            def repl(m):
-                url_inner = m.group(1).strip().strip("'\"")
-                newfname = copy_from_temp_or_download(url_inner, 'img')
-                newurl = f"{public_prefix}/{newfname}" if newfname else url_inner
-                return f"url('{newurl}')"
-            # match url("..."), url('...') or url(...)
-            return re.sub(r"url\(([^)]+)\)", repl, style_val or '')
-
-        def rewrite_srcset(val: str) -> str:
-            # Parse srcset: comma-separated, each item: URL [descriptor]
-            items = [x.strip() for x in (val or '').split(',') if x.strip()]
-            out = []
-            for it in items:
-                parts = it.split()
-                if not parts:
-                    continue
-                urlp = parts[0]
-                desc = ' '.join(parts[1:])
-                fname = copy_from_temp_or_download(urlp, 'img')
-                newu = f"{public_prefix}/{fname}" if fname else urlp
-                out.append((newu + (f" {desc}" if desc else '')).strip())
-            return ', '.join(out)
-
-        def rewrite_attr(tag, attr_name: str, default_prefix: str = 'img'):
-            if not tag.has_attr(attr_name):
-                return
-            val = tag.get(attr_name)
-            if not val:
-                return
-            if attr_name.endswith('srcset'):
-                tag[attr_name] = rewrite_srcset(val)
-            else:
-                fname = copy_from_temp_or_download(val, default_prefix)
-                if fname:
-                    tag[attr_name] = f"{public_prefix}/{fname}"
-
-        # IMG tags (src and srcset and lazy variants)
-        for tag in soup.find_all('img'):
-            for a in ['src', 'data-src', 'data-original', 'data-url', 'data-image', 'data-bg', 'data-background']:
-                rewrite_attr(tag, a, 'img')
-            for a in ['srcset', 'data-srcset', 'data-responsive-srcset']:
-                rewrite_attr(tag, a, 'img')
-            # Inline style background-image, etc.
-            if tag.has_attr('style'):
-                tag['style'] = rewrite_style_urls(tag.get('style', ''))
-
-        # PICTURE/SOURCE for responsive images (srcset and lazy variants)
-        for tag in soup.find_all('source'):
-            for a in ['srcset', 'data-srcset']:
-                rewrite_attr(tag, a, 'img')
-            if tag.has_attr('style'):
-                tag['style'] = rewrite_style_urls(tag.get('style', ''))
-
-        # SVG <image> tags (xlink:href or href)
-        for tag in soup.find_all('image'):
-            href = tag.get('href') or tag.get('{http://www.w3.org/1999/xlink}href') or tag.get('xlink:href')
-            if href:
-                fname = copy_from_temp_or_download(href, 'img')
-                if fname:
-                    newv = f"{public_prefix}/{fname}"
-                    tag['href'] = newv
-                    if '{http://www.w3.org/1999/xlink}href' in tag.attrs:
-                        tag['{http://www.w3.org/1999/xlink}href'] = newv
-                    if 'xlink:href' in tag.attrs:
-                        tag['xlink:href'] = newv
-            if tag.has_attr('style'):
-                tag['style'] = rewrite_style_urls(tag.get('style', ''))
-
-        # Also rewrite inline styles globally on common containers
-        for tag in soup.find_all(True):
-            if tag.has_attr('style'):
-                tag['style'] = rewrite_style_urls(tag.get('style', ''))
-
-        # Rewrite URLs inside <style> tags content
-        for sty in soup.find_all('style'):
-            if sty.string:
-                try:
-                    sty.string.replace_with(rewrite_style_urls(sty.string))
-                except Exception as e:
-                    print(f"Failed to rewrite <style> content urls: {e}")
-
-        # LINK tags that reference images (preload icons etc.)
-        for l in soup.find_all('link'):
-            rel = ' '.join(l.get('rel') or []).lower()
-            as_attr = (l.get('as') or '').lower()
-            href = l.get('href')
-            if not href:
-                continue
-            is_image_link = ('icon' in rel) or ('apple-touch-icon' in rel) or (as_attr == 'image')
-            if is_image_link:
-                fname = copy_from_temp_or_download(href, 'img')
-                if fname:
-                    l['href'] = f"{public_prefix}/{fname}"
-
-        # AUDIO and VIDEO tags (src, poster)
-        for tag in soup.find_all(['audio', 'video']):
-            src = tag.get('src')
-            if src:
-                fname = copy_from_temp_or_download(src, 'media')
-                if fname:
-                    tag['src'] = f"{public_prefix}/{fname}"
-            poster = tag.get('poster')
-            if poster:
-                fname = copy_from_temp_or_download(poster, 'poster')
-                if fname:
-                    tag['poster'] = f"{public_prefix}/{fname}"
-            for s in tag.find_all('source'):
-                ssrc = s.get('src')
-                if not ssrc:
-                    continue
-                fname = copy_from_temp_or_download(ssrc, 'media')
-                if fname:
-                    s['src'] = f"{public_prefix}/{fname}"
-
-        return str(soup), images_moved_count
-    except Exception as e:
-        print(f"Error localizing multimedia: {e}")
-        return html, images_moved_count
-
 # --- Image upload endpoint ---
 ALLOWED_IMAGE_EXTS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg'}
 
@@ -574,14 +525,15 @@ def schedule_temp_media_cleanup():
 # Start the cleanup scheduler
 schedule_temp_media_cleanup()
 start_background_updater()
+# Kept warm by start_background_updater (batched Dexscreener requests for every configured mint)
+price_service = get_price_service()
 
 @app.route('/api/spl_price')
 def api_spl_price():
-    """Diagnostic endpoint: returns live Dexscreener price, cached, and DB stored metrics.
+    """Diagnostic endpoint: returns the price service quote (with age and source) and DB stored metrics.
     Helps debug anomalies (e.g., USDC showing 0.004)."""
     mint = os.getenv('SPL_TOKEN_MINT','')
-    live = get_dexscreener_price(mint) if mint else None
-    cached = get_token_price_cached(mint) if mint else None
+    quote = price_service.quote(mint)
     metrics = None
     try:
         metrics = db_builder.fetch_token_metrics(mint) if mint else None
@@ -589,10 +541,16 @@ def api_spl_price():
         metrics = None
     return jsonify({
         'mint': mint,
-        'live_price_usd': live,
-        'cached_price_usd': cached,
+        'live_price_usd': quote['price'],
+        'cached_price_usd': quote['price'],
+        'price_age_sec': quote['age_sec'],
+        'price_stale': quote['stale'],
+        'price_last_error': quote['last_error'],
+        'price_service': price_service.stats(),
+        'solana_rpc': get_rpc().stats(),
+        'balance_cache': get_balance_cache().stats(),
         'db_metrics': metrics,
-        'price_source_note': 'live is direct Dexscreener robust; cached is last in-memory; db_metrics from periodic updater',
+        'price_source_note': 'price comes from the in-memory price service (Dexscreener, refreshed in the background; db until the first fetch); db_metrics from periodic updater',
     })
 
 @app.route('/sign-up')
@@ -623,14 +581,7 @@ def confirm_and_signup():
         if not (username and password):
             return jsonify({'success': False, 'error': 'All fields are required'}), 400
 
-        db_tool = AccountsDBTools(
-            user_db=os.getenv('USERDB'),
-            password_db=os.getenv('PASSWORDDB'),
-            host_db=os.getenv('DBHOST'),
-            port_db=os.getenv('PORTDB'),
-            database="strawberry_platform"
-        )
-        result = db_tool.register_new_user(username, password)
+        result = db_builder.register_new_user(username, password)
 
         if "successfully" in result:
             return jsonify({'success': True})
@@ -649,15 +600,7 @@ def login_action():
     if not (username and password):
         return jsonify({'error': 'Username and password are required'}), 400
 
-    login_process = AccountsDBTools(
-        user_db=os.getenv('USERDB'),
-        password_db=os.getenv('PASSWORDDB'),
-        host_db=os.getenv('DBHOST'),
-        port_db=os.getenv('PORTDB'),
-        database="strawberry_platform"
-    )
-
-    result = login_process.login_session(username, password)
+    result = db_builder.login_session(username, password)
     result_json = json.loads(result)
 
     if "error" not in result_json:
@@ -694,9 +637,8 @@ def chat(hashchat=None):
             return render_template('chatweb.html', username=session['username'], hashchat=None, balance=balance)
 
     # Load existing chat
-    history = db_builder.load_chat_history(hashchat, user_id)
+    history = _get_chat_history(hashchat, user_id)
     if history is not None:
-        chat_sessions.ChatHistory[hashchat] = history
         session['hashchat'] = hashchat
         return render_template('chatweb.html',
                                username=session['username'],
@@ -713,7 +655,7 @@ def new_chat():
         return jsonify({'success': False, 'error': 'Unauthorized'}), 401
 
     hashchat = ''.join(random.choices(string.ascii_letters + string.digits, k=18))
-    chat_sessions.ChatHistory[hashchat] = []
+    chat_sessions.set_history(hashchat, [], session['user_id'])
     db_builder.save_chat_history(session['user_id'], hashchat, f"New Chat {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}", [])
     
     return jsonify({'success': True, 'hashchat': hashchat})
@@ -724,8 +666,71 @@ def chat_history():
         return redirect(url_for('login'))
     return render_template('chat_history.html', username=session['username'])
 
+def _run_publish_job(job, plan, html_content, site_folder, sanitized_name, website_name, user_id, hashchat,
+                     republish_flag, total_cost, images_to_save):
+    """Worker side of /publish_website: build the site in a staging folder, swap it in, record it.
+    Refunds the reserved cost if the build fails before the swap; once the site is live it is kept."""
+    tag = '[republish]' if republish_flag else '[publish_website]'
+    staging = None
+    committed = False
+    try:
+        publish_jobs.update(job, stage='staging')
+        staging = stage_site(site_folder, job['id'])
+        plan.retarget(staging)
+
+        publish_jobs.update(job, stage='assets')
+        processed_html, moved_images = localize_plan(
+            plan, progress=lambda done, total: publish_jobs.update(job, assets_done=done, assets_total=total))
+        processed_html = processed_html or html_content
+
+        publish_jobs.update(job, stage='writing')
+        write_file_atomic(os.path.join(staging, 'index.html'), processed_html)
+        precompress_site(staging)
+        commit_site(staging, site_folder)
+        committed = True
+        staging = None
+
+        # Update the active chat session document so recall_html returns the finalized HTML
+        if hashchat and hashchat in chat_sessions.sessions_online:
+            try:
+                chat_sessions.sessions_online[hashchat].current_document = processed_html
+            except Exception as e:
+                print(f"{tag} Failed to update current_document for {hashchat}: {e}")
+
+        relative_url = f"/static/websites/{sanitized_name}/index.html"
+        base_url = os.getenv('BASE_URL', 'http://localhost:8080').rstrip('/')
+        public_url = f"{base_url}{relative_url}"
+
+        if republish_flag:
+            try:
+                db_builder.update_website_by_file(user_id, f"{sanitized_name}/index.html", website_name, f"{sanitized_name}/index.html")
+            except Exception as e:
+                print(f"{tag} update_website_by_file failed, fallback to save_website: {e}")
+                db_builder.save_website(user_id, relative_url, website_name, f"{sanitized_name}/index.html")
+        else:
+            db_builder.save_website(user_id, relative_url, website_name, f"{sanitized_name}/index.html")
+
+        print(f"{tag} job={job['id']} done site='{sanitized_name}' images_saved={moved_images}")
+        return {'url': public_url, 'republish': republish_flag, 'images_saved': int(moved_images), 'images_charged': int(images_to_save)}
+    except Exception:
+        if committed:
+            # The new site is already being served: the user got what they paid for
+            print(f"{tag}[error] job={job['id']} failed after site '{sanitized_name}' went live; not refunding")
+            raise
+        if db_builder.adjust_user_balance(user_id, total_cost):
+            ledger.invalidate(user_id)
+            print(f"{tag} job={job['id']} failed; refunded {total_cost} to user_id={user_id}")
+        else:
+            print(f"{tag}[error] job={job['id']} failed and the refund of {total_cost} to user_id={user_id} did not apply")
+        raise
+    finally:
+        if staging and os.path.isdir(staging):
+            shutil.rmtree(staging, ignore_errors=True)
+
+
 @app.route('/publish_website', methods=['POST'])
 def publish_website():
+    """Validate, price and reserve the cost, then hand the build to a publish job (202 + job id)."""
     data = request.get_json()
     html_content = data.get('html_content', '')
     website_name = escape(data.get('website_name', ''))
@@ -748,6 +753,7 @@ def publish_website():
     websites_root = os.path.join('static', 'websites')
     os.makedirs(websites_root, exist_ok=True)
     site_folder = os.path.join(websites_root, sanitized_name)
+    public_prefix = f"/static/websites/{sanitized_name}"
 
     price_per_publish = Decimal(os.getenv('PRICE_PER_PUBLISH_USD', '50'))
     price_per_republish = Decimal(os.getenv('PRICE_PER_REPUBLISH_USD', '0.10'))
@@ -755,19 +761,22 @@ def publish_website():
 
     balance = db_builder.get_user_balance(user_id)
     recharge_url = os.getenv('RECHARGE_URL')
+    tag = '[republish]' if republish_flag else '[publish_website]'
 
     # Debug logs about inputs and paths
     print(f"[publish_website] user_id={user_id} website_name_raw='{website_name}' sanitized='{sanitized_name}' republish={republish_flag}")
     print(f"[publish_website] websites_root='{websites_root}' site_folder='{site_folder}' exists? {os.path.exists(site_folder)}")
 
-    if not republish_flag:
-        # Check case-insensitively for existing folder BEFORE any side effects
+    def site_exists():
+        # Case-insensitive check for an existing folder BEFORE any side effects
         try:
             existing_dirs_lower = {d.lower() for d in os.listdir(websites_root) if os.path.isdir(os.path.join(websites_root, d))}
         except FileNotFoundError:
             existing_dirs_lower = set()
-        print(f"[publish_website] existing_dirs_lower={sorted(existing_dirs_lower)}")
-        if sanitized_name.lower() in existing_dirs_lower or os.path.isdir(site_folder):
+        return sanitized_name.lower() in existing_dirs_lower or os.path.isdir(site_folder)
+
+    if not republish_flag:
+        if site_exists() or publish_jobs.is_reserved(sanitized_name):
             msg = 'No se pudo publicar el sitio: Esta web ya existe (carpeta). Elige otro nombre o usa Republish.'
             print(f"[publish_website][error] {msg}")
             return jsonify({
@@ -779,98 +788,91 @@ def publish_website():
                     'site_folder_exists': os.path.isdir(site_folder)
                 }
             }), 400
-
-        # Only analyze images after confirming the folder does not exist
-        images_to_save = analyze_images_needed(html_content, site_folder)
-        images_cost = price_per_image * Decimal(images_to_save)
-        print(f"[publish_website] images_to_save={images_to_save} images_cost={images_cost}")
-
-        total_cost = price_per_publish + images_cost
-        if balance is None or balance < total_cost:
-            print(f"[publish_website][error] Insufficient balance. balance={balance} needed={total_cost}")
-            return jsonify({'success': False, 'error': f'Insufficient balance. Need ${total_cost} USD.', 'recharge_url': recharge_url}), 402
-        # Deduct first
-        db_builder.update_user_balance(user_id, balance - total_cost)
-
-        # Create folder now that we're certain it doesn't exist
-        os.makedirs(site_folder, exist_ok=True)
-        public_prefix = f"/static/websites/{sanitized_name}"
-        processed_html, moved_images = localize_multimedia(html_content, site_folder, public_prefix)
-
-        # Save index.html
-        index_path = os.path.join(site_folder, 'index.html')
-        with open(index_path, 'w', encoding='utf-8') as f:
-            f.write(processed_html)
-
-        # Update the active chat session document so recall_html returns the finalized HTML
-        if hashchat and hashchat in chat_sessions.sessions_online:
-            try:
-                chat_sessions.sessions_online[hashchat].current_document = processed_html
-            except Exception as e:
-                print(f"[publish_website] Failed to update current_document for {hashchat}: {e}")
-
-        relative_url = url_for('static', filename=f'websites/{sanitized_name}/index.html')
-        base_url = os.getenv('BASE_URL', 'http://localhost:8080').rstrip('/')
-        public_url = f"{base_url}{relative_url}"
-
-        db_builder.save_website(user_id, relative_url, website_name, f"{sanitized_name}/index.html")
-        return jsonify({'success': True, 'url': public_url, 'republish': False, 'images_saved': int(moved_images), 'images_charged': int(images_to_save)})
-
-    # Republish flow
-    existing_website = None
-    try:
-        existing_website = db_builder.get_website_by_file(user_id, f"{sanitized_name}/index.html")
-    except Exception as e:
-        print(f"[publish_website] get_website_by_file error: {e}")
+        base_price = price_per_publish
+    else:
         existing_website = None
-    if not existing_website:
         try:
-            existing_website = db_builder.get_website_by_name(user_id, website_name)
+            existing_website = db_builder.get_website_by_file(user_id, f"{sanitized_name}/index.html")
         except Exception as e:
-            print(f"[publish_website] get_website_by_name error: {e}")
+            print(f"[publish_website] get_website_by_file error: {e}")
             existing_website = None
-    if not existing_website:
-        print("[publish_website][error] Republish denied: website not found for this user")
-        return jsonify({'success': False, 'error': 'Solo puedes republicar sitios que te pertenecen. Abre el historial y usa el botón Republish.'}), 403
-
-    # Analyze images for republish
-    images_to_save = analyze_images_needed(html_content, site_folder)
+        if not existing_website:
+            try:
+                existing_website = db_builder.get_website_by_name(user_id, website_name)
+            except Exception as e:
+                print(f"[publish_website] get_website_by_name error: {e}")
+                existing_website = None
+        if not existing_website:
+            print("[publish_website][error] Republish denied: website not found for this user")
+            return jsonify({'success': False, 'error': 'Solo puedes republicar sitios que te pertenecen. Abre el historial y usa el botón Republish.'}), 403
+        base_price = price_per_republish
+
+    # Parse once: the plan prices the images here and drives the build in the job
+    plan = plan_assets(html_content, site_folder, public_prefix)
+    images_to_save = plan.new_file_count()
     images_cost = price_per_image * Decimal(images_to_save)
-    print(f"[republish] images_to_save={images_to_save} images_cost={images_cost}")
+    total_cost = base_price + images_cost
+    print(f"{tag} images_to_save={images_to_save} images_cost={images_cost}")
 
-    total_cost = price_per_republish + images_cost
     if balance is None or balance < total_cost:
-        print(f"[republish][error] Insufficient balance. balance={balance} needed={total_cost}")
+        print(f"{tag}[error] Insufficient balance. balance={balance} needed={total_cost}")
         return jsonify({'success': False, 'error': f'Insufficient balance. Need ${total_cost} USD.', 'recharge_url': recharge_url}), 402
-    db_builder.update_user_balance(user_id, balance - total_cost)
-
-    os.makedirs(site_folder, exist_ok=True)
-
-    public_prefix = f"/static/websites/{sanitized_name}"
-    processed_html, moved_images = localize_multimedia(html_content, site_folder, public_prefix)
-
-    index_path = os.path.join(site_folder, 'index.html')
-    with open(index_path, 'w', encoding='utf-8') as f:
-        f.write(processed_html)
 
-    # Update the active chat session document so recall_html returns the finalized HTML (republish)
-    if hashchat and hashchat in chat_sessions.sessions_online:
-        try:
-            chat_sessions.sessions_online[hashchat].current_document = processed_html
-        except Exception as e:
-            print(f"[republish] Failed to update current_document for {hashchat}: {e}")
+    job_id = publish_jobs.reserve(sanitized_name)
+    if job_id is None:
+        return jsonify({'success': False, 'error': 'Ya hay una publicación en curso para esta web. Espera a que termine.'}), 409
+    if not republish_flag and site_exists():
+        publish_jobs.release(sanitized_name, job_id)
+        return jsonify({'success': False, 'error': 'Esta web ya existe (carpeta). Elige otro nombre o usa Republish.'}), 400
 
-    relative_url = url_for('static', filename=f'websites/{sanitized_name}/index.html')
-    base_url = os.getenv('BASE_URL', 'http://localhost:8080').rstrip('/')
-    public_url = f"{base_url}{relative_url}"
+    # Reserve the cost up front (atomic, refuses if a concurrent charge already spent the balance)
+    if not db_builder.debit_user_balance(user_id, total_cost):
+        publish_jobs.release(sanitized_name, job_id)
+        return jsonify({'success': False, 'error': f'Insufficient balance. Need ${total_cost} USD.', 'recharge_url': recharge_url}), 402
+    ledger.invalidate(user_id)
 
     try:
-        db_builder.update_website_by_file(user_id, f"{sanitized_name}/index.html", website_name, f"{sanitized_name}/index.html")
+        publish_jobs.submit(job_id, user_id, sanitized_name, _run_publish_job, plan, html_content, site_folder,
+                            sanitized_name, website_name, user_id, hashchat, republish_flag, total_cost, images_to_save)
     except Exception as e:
-        print(f"[republish] update_website_by_file failed, fallback to save_website: {e}")
-        db_builder.save_website(user_id, relative_url, website_name, f"{sanitized_name}/index.html")
+        print(f"{tag}[error] Could not queue publish job: {e}")
+        db_builder.adjust_user_balance(user_id, total_cost)
+        ledger.invalidate(user_id)
+        return jsonify({'success': False, 'error': 'Could not start publishing. Please try again.'}), 503
 
-    return jsonify({'success': True, 'url': public_url, 'republish': True, 'images_saved': int(moved_images), 'images_charged': int(images_to_save)})
+    return jsonify({
+        'success': True,
+        'pending': True,
+        'job_id': job_id,
+        'status_url': url_for('publish_status', job_id=job_id),
+        'republish': republish_flag,
+        'images_charged': int(images_to_save),
+    }), 202
+
+
+@app.route('/publish_status/<job_id>')
+def publish_status(job_id):
+    """Progress of a publish job started by the current user; includes the URL once done."""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'User not logged in'}), 401
+    job = publish_jobs.get(job_id)
+    if not job or job['user_id'] != session['user_id']:
+        return jsonify({'success': False, 'error': 'Publish job not found'}), 404
+    payload = {
+        'success': job['status'] != 'failed',
+        'job_id': job_id,
+        'status': job['status'],
+        'stage': job['stage'],
+        'assets_done': job['assets_done'],
+        'assets_total': job['assets_total'],
+    }
+    if job['status'] == 'done' and job['result']:
+        payload.update(job['result'])
+    if job['status'] == 'failed':
+        payload['error'] = f"Publishing failed and was refunded: {job['error']}"
+    resp = jsonify(payload)
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
 
 @app.route('/update_messages_history', methods=['POST'])
 def update_messages_history():
@@ -882,24 +884,95 @@ def update_messages_history():
         if 'user_id' not in session:
             return jsonify({'error': "Unauthorized"}), 401
 
-        history = chat_sessions.ChatHistory.get(hashchat)
+        history = chat_sessions.cached_history(hashchat)
         if history is None:
             history = db_builder.load_chat_history(hashchat, session['user_id'])
             if history is None:
                 return jsonify({'message': "not_update_history_chat", "audio_autoplay": None, "deploy_item": None, "role": "system"})
-            chat_sessions.ChatHistory[hashchat] = history
+            history = chat_sessions.set_history(hashchat, history, session['user_id'])
 
         if len(history) <= len_list_history:
             return jsonify({'message': "not_update_history_chat", "audio_autoplay": None, "deploy_item": None, "role": "system"})
         else:
-            return jsonify(history)
+            # Legacy full-history format: inline the snapshot HTML of deploy items
+            return jsonify([
+                dict(m, message=m.get('message') or chat_sessions.snapshots.get(m.get('deploy_ref')))
+                if m.get('deploy_item') else m
+                for m in history
+            ])
     except Exception as e:
         print(f"Error en update_messages_history: {e}")
         return jsonify({'message': "Internal server error. Please try again later.", "audio_autoplay": None, "deploy_item": None, "role": "server"}), 500
 
-@app.route('/chat/message', methods=['POST'])
-def message():
-    data = request.get_json()
+def _get_chat_history(hashchat, user_id):
+    """In-memory history for hashchat, loading (and normalizing) it from MySQL on a miss. None if not owned."""
+    history = chat_sessions.cached_history(hashchat)
+    if history is not None and chat_sessions.owner_of(hashchat) not in (None, user_id):
+        return None
+    if history is None:
+        history = db_builder.load_chat_history(hashchat, user_id)
+        if history is None:
+            return None
+        history = chat_sessions.set_history(hashchat, history, user_id)
+    return history
+
+
+def _public_history_entry(entry):
+    """Wire format for a history entry: deploy items carry only their content hash, not the HTML."""
+    if entry.get('deploy_item'):
+        return {'seq': entry['seq'], 'role': entry.get('role', 'deploy_item'), 'deploy_item': True, 'deploy_ref': entry.get('deploy_ref')}
+    return {'seq': entry['seq'], 'role': entry.get('role'), 'message': entry.get('message'), 'deploy_item': False}
+
+
+@app.route('/chat/<hashchat>/messages')
+def chat_messages_since(hashchat):
+    """Return only the history entries with seq > ?after=<cursor>. Unchanged responses answer 304 via ETag."""
+    if 'user_id' not in session:
+        return jsonify({'error': "Unauthorized"}), 401
+    hashchat = escape(hashchat)
+    history = _get_chat_history(hashchat, session['user_id'])
+    if history is None:
+        return jsonify({'error': 'Chat not found'}), 404
+    after = request.args.get('after', 0, type=int)
+    cursor = chat_sessions.last_seq(history)
+
+    resp = jsonify({
+        'cursor': cursor,
+        'messages': [_public_history_entry(m) for m in history if m['seq'] > after],
+    })
+    resp.set_etag(f"{hashchat}-{after}-{cursor}")
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp.make_conditional(request)
+
+
+@app.route('/chat/<hashchat>/deploy/<ref>')
+def chat_deploy_item(hashchat, ref):
+    """Serve a deployed HTML snapshot referenced by content hash from the chat history."""
+    if 'user_id' not in session:
+        return jsonify({'error': "Unauthorized"}), 401
+    hashchat = escape(hashchat)
+    history = _get_chat_history(hashchat, session['user_id'])
+    entry = next((m for m in reversed(history or []) if m.get('deploy_ref') == ref), None)
+    if entry is None:
+        abort(404)
+    html = entry.get('message') or chat_sessions.snapshots.get(ref)
+    if html is None:
+        abort(404)
+    resp = make_response(html)
+    # Plain text: the client writes it into the preview iframe; it must never render on our origin.
+    resp.mimetype = 'text/plain'
+    resp.headers['X-Content-Type-Options'] = 'nosniff'
+    resp.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    resp.set_etag(ref)
+    return resp.make_conditional(request)
+
+
+def _prepare_chat_turn(data):
+    """Validate a chat request, ensure an assistant session and history exist, and record the user message.
+
+    Returns (turn, None) or (None, error_response). `turn` carries hashchat, user_id and the model prompt.
+    """
+    data = data or {}
     hashchat = escape(data.get('hashchat', ''))
     # Original user-visible text
     message_text = escape(data.get('message', ''))
@@ -909,15 +982,15 @@ def message():
     url_images = data.get('url_images', []) or []
 
     if 'user_id' not in session:
-        return jsonify({'error': 'Unauthorized'}), 401
+        return None, (jsonify({'error': 'Unauthorized'}), 401)
 
     user_id = session['user_id']
 
-    # Check user balance
-    balance = db_builder.get_user_balance(user_id)
+    # Check user balance (cached ledger view, includes charges not yet flushed)
+    balance = ledger.available_balance(user_id)
     recharge_url = os.getenv('RECHARGE_URL')
     if balance is None or balance <= 0:
-        return jsonify({'error': 'Insufficient balance. Please recharge your account.', 'recharge_url': recharge_url}), 402
+        return None, (jsonify({'error': 'Insufficient balance. Please recharge your account.', 'recharge_url': recharge_url}), 402)
 
     # Check if assistant exists and is active
     if hashchat not in chat_sessions.sessions_online or \
@@ -936,10 +1009,13 @@ def message():
                                  "\n- When adding new images, keep all existing images and their URLs unchanged.")
 
         session_gpt = account_mg.flow_login_session(username, type_gpt_select)
-        session_gpt_instance = session_gpt.try_login_session(initial_instruction, user_id)
+        # Resume the thread another worker already holds for this chat, if any
+        session_gpt_instance = session_gpt.try_login_session(initial_instruction, user_id,
+                                                             thread_id=chat_sessions.thread_for(hashchat))
 
         if isinstance(session_gpt_instance, str):
-            return jsonify({'error': session_gpt_instance}), 500
+            return None, (jsonify({'error': session_gpt_instance}), 500)
+        chat_sessions.remember_thread(hashchat, session_gpt_instance['session_thread'].id)
         
         with open(os.path.join(route_mount, f'json_files/templates_structures/gpt_configs/{type_gpt_select}.json'), 'r') as f:
             data_config = json.load(f)
@@ -968,47 +1044,126 @@ def message():
             joined = '\n'.join(urls)
             message_for_model = f"{message_text}\n\nademas debes incluir estas imagenes: aca van todas las url:\n{joined}"
 
-    if hashchat not in chat_sessions.ChatHistory:
+    if chat_sessions.cached_history(hashchat) is None:
         loaded_history = db_builder.load_chat_history(hashchat, user_id)
         if loaded_history is None:
              # This case means the user is trying to access a chat that doesn't belong to them
              # or the hash is invalid. We can clear their session and redirect.
             session.clear()
-            return jsonify({'error': 'Unauthorized'}), 401
-        chat_sessions.ChatHistory[hashchat] = loaded_history
+            return None, (jsonify({'error': 'Unauthorized'}), 401)
+        chat_sessions.set_history(hashchat, loaded_history, user_id)
 
-    # Store only the original user text (no noisy system instructions)
-    chat_sessions.ChatHistory[hashchat].append({
-        'role': 'user',
-        'message': message_text
-    })
+    # Only one worker may run a turn of this chat at a time (shared state backends)
+    turn_lock = chat_sessions.turn_lock(hashchat)
+    if turn_lock is not None and not turn_lock.acquire():
+        return None, (jsonify({'error': 'A response is already in progress for this chat.'}), 409)
 
-    recive_msg, audio_recive, html_return = chat_sessions.sessions_online[hashchat].push_new_msg_user(
-        f'{username}: {message_for_model}', None, []
-    )
-    
+    try:
+        # Store only the original user text (no noisy system instructions)
+        chat_sessions.append_message(hashchat, {
+            'role': 'user',
+            'message': message_text
+        }, user_id)
+    except Exception:
+        if turn_lock is not None:
+            turn_lock.release()
+        raise
+
+    return {
+        'hashchat': hashchat,
+        'user_id': user_id,
+        'prompt': f'{username}: {message_for_model}',
+        'lock': turn_lock,
+    }, None
+
+
+def _release_chat_turn(turn):
+    """Release the turn lock; safe to call more than once."""
+    lock = turn.pop('lock', None)
+    if lock is not None:
+        lock.release()
+
+
+def _record_chat_turn(hashchat, user_id, recive_msg, html_return):
+    """Append the assistant answer (or deployed HTML) to the history and persist it."""
     recive_msg = escape(recive_msg)
 
     if html_return:
-        chat_sessions.ChatHistory[hashchat].append({
+        chat_sessions.append_message(hashchat, {
             'role': 'deploy_item',
             'message': html_return,
             "deploy_item": True,
-        })
+        }, user_id)
     else:
-        chat_sessions.ChatHistory[hashchat].append({
+        chat_sessions.append_message(hashchat, {
             'role': 'server',
             'message': recive_msg,
             "deploy_item": False,
-        })
+        }, user_id)
 
     # Save history
-    if chat_sessions.ChatHistory[hashchat]:
-        title = chat_sessions.ChatHistory[hashchat][0]['message'][:50] # First user message as title
-        db_builder.save_chat_history(user_id, hashchat, title, chat_sessions.ChatHistory[hashchat])
+    chat_sessions.save_history(hashchat, user_id)
+
+
+@app.route('/chat/message', methods=['POST'])
+def message():
+    turn, error = _prepare_chat_turn(request.get_json())
+    if error:
+        return error
+    hashchat = turn['hashchat']
+
+    try:
+        recive_msg, audio_recive, html_return = chat_sessions.sessions_online[hashchat].push_new_msg_user(
+            turn['prompt'], None, []
+        )
+        _record_chat_turn(hashchat, turn['user_id'], recive_msg, html_return)
+    finally:
+        _release_chat_turn(turn)
 
     return jsonify({'success': True})
 
+
+def _sse(event: dict) -> str:
+    return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+
+@app.route('/chat/message/stream', methods=['POST'])
+def message_stream():
+    """Same as /chat/message but streams token deltas, tool progress and deployed HTML as Server-Sent Events.
+
+    The history is persisted before the final `done` event, so clients can refresh right after it.
+    """
+    turn, error = _prepare_chat_turn(request.get_json())
+    if error:
+        return error
+    hashchat = turn['hashchat']
+    try:
+        run_session = chat_sessions.sessions_online[hashchat]
+    except Exception:
+        _release_chat_turn(turn)
+        raise
+
+    def generate():
+        # Flush headers immediately so the browser sees the first byte before the run starts.
+        yield ": stream-open\n\n"
+        try:
+            for event in run_session.stream_new_msg_user(turn['prompt']):
+                if event['event'] == 'done':
+                    _record_chat_turn(hashchat, turn['user_id'], event['message'], event['html'])
+                elif event['event'] == 'error':
+                    _record_chat_turn(hashchat, turn['user_id'], event['message'], None)
+                yield _sse(event)
+        finally:
+            _release_chat_turn(turn)
+
+    resp = app.response_class(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    # The generator's finally never runs if the client leaves before the body is iterated
+    resp.call_on_close(lambda: _release_chat_turn(turn))
+    return resp
+
 @app.route('/history')
 def history():
     if 'user_id' not in session:
@@ -1067,7 +1222,7 @@ def delete_website():
         folder_path = os.path.join('static', 'websites', folder)
         if os.path.isdir(folder_path):
             try:
-                shutil.rmtree(folder_path)
+                remove_site(folder_path)
             except Exception as e:
                 print(f"Error deleting folder {folder_path}: {e}")
         else:
@@ -1081,6 +1236,9 @@ def delete_website():
         if os.path.exists(file_path):
             os.remove(file_path)
         
+    # Site files were hardlinks into the shared blob store; drop blobs nothing links to anymore
+    schedule_blob_gc()
+
     # Delete from database
     if db_builder.delete_website(user_id, website_name):
         return jsonify({'success': True})
@@ -1101,6 +1259,7 @@ def delete_chat():
     user_id = session['user_id']
     
     if db_builder.delete_chat_history(user_id, hashchat):
+        chat_sessions.forget(hashchat)
         return jsonify({'success': True})
     else:
         return jsonify({'success': False, 'error': 'Failed to delete chat history'}), 500
@@ -1113,6 +1272,7 @@ def delete_all_chats():
     user_id = session['user_id']
     
     if db_builder.delete_all_chat_history(user_id):
+        chat_sessions.forget(user_id=user_id)
         return jsonify({'success': True})
     else:
         return jsonify({'success': False, 'error': 'Failed to delete all chat history'}), 500
@@ -1141,8 +1301,10 @@ def webhook_recharge():
     if current_balance is None:
         return jsonify({'error': 'User not found'}), 404
 
-    new_balance = current_balance + Decimal(str(amount_usd))
-    db_builder.update_user_balance(user_id, new_balance)
+    if not db_builder.adjust_user_balance(user_id, Decimal(str(amount_usd))):
+        return jsonify({'error': 'Balance update failed'}), 500
+    ledger.invalidate(user_id)
+    new_balance = db_builder.get_user_balance(user_id) or (current_balance + Decimal(str(amount_usd)))
 
     return jsonify({'success': True, 'new_balance': float(new_balance)}), 200
 
@@ -1180,9 +1342,10 @@ def webhook_recharge_balance():
         return jsonify({'error': 'Formato de usuario invalido'}), 500
 
     try:
-        current_balance = db_builder.get_user_balance(user_id) or Decimal('0')
-        new_balance = Decimal(str(current_balance)) + Decimal(str(amount))
-        db_builder.update_user_balance(user_id, new_balance)
+        if not db_builder.adjust_user_balance(user_id, Decimal(str(amount))):
+            raise RuntimeError('balance update failed')
+        ledger.invalidate(user_id)
+        new_balance = db_builder.get_user_balance(user_id) or Decimal('0')
     except Exception as e:
         return jsonify({'error': 'No se pudo actualizar balance'}), 500
 
@@ -1197,13 +1360,10 @@ def recharge_page():
 def token_config():
     token_address = os.getenv('SPL_TOKEN_MINT','')
     treasury = os.getenv('PLATFORM_TREASURY_WALLET','')
-    # Fetch latest metrics (optional informational) but price MUST come directly from Dexscreener
+    # Fetch latest metrics (optional informational); price comes from the price service (no hardcoded default)
     metrics = db_builder.fetch_token_metrics(token_address) if token_address else None
-    live_price = get_dexscreener_price(token_address) if token_address else None
-    if live_price is None:
-        # Try cached as secondary (still originally from Dexscreener); no hardcoded default
-        live_price = get_token_price_cached(token_address)
-    price = live_price  # May be None
+    quote = price_service.quote(token_address, wait=PRICE_COLD_WAIT_SEC)
+    price = quote['price']  # May be None
     min_signup_usd = Decimal(os.getenv('MIN_SIGNUP_BALANCE_USD','5'))
     min_deposit_usd = Decimal(os.getenv('MIN_DEPOSIT_USD','1'))
     price_decimal = Decimal(str(price)) if price else Decimal('0')
@@ -1220,7 +1380,8 @@ def token_config():
         'metrics': metrics,
         'mint_address': token_address,
         'treasury': treasury,
-        'price_source': 'dexscreener_live' if price_decimal>0 else 'dexscreener_unavailable'
+        'price_source': ('dexscreener_live' if quote['source'] == 'dexscreener' else 'db_last_known') if price_decimal>0 else 'dexscreener_unavailable',
+        'price_age_sec': quote['age_sec'],
     }
     if price_decimal == 0:
         return jsonify(resp), 503
@@ -1263,11 +1424,9 @@ def validate_signup_balance():
     if not wallet_address:
         return jsonify({'error':'wallet_address required'}), 400
     balance_tokens = get_token_balance_owner(wallet_address)
-    # Always take live Dexscreener price for validation (no default). Fallback to cached if immediate live fails.
+    # Price service: last good Dexscreener price, refreshed in the background (no default)
     mint_addr = os.getenv('SPL_TOKEN_MINT','')
-    live_price = get_dexscreener_price(mint_addr) if mint_addr else None
-    if live_price is None:
-        live_price = get_token_price_cached(mint_addr)
+    live_price = price_service.get(mint_addr, wait=PRICE_COLD_WAIT_SEC)
     if live_price is None:
         return jsonify({'error': 'Precio de token no disponible (Dexscreener). Intenta mas tarde.'}), 503
     price = Decimal(str(live_price))
@@ -1343,63 +1502,6 @@ def api_deposit_proxy():
     return jsonify({'forward_status': status_code, 'payment_response': body, 'balance': float(current_balance) if current_balance is not None else 0})
 
 
-# --- Per-website rate limiter for static/websites ---
-def _get_website_hourly_limit() -> int:
-    """Read hourly limit from environment.
-    Prefer WEBSITE_HOURLY_LIMIT, fallback to MAX_REQUESTS_PER_HOUR_WEBSITE, default 1000.
-    """
-    try:
-        return int(os.getenv('WEBSITE_HOURLY_LIMIT', os.getenv('MAX_REQUESTS_PER_HOUR_WEBSITE', '1000')))
-    except Exception:
-        return 1000
-
-
-def _check_website_rate_limit(site: str) -> bool:
-    """Return True if allowed, False if the site exceeded the hourly limit."""
-    if not site:
-        return True
-    limit = _get_website_hourly_limit()
-    now = int(time.time())
-    current_window = now - (now % 3600)  # floor to current hour
-    with global_vars.web_rate_lock:
-        rec = global_vars.web_rate_limiter.get(site)
-        if not rec or rec.get('window') != current_window:
-            rec = {'window': current_window, 'count': 0}
-        if rec['count'] >= limit:
-            global_vars.web_rate_limiter[site] = rec
-            return False
-        rec['count'] += 1
-        global_vars.web_rate_limiter[site] = rec
-        return True
-
-
-@app.before_request
-def websites_rate_limit_guard():
-    """Apply per-website hourly limit to any request under /static/websites/*, even when served by Flask static handler."""
-    path = request.path or ''
-    prefix = '/static/websites/'
-    if not path.startswith(prefix):
-        return
-    rest = path[len(prefix):]
-    site = rest.split('/', 1)[0] if rest else ''
-    if not _check_website_rate_limit(site):
-        return make_response('Rate limit exceeded for this website. Try again later.', 429)
-
-
-@app.route('/static/websites/<path:filename>')
-def serve_rate_limited_website(filename):
-    """Serve files under static/websites with per-website hourly rate limit."""
-    # Extract the website folder (first path segment)
-    site = (filename.split('/', 1)[0] if '/' in filename else filename).strip()
-    if not _check_website_rate_limit(site):
-        return make_response('Rate limit exceeded for this website. Try again later.', 429)
-    # Delegate to Flask's file server from the websites directory
-    try:
-        return send_from_directory(os.path.join('static', 'websites'), filename)
-    except Exception:
-        # Preserve behavior similar to default static serving
-        abort(404)
-
 if __name__ == '__main__':
     print("Starting server...")
     app.run(debug=True, port=int(os.getenv('PORT', 8080)), host='0.0.0.0')
@@ -0,0 +1,185 @@
+"""Small in-process cache primitives shared by the app modules.
+
+LRUTTLStore is a thread-safe, dict-like map bounded by entry count, an
+estimated byte budget and an idle TTL. Evicted values are handed to an
+``on_evict(key, value, reason)`` callback outside the lock so owners can
+flush or close them.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+
+def approx_sizeof(value: Any) -> int:
+    """Cheap recursive size estimate (string payloads dominate our caches)."""
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return 64 + sum(approx_sizeof(k) + approx_sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return 56 + sum(approx_sizeof(v) for v in value)
+    return 32
+
+
+class LRUTTLStore:
+    _MISSING = object()
+
+    def __init__(self, name: str, max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+                 ttl: Optional[float] = None, sizeof: Callable[[Any], int] = approx_sizeof,
+                 on_evict: Optional[Callable[[Any, Any, str], None]] = None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self._lock = threading.RLock()
+        self._data: "OrderedDict[Any, list]" = OrderedDict()  # key -> [value, size, last_access]
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # --- dict-like API ---
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            rec = self._data.get(key)
+            return rec is not None and not self._expired(rec, time.time())
+
+    def __getitem__(self, key):
+        value = self.get(key, self._MISSING)
+        if value is self._MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            rec = self._data.get(key)
+            if rec is None or self._expired(rec, now):
+                self.misses += 1
+                return default
+            rec[2] = now
+            self._data.move_to_end(key)
+            self.hits += 1
+            return rec[0]
+
+    def set(self, key, value):
+        evicted = []
+        with self._lock:
+            now = time.time()
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+                if self._expired(old, now):
+                    # expired but not yet swept: it leaves the cache here
+                    self.evictions += 1
+                    evicted.append((key, old[0], 'expired'))
+            size = self.sizeof(value)
+            self._data[key] = [value, size, now]
+            self._bytes += size
+            evicted += self._enforce_bounds(protect=key)
+        self._notify(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            rec = self._data.pop(key, None)
+            if rec is None:
+                return default
+            self._bytes -= rec[1]
+            return rec[0]
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def touch(self, key):
+        with self._lock:
+            rec = self._data.get(key)
+            if rec is not None:
+                rec[2] = time.time()
+                self._data.move_to_end(key)
+
+    def resize(self, key):
+        """Re-measure a value that was mutated in place (e.g. a list that grew)."""
+        evicted = []
+        with self._lock:
+            rec = self._data.get(key)
+            if rec is None:
+                return
+            new_size = self.sizeof(rec[0])
+            self._bytes += new_size - rec[1]
+            rec[1] = new_size
+            evicted = self._enforce_bounds(protect=key)
+        self._notify(evicted)
+
+    # --- eviction ---
+    def _expired(self, rec, now) -> bool:
+        return self.ttl is not None and (now - rec[2]) > self.ttl
+
+    def _enforce_bounds(self, protect=None):
+        evicted = []
+        while self._data and (
+            (self.max_entries is not None and len(self._data) > self.max_entries)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            key = next(iter(self._data))
+            if key == protect:
+                if len(self._data) == 1:
+                    break
+                self._data.move_to_end(key)
+                key = next(iter(self._data))
+            rec = self._data.pop(key)
+            self._bytes -= rec[1]
+            self.evictions += 1
+            evicted.append((key, rec[0], 'capacity'))
+        return evicted
+
+    def sweep(self) -> int:
+        """Evict idle entries past the TTL. Returns how many were evicted."""
+        if self.ttl is None:
+            return 0
+        now = time.time()
+        evicted = []
+        with self._lock:
+            for key in list(self._data.keys()):
+                rec = self._data[key]
+                if self._expired(rec, now):
+                    del self._data[key]
+                    self._bytes -= rec[1]
+                    self.evictions += 1
+                    evicted.append((key, rec[0], 'expired'))
+        self._notify(evicted)
+        return len(evicted)
+
+    def _notify(self, evicted):
+        if not self.on_evict:
+            return
+        for key, value, reason in evicted:
+            try:
+                self.on_evict(key, value, reason)
+            except Exception as e:
+                print(f"[cache:{self.name}] on_evict failed for {key}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -7,7 +7,8 @@ from functions_calling_module import *
 import time
 from generator_pages import *
 import threading
-from db_module import AccountsDBTools
+from db_module import get_shared_db
+from ledger_module import get_ledger
 from decimal import Decimal
 
 # Configure the OpenAI client with the API key
@@ -48,14 +49,15 @@ class gpt_run_session:
         self.current_document = ""
         self.return_html_final = None
         self.lock = threading.Lock()
-        self.db_builder = AccountsDBTools(
-            user_db=os.getenv('USERDB'),
-            password_db=os.getenv('PASSWORDDB'),
-            host_db=os.getenv('DBHOST'),
-            port_db=os.getenv('PORTDB'),
-            database="strawberry_platform"
-        )
+        # Borrow the process-wide pool instead of opening a connection (and re-running DDL) per chat.
+        self.db_builder = get_shared_db()
+        # Charges are metered in memory and flushed once per turn (see ledger_module).
+        self.ledger = get_ledger()
     
+    def _charge(self, cost, reason):
+        self.user_balance -= cost
+        self.ledger.charge(self.user_id, cost, reason, self.hash_session)
+
     def call_function(self, function_name, *args, **kwargs):
         if function_name in functions_available:
             return functions_available[function_name](*args, **kwargs)
@@ -67,8 +69,7 @@ class gpt_run_session:
             if function_name == "CreateNewDocument":
                 render_html_code, total_tokens = functions_render_avalibles[function_name](*args, **kwargs)
                 cost = Decimal(total_tokens) * self.price_per_token_deepseek
-                self.user_balance -= cost
-                self.db_builder.update_user_balance(self.user_id, self.user_balance)
+                self._charge(cost, function_name)
                 return render_html_code
             else:
                 render_html_code = functions_render_avalibles[function_name](*args, **kwargs)
@@ -83,16 +84,17 @@ class gpt_run_session:
         
         # Handle special cases first
         
+        if not self.ledger.has_funds(self.user_id):
+            return "The user's balance is exhausted. Stop and ask the user to recharge their account before continuing."
+
         if function_name == "generate_music":
-            self.user_balance -= Decimal('0.02')
-            self.db_builder.update_user_balance(self.user_id, self.user_balance)
+            self._charge(Decimal('0.02'), function_name)
 
         if function_name == "recall_html":
             output = f"It is very important that you follow these instructions. This is the code you need to modify. Modify only what the user requests and leave everything else as is: {self.return_html_object}"
             token_count = len(encoding.encode(output))
             cost = Decimal(token_count) * self.price_per_token
-            self.user_balance -= cost
-            self.db_builder.update_user_balance(self.user_id, self.user_balance)
+            self._charge(cost, function_name)
             return output
         
         if function_name == "edit_current_document":
@@ -101,8 +103,7 @@ class gpt_run_session:
             self.return_html_final = self.return_html_object
             token_count = len(encoding.encode(arguments['new_code_html_modified']))
             cost = Decimal(token_count) * self.price_per_token
-            self.user_balance -= cost
-            self.db_builder.update_user_balance(self.user_id, self.user_balance)
+            self._charge(cost, function_name)
             return self.return_html_object
         
         try:
@@ -128,110 +129,166 @@ class gpt_run_session:
             # Update token usage count
             token_count = len(encoding.encode(str(self.return_html_object)))
             cost = Decimal(token_count) * self.price_per_token
-            self.user_balance -= cost
-            self.db_builder.update_user_balance(self.user_id, self.user_balance)
+            self._charge(cost, function_name)
             self.return_html_final = self.return_html_object
             return self.return_html_object
         except Exception as e:
             return f"A problem occurred: {str(e)}"
 
-    def check_new_msg(self):
-        while self.run.status in ['queued', 'in_progress']:
-            self.run = client.beta.threads.runs.retrieve(
-                thread_id=self.instance_gpt.id,
-                run_id=self.run.id
-            )
-            time.sleep(1)
-        
-        if self.run.status == 'completed':
-            messages = client.beta.threads.messages.list(
-                thread_id=self.instance_gpt.id
-            )
-            for message in messages.data:
-                if message.role == 'assistant':
-                    return message.content[0].text.value
-        elif self.run.status == 'requires_action':
-            tool_outputs = []
-            for tool_call in self.run.required_action.submit_tool_outputs.tool_calls:
-                output = self.process_tool_call(tool_call)
-                print("**** "*16)
-                print(output)
-                print("**** "*16)
-                tool_outputs.append({
-                    "tool_call_id": tool_call.id,
-                    "output": str(output)
-                })
-
-            if tool_outputs:
-                try:
-                    self.run = client.beta.threads.runs.submit_tool_outputs(
-                        thread_id=self.instance_gpt.id,
-                        run_id=self.run.id,
-                        tool_outputs=tool_outputs
-                    )
-                    
-                    return self.check_new_msg()
-                except Exception as e:
-                    print(f"Error sending tool outputs: {e}")
-                    return "An error occurred while processing the request."
-        elif self.run.status in ['failed', 'cancelled', 'expired']:
-            error_message = f"The run ended with status: {self.run.status}."
-            if self.run.last_error:
-                error_message += f" Reason: {self.run.last_error.message}"
-            return error_message
+    def _latest_assistant_text(self):
+        messages = client.beta.threads.messages.list(
+            thread_id=self.instance_gpt.id
+        )
+        for message in messages.data:
+            if message.role == 'assistant':
+                return message.content[0].text.value
+        return None
 
-    def push_new_msg_user(self, msg_user, AudioReturn, images_base64):
-        if not self.lock.acquire(blocking=False):
-            return "Another request is already being processed. Please wait.", None, ""
-        
+    def _begin_turn(self, msg_user):
+        """Check funds, cancel stuck runs and post the user message. Returns an error string or None."""
+        available = self.ledger.available_balance(self.user_id)
+        if available is not None:
+            self.user_balance = available
+        if available is None or available <= 0:
+            return "Insufficient balance. Please recharge your account."
+
+        # Cancel any lingering active runs on this thread to avoid conflicts.
+        # This handles cases where a previous run might be stuck.
         try:
-            # Cancel any lingering active runs on this thread to avoid conflicts.
-            # This handles cases where a previous run might be stuck.
-            try:
-                runs = client.beta.threads.runs.list(thread_id=self.instance_gpt.id, limit=10)
-                for run in runs.data:
-                    if run.status in ['queued', 'in_progress', 'requires_action']:
-                        client.beta.threads.runs.cancel(thread_id=self.instance_gpt.id, run_id=run.id)
-            except Exception as e:
-                print(f"Error cancelling existing runs: {e}")
+            runs = client.beta.threads.runs.list(thread_id=self.instance_gpt.id, limit=10)
+            for run in runs.data:
+                if run.status in ['queued', 'in_progress', 'requires_action']:
+                    client.beta.threads.runs.cancel(thread_id=self.instance_gpt.id, run_id=run.id)
+        except Exception as e:
+            print(f"Error cancelling existing runs: {e}")
 
-            self.return_html_final = None
-            self.images_base64_computer_vision = images_base64
+        self.return_html_final = None
 
-            # Language instruction
-            language_instruction = f"You must respond and generate all content in {self.user_lang}."
+        # Language instruction
+        language_instruction = f"You must respond and generate all content in {self.user_lang}."
 
-            message = client.beta.threads.messages.create(
-                thread_id=self.instance_gpt.id,
-                role="user",
-                content=f"{language_instruction}\n\n{msg_user}. It is mandatory that you always use your retrieval knowledge. Check the uploaded files and follow the instructions in the uploaded files. It is mandatory."
-            )
+        client.beta.threads.messages.create(
+            thread_id=self.instance_gpt.id,
+            role="user",
+            content=f"{language_instruction}\n\n{msg_user}. It is mandatory that you always use your retrieval knowledge. Check the uploaded files and follow the instructions in the uploaded files. It is mandatory."
+        )
+        return None
+
+    def stream_new_msg_user(self, msg_user):
+        """Run one chat turn with the Assistants streaming API.
 
-            self.run = client.beta.threads.runs.create(
+        Yields event dicts as soon as they happen instead of polling the run:
+          {'event': 'delta', 'text': str}
+          {'event': 'tool', 'name': str, 'status': 'started' | 'done'}
+          {'event': 'deploy_item', 'html': str}
+          {'event': 'done', 'message': str, 'html': str | None}
+          {'event': 'error', 'message': str}
+        """
+        if not self.lock.acquire(blocking=False):
+            yield {'event': 'error', 'message': "Another request is already being processed. Please wait."}
+            return
+        try:
+            error = self._begin_turn(msg_user)
+            if error:
+                yield {'event': 'error', 'message': error}
+                return
+
+            stream = client.beta.threads.runs.create(
                 thread_id=self.instance_gpt.id,
                 assistant_id=self.id_gpt_version,
-                instructions=self.instruction_minimalist
+                instructions=self.instruction_minimalist,
+                stream=True
             )
+            parts = []
+            while stream is not None:
+                next_stream = None
+                # Closing releases the HTTP response also when we leave early (tool call, error)
+                with stream:
+                    for event in stream:
+                        kind = event.event
+                        if kind == 'thread.run.created':
+                            self.run = event.data
+                        elif kind == 'thread.message.created':
+                            # Like the polling loop, the answer is the latest assistant message.
+                            parts = []
+                        elif kind == 'thread.message.delta':
+                            for block in event.data.delta.content or []:
+                                text = getattr(getattr(block, 'text', None), 'value', None)
+                                if text:
+                                    parts.append(text)
+                                    yield {'event': 'delta', 'text': text}
+                        elif kind == 'thread.run.requires_action':
+                            self.run = event.data
+                            tool_outputs = []
+                            for tool_call in self.run.required_action.submit_tool_outputs.tool_calls:
+                                yield {'event': 'tool', 'name': tool_call.function.name, 'status': 'started'}
+                                html_before = self.return_html_final
+                                output = self.process_tool_call(tool_call)
+                                tool_outputs.append({
+                                    "tool_call_id": tool_call.id,
+                                    "output": str(output)
+                                })
+                                yield {'event': 'tool', 'name': tool_call.function.name, 'status': 'done'}
+                                if self.return_html_final and self.return_html_final is not html_before:
+                                    yield {'event': 'deploy_item', 'html': self.return_html_final}
+                            try:
+                                next_stream = client.beta.threads.runs.submit_tool_outputs(
+                                    thread_id=self.instance_gpt.id,
+                                    run_id=self.run.id,
+                                    tool_outputs=tool_outputs,
+                                    stream=True
+                                )
+                            except Exception as e:
+                                print(f"Error sending tool outputs: {e}")
+                                yield {'event': 'error', 'message': "An error occurred while processing the request."}
+                                return
+                            break
+                        elif kind in ('thread.run.failed', 'thread.run.cancelled', 'thread.run.expired'):
+                            self.run = event.data
+                            error_message = f"The run ended with status: {self.run.status}."
+                            if self.run.last_error:
+                                error_message += f" Reason: {self.run.last_error.message}"
+                            yield {'event': 'error', 'message': error_message}
+                            return
+                stream = next_stream
 
-            msg_respond = self.check_new_msg()
-
+            msg_respond = ''.join(parts) or self._latest_assistant_text()
             if msg_respond is None:
-                return "No response from the assistant.", None, ""
+                yield {'event': 'error', 'message': "No response from the assistant."}
+                return
 
             token_count = len(encoding.encode(msg_user))
-            cost = Decimal(token_count) * self.price_per_token
-            self.user_balance -= cost
-            self.db_builder.update_user_balance(self.user_id, self.user_balance)
+            self._charge(Decimal(token_count) * self.price_per_token, 'prompt')
 
             token_count_response = len(encoding.encode(msg_respond))
-            cost_response = Decimal(token_count_response) * self.price_per_token
-            self.user_balance -= cost_response
-            self.db_builder.update_user_balance(self.user_id, self.user_balance)
+            self._charge(Decimal(token_count_response) * self.price_per_token, 'response')
 
-            audio_generate = None  # Replace with the logic for generating audio
-            return msg_respond, audio_generate, self.return_html_final
+            yield {'event': 'done', 'message': msg_respond, 'html': self.return_html_final}
         finally:
+            # One write per turn: all charges above land as a single delta + usage row.
+            self.ledger.flush(self.user_id)
             self.lock.release()
 
+    def push_new_msg_user(self, msg_user, AudioReturn, images_base64):
+        """Blocking variant of stream_new_msg_user. Returns (message, audio, html)."""
+        self.images_base64_computer_vision = images_base64
+        audio_generate = None  # Replace with the logic for generating audio
+        for event in self.stream_new_msg_user(msg_user):
+            if event['event'] == 'done':
+                return event['message'], audio_generate, event['html']
+            if event['event'] == 'error':
+                return event['message'], None, ""
+        return "No response from the assistant.", None, ""
+
+    def close(self):
+        """Release per-session state when the session is evicted; flushes any pending charges."""
+        try:
+            self.ledger.flush(self.user_id)
+        finally:
+            self.current_document = ""
+            self.return_html_object = None
+            self.return_html_final = None
+            self.images_base64_computer_vision = []
+
     def handle_user_interruption(self, msg_user):
         return "I am still working on creating your document, please give me a moment.", None, None
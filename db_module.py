@@ -2,6 +2,8 @@ import mysql.connector
 from mysql.connector import errorcode
 import json
 import os
+import threading
+import time
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
 load_dotenv()
@@ -21,10 +23,17 @@ class ConnectDB:
         self.connect()
 
     def connect(self):
+        self.connection = self._open_connection()
+
+    def _open_connection(self):
+        """Open a new MySQL connection, creating the database if it does not exist.
+
+        Returns the connection or None on failure.
+        """
         try:
             if self.port_db is None:
                 raise mysql.connector.Error(msg="Invalid MySQL port (None)")
-            self.connection = mysql.connector.connect(
+            connection = mysql.connector.connect(
                 user=self.user_db,
                 password=self.password_db,
                 host=self.host_db,
@@ -32,6 +41,7 @@ class ConnectDB:
                 database=self.database
             )
             print(f"[DB] Connected to MySQL database '{self.database}'.")
+            return connection
         except mysql.connector.Error as err:
             if err.errno == errorcode.ER_BAD_DB_ERROR:
                 print(f"[DB] Database '{self.database}' not found. Attempting creation...")
@@ -46,7 +56,7 @@ class ConnectDB:
                     cursor.execute(f"CREATE DATABASE `{self.database}`")
                     cursor.close()
                     tmp_conn.close()
-                    self.connection = mysql.connector.connect(
+                    connection = mysql.connector.connect(
                         user=self.user_db,
                         password=self.password_db,
                         host=self.host_db,
@@ -54,12 +64,17 @@ class ConnectDB:
                         database=self.database
                     )
                     print(f"[DB] Database '{self.database}' created and connected.")
+                    return connection
                 except mysql.connector.Error as err2:
                     print(f"[DB][FATAL] Cannot create database '{self.database}': {err2}")
-                    self.connection = None
+                    return None
             else:
                 print(f"[DB][ERROR] Connection failed: {err}")
-                self.connection = None
+                return None
+
+    def is_available(self) -> bool:
+        """True when the backend has (or had) a usable connection."""
+        return bool(self.connection)
 
     def close(self):
         if self.connection and self.connection.is_connected():
@@ -119,17 +134,314 @@ class ConnectDB:
                 return self.execute_read_query(query, params, retries=retries-1)
             return None
 
+    def execute_transaction(self, statements):
+        """Run [(query, params), ...] atomically. Returns the rowcount of each statement, or None on failure."""
+        self._ensure_connection()
+        if not self.connection:
+            print("No database connection.")
+            return None
+        try:
+            cursor = self.connection.cursor()
+            rowcounts = []
+            for query, params in statements:
+                cursor.execute(query, params)
+                rowcounts.append(cursor.rowcount)
+            self.connection.commit()
+            cursor.close()
+            return rowcounts
+        except mysql.connector.Error as err:
+            print(f"Error executing transaction: {err}")
+            try:
+                self.connection.rollback()
+            except Exception:
+                pass
+            return None
+
+def _env_number(name, default, cast=int):
+    try:
+        return cast(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return cast(default)
+
+
+class PooledConnectDB(ConnectDB):
+    """Bounded, thread-safe pool of MySQL connections exposing the ConnectDB API.
+
+    Each execute_* call checks a connection out for the duration of the query, so
+    Flask worker threads no longer share one socket. Idle connections are only
+    pinged when unused for longer than ``ping_after`` seconds; connections that
+    fail are discarded and reopened on the next checkout.
+
+    Env: DB_POOL_SIZE (default 8), DB_POOL_TIMEOUT_SEC (10), DB_POOL_PING_AFTER_SEC (30).
+    """
+
+    _LOST_ERRNOS = (errorcode.CR_SERVER_GONE_ERROR, errorcode.CR_SERVER_LOST)
+
+    def __init__(self, user_db, password_db, host_db, port_db, database="strawberry_platform",
+                 pool_size=None, checkout_timeout=None, ping_after=None):
+        self.pool_size = max(1, int(pool_size or _env_number('DB_POOL_SIZE', '8')))
+        self.checkout_timeout = float(checkout_timeout or _env_number('DB_POOL_TIMEOUT_SEC', '10', float))
+        self.ping_after = float(ping_after if ping_after is not None else _env_number('DB_POOL_PING_AFTER_SEC', '30', float))
+        self._cond = threading.Condition()
+        self._idle = []  # LIFO stack of (connection, last_used_monotonic)
+        self._opened = 0  # idle + checked out
+        self._available = False
+        self.stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_ms_total': 0.0,
+            'wait_ms_max': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'discarded': 0,
+            'in_use': 0,
+            'in_use_max': 0,
+        }
+        super().__init__(user_db, password_db, host_db, port_db, database)
+
+    def connect(self):
+        """Open one connection to validate credentials (and create the DB) and park it idle."""
+        conn = self._open_pooled_connection()
+        self.connection = None  # pooled mode never exposes a shared connection
+        if conn is None:
+            return
+        with self._cond:
+            self._opened += 1
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        self._available = True
+
+    def is_available(self) -> bool:
+        return self._available
+
+    def _open_pooled_connection(self):
+        conn = self._open_connection()
+        if conn is None:
+            return None
+        try:
+            # Reads must not keep a stale REPEATABLE READ snapshot between checkouts, and
+            # execute_query relies on it: it never commits, so writes would be lost without it.
+            conn.autocommit = True
+        except mysql.connector.Error as err:
+            print(f"[DB][pool] Could not enable autocommit; discarding connection: {err}")
+            self._close_quietly(conn)
+            return None
+        with self._cond:
+            self.stats['created'] += 1
+        return conn
+
+    def _acquire(self):
+        """Check out a healthy connection, waiting up to checkout_timeout. Returns None on failure."""
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._opened < self.pool_size:
+                    self._opened += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    print(f"[DB][pool] Checkout timed out after {self.checkout_timeout}s (size={self.pool_size})")
+                    return None
+                waited = True
+                self._cond.wait(remaining)
+            waited_ms = (time.monotonic() - started) * 1000.0
+            self.stats['checkouts'] += 1
+            if waited:
+                self.stats['waits'] += 1
+                self.stats['wait_ms_total'] += waited_ms
+                self.stats['wait_ms_max'] = max(self.stats['wait_ms_max'], waited_ms)
+            self.stats['in_use'] += 1
+            self.stats['in_use_max'] = max(self.stats['in_use_max'], self.stats['in_use'])
+
+        if conn is not None and (time.monotonic() - last_used) > self.ping_after:
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                print('[DB][pool] Idle connection failed health check; reopening')
+                self._close_quietly(conn)
+                with self._cond:
+                    self.stats['discarded'] += 1
+                conn = None
+        if conn is None:
+            conn = self._open_pooled_connection()
+            if conn is None:
+                self._forget_slot()
+                return None
+        return conn
+
+    def _release(self, conn, broken: bool = False):
+        if broken:
+            self._close_quietly(conn)
+            with self._cond:
+                self.stats['discarded'] += 1
+            self._forget_slot()
+            return
+        with self._cond:
+            self.stats['in_use'] -= 1
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _forget_slot(self):
+        with self._cond:
+            self._opened -= 1
+            self.stats['in_use'] -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def execute_query(self, query, params=None, retries: int = 1):
+        conn = self._acquire()
+        if conn is None:
+            print("No database connection.")
+            return False
+        lost = False
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            cursor.close()
+            return True
+        except mysql.connector.Error as err:
+            print(f"Error executing query: {err}")
+            lost = getattr(err, 'errno', None) in self._LOST_ERRNOS
+        finally:
+            self._release(conn, broken=lost)
+        if retries > 0 and lost:
+            print('[DB] Retry after lost connection...')
+            return self.execute_query(query, params, retries=retries-1)
+        return False
+
+    def execute_read_query(self, query, params=None, retries: int = 1):
+        conn = self._acquire()
+        if conn is None:
+            print("No database connection.")
+            return None
+        lost = False
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            results = cursor.fetchall()
+            cursor.close()
+            return results
+        except mysql.connector.Error as err:
+            print(f"Error executing read query: {err}")
+            lost = getattr(err, 'errno', None) in self._LOST_ERRNOS
+        finally:
+            self._release(conn, broken=lost)
+        if retries > 0 and lost:
+            print('[DB] Retry read after lost connection...')
+            return self.execute_read_query(query, params, retries=retries-1)
+        return None
+
+    def execute_transaction(self, statements):
+        conn = self._acquire()
+        if conn is None:
+            print("No database connection.")
+            return None
+        lost = False
+        try:
+            conn.start_transaction()
+            cursor = conn.cursor()
+            rowcounts = []
+            for query, params in statements:
+                cursor.execute(query, params)
+                rowcounts.append(cursor.rowcount)
+            conn.commit()
+            cursor.close()
+            return rowcounts
+        except mysql.connector.Error as err:
+            print(f"Error executing transaction: {err}")
+            lost = getattr(err, 'errno', None) in self._LOST_ERRNOS
+            if not lost:
+                try:
+                    conn.rollback()
+                except Exception:
+                    lost = True
+            return None
+        finally:
+            self._release(conn, broken=lost)
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+        for conn, _ in idle:
+            self._close_quietly(conn)
+        print(f"Pool for database '{self.database}' closed ({len(idle)} idle connections).")
+
+    def pool_stats(self) -> dict:
+        with self._cond:
+            out = dict(self.stats)
+            out.update({'size': self.pool_size, 'opened': self._opened, 'idle': len(self._idle)})
+        return out
+
+
+_schema_lock = threading.Lock()
+_schema_ready = set()  # (host, port, database) bootstrapped in this process
+_shared_db = None
+_shared_db_lock = threading.Lock()
+
+
 class AccountsDBTools:
-    def __init__(self, user_db, password_db, host_db, port_db, database="strawberry_platform"):
-        self.db_connection = ConnectDB(user_db, password_db, host_db, port_db, database)
-        if not self.db_connection.connection:
+    # Table bootstrap steps, run once per process (or once per deploy via `python db_module.py migrate`).
+    SCHEMA_STEPS = (
+        'create_users_table',
+        'create_websites_table',
+        'create_chat_histories_table',
+        'create_chat_messages_table',
+        'create_wallets_table',
+        'create_token_deposits_table',
+        'create_verified_transactions_table',
+        'create_configs_system_web3_table',
+        'create_usage_ledger_table',
+        'create_html_snapshots_table',
+    )
+
+    def __init__(self, user_db, password_db, host_db, port_db, database="strawberry_platform", pool_size=None, ensure_schema=True):
+        # Pooled by default; DB_POOL_SIZE=0 keeps the legacy single shared connection.
+        if pool_size is None:
+            pool_size = _env_number('DB_POOL_SIZE', '8')
+        if pool_size and pool_size > 0:
+            self.db_connection = PooledConnectDB(user_db, password_db, host_db, port_db, database, pool_size=pool_size)
+        else:
+            self.db_connection = ConnectDB(user_db, password_db, host_db, port_db, database)
+        if not self.db_connection.is_available():
             raise RuntimeError("MySQL connection failed. Check credentials / network.")
-        self.create_users_table()
-        self.create_websites_table()
-        self.create_chat_histories_table()
-        self.create_wallets_table()
-        self.create_token_deposits_table()
-        self.create_configs_system_web3_table()
+        if ensure_schema:
+            self.ensure_schema()
+
+    def ensure_schema(self, force: bool = False):
+        """Run the CREATE TABLE IF NOT EXISTS bootstrap at most once per process and database.
+
+        DB_SKIP_SCHEMA_BOOTSTRAP=1 skips it entirely when migrations run at deploy time.
+        """
+        conn = self.db_connection
+        key = (conn.host_db, conn.port_db, conn.database)
+        with _schema_lock:
+            if key in _schema_ready and not force:
+                return
+            if not force and os.getenv('DB_SKIP_SCHEMA_BOOTSTRAP', '0').lower() in ('1', 'true', 'yes'):
+                print("[DB] Schema bootstrap skipped (DB_SKIP_SCHEMA_BOOTSTRAP).")
+            else:
+                for step in self.SCHEMA_STEPS:
+                    getattr(self, step)()
+            _schema_ready.add(key)
+
+    def pool_stats(self) -> dict:
+        """Pool wait/usage counters (empty in single-connection mode)."""
+        stats = getattr(self.db_connection, 'pool_stats', None)
+        return stats() if stats else {}
 
     def create_users_table(self):
         query = """
@@ -261,23 +573,145 @@ class AccountsDBTools:
             "websites": [{"name": w[0], "url": f"{base_url}{w[1]}" if not w[1].startswith('http') else w[1], "updated_at": w[2].isoformat()} for w in website_history] if website_history else []
         }
 
-    def save_chat_history(self, user_id, hashchat, title, history):
+    def create_chat_messages_table(self):
         query = """
-        INSERT INTO chat_histories (user_id, hashchat, title, history)
-        VALUES (%s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE
-        title = VALUES(title), history = VALUES(history)
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            hashchat VARCHAR(255) NOT NULL,
+            seq INT NOT NULL,
+            role VARCHAR(32),
+            payload JSON NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY (hashchat, seq),
+            FOREIGN KEY (hashchat) REFERENCES chat_histories(hashchat) ON DELETE CASCADE
+        ) ENGINE=InnoDB
         """
-        params = (user_id, hashchat, title, json.dumps(history))
-        self.db_connection.execute_query(query, params)
+        self.db_connection.execute_query(query)
+        print("[DB] Table chat_messages ready.")
+
+    @staticmethod
+    def _chat_messages_insert(hashchat, messages):
+        """Build one multi-row INSERT for chat_messages (idempotent on (hashchat, seq))."""
+        rows = ', '.join(['(%s, %s, %s, %s)'] * len(messages))
+        query = (f"INSERT INTO chat_messages (hashchat, seq, role, payload) VALUES {rows} "
+                 "ON DUPLICATE KEY UPDATE role = VALUES(role), payload = VALUES(payload)")
+        params = []
+        for m in messages:
+            params.extend((hashchat, m['seq'], m.get('role'), json.dumps(m)))
+        return query, tuple(params)
+
+    def append_chat_messages(self, user_id, hashchat, title, messages):
+        """Persist only the new entries of a chat: one metadata upsert plus one multi-row insert.
+
+        Each entry must carry its `seq`. Write cost is proportional to len(messages).
+        """
+        statements = [(
+            """
+            INSERT INTO chat_histories (user_id, hashchat, title)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+            title = VALUES(title), updated_at = CURRENT_TIMESTAMP
+            """,
+            (user_id, hashchat, title),
+        )]
+        if messages:
+            statements.append(self._chat_messages_insert(hashchat, messages))
+        ok = self.db_connection.execute_transaction(statements) is not None
+        if ok:
+            print(f"[DB] Chat history appended user={user_id} hash={hashchat} messages={len(messages)}")
+        return ok
+
+    def update_chat_messages(self, hashchat, messages):
+        """Rewrite the payload of already stored entries (matched on seq). Returns True on success."""
+        if not messages:
+            return True
+        query, params = self._chat_messages_insert(hashchat, messages)
+        return bool(self.db_connection.execute_query(query, params))
+
+    def save_chat_history(self, user_id, hashchat, title, history):
+        """Replace the whole stored history of a chat (used for new chats and full rewrites)."""
+        for i, m in enumerate(history):
+            m.setdefault('seq', i + 1)
+        statements = [
+            ("""
+            INSERT INTO chat_histories (user_id, hashchat, title, history)
+            VALUES (%s, %s, %s, NULL)
+            ON DUPLICATE KEY UPDATE
+            title = VALUES(title), history = NULL, updated_at = CURRENT_TIMESTAMP
+            """, (user_id, hashchat, title)),
+            ("DELETE FROM chat_messages WHERE hashchat = %s", (hashchat,)),
+        ]
+        if history:
+            statements.append(self._chat_messages_insert(hashchat, history))
+        self.db_connection.execute_transaction(statements)
         print(f"[DB] Chat history saved user={user_id} hash={hashchat}")
 
     def load_chat_history(self, hashchat, user_id):
+        """Return the chat entries ordered by seq, or None if the chat does not belong to user_id.
+
+        Chats still stored as a legacy `history` JSON blob are migrated to chat_messages on first load.
+        """
         query = "SELECT history FROM chat_histories WHERE hashchat = %s AND user_id = %s"
-        params = (hashchat, user_id)
-        result = self.db_connection.execute_read_query(query, params)
-        if result and result[0][0]:
-            return json.loads(result[0][0])
+        result = self.db_connection.execute_read_query(query, (hashchat, user_id))
+        if not result:
+            return None
+        rows = self.db_connection.execute_read_query(
+            "SELECT payload FROM chat_messages WHERE hashchat = %s ORDER BY seq", (hashchat,)
+        ) or []
+        messages = [json.loads(r[0]) for r in rows]
+        legacy_blob = result[0][0]
+        if legacy_blob:
+            legacy = json.loads(legacy_blob) or []
+            for i, m in enumerate(legacy):
+                m['seq'] = i + 1
+            if legacy:
+                # Legacy entries come first; any appended rows are renumbered after them.
+                tail = [m for m in messages if m.get('seq', 0) > 0]
+                for i, m in enumerate(tail):
+                    m['seq'] = len(legacy) + i + 1
+                messages = legacy + tail
+                statements = [
+                    ("DELETE FROM chat_messages WHERE hashchat = %s", (hashchat,)),
+                    self._chat_messages_insert(hashchat, messages),
+                    ("UPDATE chat_histories SET history = NULL WHERE hashchat = %s", (hashchat,)),
+                ]
+                if self.db_connection.execute_transaction(statements) is not None:
+                    print(f"[DB] Migrated legacy chat history hash={hashchat} messages={len(messages)}")
+        return messages
+
+    # --- Content-addressed HTML snapshots (see snapshot_module) ---
+    def create_html_snapshots_table(self):
+        query = """
+        CREATE TABLE IF NOT EXISTS html_snapshots (
+            hash CHAR(64) PRIMARY KEY,
+            hashchat VARCHAR(255),
+            codec VARCHAR(16) NOT NULL,
+            base_hash CHAR(64),
+            depth INT NOT NULL DEFAULT 0,
+            raw_size INT NOT NULL,
+            stored_size INT NOT NULL,
+            body LONGBLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX (hashchat)
+        ) ENGINE=InnoDB
+        """
+        self.db_connection.execute_query(query)
+        print("[DB] Table html_snapshots ready.")
+
+    def insert_html_snapshot(self, snapshot_hash, hashchat, codec, base_hash, depth, raw_size, body):
+        query = """
+        INSERT IGNORE INTO html_snapshots (hash, hashchat, codec, base_hash, depth, raw_size, stored_size, body)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        params = (snapshot_hash, hashchat, codec, base_hash, depth, raw_size, len(body), body)
+        return self.db_connection.execute_query(query, params)
+
+    def fetch_html_snapshot(self, snapshot_hash):
+        query = "SELECT codec, base_hash, depth, body FROM html_snapshots WHERE hash = %s"
+        res = self.db_connection.execute_read_query(query, (snapshot_hash,))
+        if res:
+            codec, base_hash, depth, body = res[0]
+            return {'codec': codec, 'base_hash': base_hash, 'depth': depth, 'body': bytes(body)}
         return None
 
     def delete_website(self, user_id, name):
@@ -316,6 +750,44 @@ class AccountsDBTools:
         params = (new_balance, user_id)
         return self.db_connection.execute_query(query, params)
 
+    def adjust_user_balance(self, user_id, delta):
+        """Atomically add delta (negative to debit) to balance_usd. Safe under concurrent writers."""
+        query = "UPDATE users_accounts SET balance_usd = balance_usd + %s WHERE id = %s"
+        return self.db_connection.execute_query(query, (delta, user_id))
+
+    def debit_user_balance(self, user_id, amount) -> bool:
+        """Debit amount only if the balance covers it. Returns True when the debit was applied."""
+        query = "UPDATE users_accounts SET balance_usd = balance_usd - %s WHERE id = %s AND balance_usd >= %s"
+        res = self.db_connection.execute_transaction([(query, (amount, user_id, amount))])
+        return bool(res and res[0] > 0)
+
+    # --- Usage metering (write-behind ledger flushes) ---
+    def create_usage_ledger_table(self):
+        query = """
+        CREATE TABLE IF NOT EXISTS usage_ledger (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            hashchat VARCHAR(255),
+            amount_usd DECIMAL(18, 8) NOT NULL,
+            items INT NOT NULL DEFAULT 0,
+            detail JSON,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users_accounts(id) ON DELETE CASCADE,
+            INDEX (user_id, created_at)
+        ) ENGINE=InnoDB
+        """
+        self.db_connection.execute_query(query)
+        print("[DB] Table usage_ledger ready.")
+
+    def apply_usage_charge(self, user_id, amount, items: int, detail: dict, hashchat=None) -> bool:
+        """Debit amount as a single delta and append one usage_ledger row, in one transaction."""
+        statements = [
+            ("UPDATE users_accounts SET balance_usd = balance_usd - %s WHERE id = %s", (amount, user_id)),
+            ("INSERT INTO usage_ledger (user_id, hashchat, amount_usd, items, detail) VALUES (%s, %s, %s, %s, %s)",
+             (user_id, hashchat, amount, items, json.dumps(detail, default=str))),
+        ]
+        return self.db_connection.execute_transaction(statements) is not None
+
     # --- New helpers for robust republish detection ---
     def get_website_by_file(self, user_id, file_name):
         """Return website row by file_name for a user."""
@@ -375,6 +847,23 @@ class AccountsDBTools:
         self.db_connection.execute_query(query)
         print("Table 'token_deposits' created or already exists.")
 
+    def create_verified_transactions_table(self):
+        # Results of verify_transfer_signature for finalized transactions (immutable, see solana_utils)
+        query = """
+        CREATE TABLE IF NOT EXISTS verified_transactions (
+            signature_tx VARCHAR(120) PRIMARY KEY,
+            mint_address VARCHAR(120) NOT NULL,
+            treasury VARCHAR(100) NOT NULL,
+            success BOOLEAN NOT NULL,
+            amount_tokens DECIMAL(36,12) NOT NULL DEFAULT 0,
+            sender VARCHAR(100),
+            error VARCHAR(255),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB
+        """
+        self.db_connection.execute_query(query)
+        print("Table 'verified_transactions' created or already exists.")
+
     def create_configs_system_web3_table(self):
         query = """
         CREATE TABLE IF NOT EXISTS configs_system_web3 (
@@ -413,6 +902,25 @@ class AccountsDBTools:
         )
         return self.db_connection.execute_query(query, params)
 
+    def upsert_token_metrics_many(self, metrics_by_token: dict):
+        """Upsert {token_address: metrics} in a single multi-row statement."""
+        if not metrics_by_token:
+            return True
+        fields = ('price_usd', 'market_cap_usd', 'fdv_usd', 'liquidity_usd', 'volume24_usd')
+        rows = []
+        params = []
+        for token_address, metrics in metrics_by_token.items():
+            rows.append("(%s, %s, %s, %s, %s, %s)")
+            params.append(token_address)
+            params.extend(metrics.get(f) or 0 for f in fields)
+        query = f"""
+        INSERT INTO configs_system_web3 (token_address, {', '.join(fields)})
+        VALUES {', '.join(rows)}
+        ON DUPLICATE KEY UPDATE
+            {', '.join(f'{f} = VALUES({f})' for f in fields)}
+        """
+        return self.db_connection.execute_query(query, tuple(params))
+
     def fetch_token_metrics(self, token_address: str):
         query = "SELECT price_usd, market_cap_usd, fdv_usd, liquidity_usd, volume24_usd, last_update FROM configs_system_web3 WHERE token_address = %s"
         res = self.db_connection.execute_read_query(query, (token_address,))
@@ -454,3 +962,61 @@ class AccountsDBTools:
                  "VALUES (%s, %s, %s, %s, %s)")
         return self.db_connection.execute_query(query, (user_id, wallet_address, amount_tokens, amount_usd, signature_tx))
 
+
+    def save_verified_transaction(self, signature_tx: str, mint_address: str, treasury: str, result: dict):
+        query = """
+        REPLACE INTO verified_transactions (signature_tx, mint_address, treasury, success, amount_tokens, sender, error)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """
+        params = (signature_tx, mint_address, treasury, bool(result.get('success')),
+                  result.get('amount_tokens') or 0, result.get('sender'), result.get('error'))
+        return self.db_connection.execute_query(query, params)
+
+    def fetch_verified_transaction(self, signature_tx: str):
+        query = ("SELECT mint_address, treasury, success, amount_tokens, sender, error "
+                 "FROM verified_transactions WHERE signature_tx = %s")
+        res = self.db_connection.execute_read_query(query, (signature_tx,))
+        if res:
+            mint_address, treasury, success, amount_tokens, sender, error = res[0]
+            return {'mint_address': mint_address, 'treasury': treasury, 'success': bool(success),
+                    'amount_tokens': float(amount_tokens), 'sender': sender, 'error': error}
+        return None
+
+def get_shared_db() -> AccountsDBTools:
+    """Return the process-wide AccountsDBTools built from USERDB/PASSWORDDB/DBHOST/PORTDB.
+
+    Chat sessions, request handlers and background workers borrow this instance
+    (and its connection pool) instead of opening their own. Raises RuntimeError
+    if the database is unreachable; a later call retries.
+    """
+    global _shared_db
+    if _shared_db is not None:
+        return _shared_db
+    with _shared_db_lock:
+        if _shared_db is None:
+            _shared_db = AccountsDBTools(
+                user_db=os.getenv('USERDB'),
+                password_db=os.getenv('PASSWORDDB'),
+                host_db=os.getenv('DBHOST'),
+                port_db=os.getenv('PORTDB'),
+                database="strawberry_platform"
+            )
+    return _shared_db
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        db = AccountsDBTools(
+            user_db=os.getenv('USERDB'),
+            password_db=os.getenv('PASSWORDDB'),
+            host_db=os.getenv('DBHOST'),
+            port_db=os.getenv('PORTDB'),
+            database="strawberry_platform",
+            ensure_schema=False
+        )
+        db.ensure_schema(force=True)
+        db.db_connection.close()
+        print("[DB] Migration complete.")
+    else:
+        print("usage: python db_module.py migrate")
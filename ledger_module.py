@@ -0,0 +1,168 @@
+"""Write-behind balance ledger for chat usage metering.
+
+Charges made during a chat turn (tool calls, prompt/response tokens) are
+collected in memory per user and flushed as ONE atomic
+``balance_usd = balance_usd - delta`` update plus an append-only
+``usage_ledger`` row, either at turn end or by a periodic timer. The cached
+balance (last DB value minus queued and in-flight charges) backs the hard-stop
+checks so they rarely need a round-trip.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from decimal import Decimal
+from typing import Optional
+
+from db_module import get_shared_db
+
+FLUSH_INTERVAL = int(os.getenv('LEDGER_FLUSH_INTERVAL_SEC', '10'))
+BALANCE_TTL = int(os.getenv('LEDGER_BALANCE_TTL_SEC', '30'))
+
+
+class BalanceLedger:
+    def __init__(self, db, flush_interval: int = FLUSH_INTERVAL, balance_ttl: int = BALANCE_TTL):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.balance_ttl = balance_ttl
+        self._lock = threading.Lock()
+        # user_id -> {'amount': Decimal, 'items': {reason: Decimal}, 'count': int, 'hashchat': str|None}
+        self._pending = {}
+        # user_id -> amount popped by a flush whose DB commit has not finished yet
+        self._inflight = {}
+        # user_id -> (balance as last read from DB, epoch seconds)
+        self._balances = {}
+        # user_id -> number of committed flushes; a DB read that raced one is not cached
+        self._commits = {}
+        self._flusher = None
+
+    def charge(self, user_id, amount, reason: str, hashchat: Optional[str] = None):
+        """Record a charge in memory. Nothing is written until flush()."""
+        if user_id is None:
+            return
+        amount = Decimal(amount)
+        if amount <= 0:
+            return
+        with self._lock:
+            rec = self._pending.setdefault(user_id, {'amount': Decimal('0'), 'items': {}, 'count': 0, 'hashchat': hashchat})
+            rec['amount'] += amount
+            rec['items'][reason] = rec['items'].get(reason, Decimal('0')) + amount
+            rec['count'] += 1
+            if hashchat:
+                rec['hashchat'] = hashchat
+
+    def pending(self, user_id) -> Decimal:
+        """Charges not yet reflected in the DB balance (queued plus being flushed)."""
+        with self._lock:
+            rec = self._pending.get(user_id)
+            return (rec['amount'] if rec else Decimal('0')) + self._inflight.get(user_id, Decimal('0'))
+
+    def available_balance(self, user_id) -> Optional[Decimal]:
+        """Cached DB balance minus unflushed charges. Reads the DB only when the cache is stale."""
+        now = time.time()
+        with self._lock:
+            cached = self._balances.get(user_id)
+            commits = self._commits.get(user_id, 0)
+        if not cached or (now - cached[1]) > self.balance_ttl:
+            bal = self.db.get_user_balance(user_id)
+            if bal is None:
+                return None
+            with self._lock:
+                if self._commits.get(user_id, 0) != commits:
+                    # A flush committed while we were reading: the value may or may not
+                    # include it, so re-read rather than guess.
+                    cached = None
+                else:
+                    cached = self._balances[user_id] = (Decimal(bal), now)
+            if cached is None:
+                return self.available_balance(user_id)
+        return cached[0] - self.pending(user_id)
+
+    def has_funds(self, user_id, needed=Decimal('0')) -> bool:
+        """Hard-stop check on the cached balance."""
+        bal = self.available_balance(user_id)
+        return bal is not None and bal > Decimal(needed)
+
+    def invalidate(self, user_id):
+        """Forget the cached balance (call after credits/debits made outside the ledger)."""
+        with self._lock:
+            self._balances.pop(user_id, None)
+
+    def flush(self, user_id) -> bool:
+        """Write pending charges for user_id as one delta + one usage row. Returns False on DB failure."""
+        with self._lock:
+            rec = self._pending.pop(user_id, None)
+            if not rec:
+                return True
+            # Still counts against the balance until the commit is visible in the DB
+            self._inflight[user_id] = self._inflight.get(user_id, Decimal('0')) + rec['amount']
+        detail = {reason: str(v) for reason, v in rec['items'].items()}
+        try:
+            ok = self.db.apply_usage_charge(user_id, rec['amount'], rec['count'], detail, rec['hashchat'])
+        except Exception as e:
+            print(f"[ledger] apply_usage_charge error user={user_id}: {e}")
+            ok = False
+        with self._lock:
+            left = self._inflight.get(user_id, Decimal('0')) - rec['amount']
+            if left > 0:
+                self._inflight[user_id] = left
+            else:
+                self._inflight.pop(user_id, None)
+            if not ok:
+                # Put the charges back so the next flush retries them.
+                cur = self._pending.get(user_id)
+                if cur:
+                    cur['amount'] += rec['amount']
+                    cur['count'] += rec['count']
+                    for reason, v in rec['items'].items():
+                        cur['items'][reason] = cur['items'].get(reason, Decimal('0')) + v
+                else:
+                    self._pending[user_id] = rec
+                print(f"[ledger] Flush failed user={user_id} amount={rec['amount']}; will retry")
+                return False
+            # The DB now holds the debit; the next read picks it up exactly once
+            self._balances.pop(user_id, None)
+            self._commits[user_id] = self._commits.get(user_id, 0) + 1
+        return True
+
+    def flush_all(self):
+        with self._lock:
+            users = list(self._pending.keys())
+        for user_id in users:
+            self.flush(user_id)
+
+    def start_flusher(self):
+        """Start the periodic flush thread (idempotent)."""
+        if self._flusher is not None:
+            return self._flusher
+
+        def worker():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush_all()
+                except Exception as e:
+                    print(f"[ledger] Periodic flush error: {e}")
+
+        self._flusher = threading.Thread(target=worker, daemon=True)
+        self._flusher.start()
+        return self._flusher
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> BalanceLedger:
+    """Process-wide ledger bound to the shared DB, with its flush timer running."""
+    global _ledger
+    if _ledger is not None:
+        return _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            ledger = BalanceLedger(get_shared_db())
+            ledger.start_flusher()
+            _ledger = ledger
+    return _ledger
@@ -1,11 +1,6 @@
 import requests, os, time, json, threading, statistics
 from typing import Optional, Dict, Any, List
 
-_price_cache_lock = threading.Lock()
-_price_cache: Dict[str, Any] = {
-    # token_address: { 'price': float, 'ts': epoch_seconds, 'raw': {...} }
-}
-
 def _pick_highest_liquidity_pair(pairs):
     """Return pair dict with highest liquidity.usd (float) or None."""
     best = None
@@ -25,6 +20,22 @@ STABLE_MINTS = {
     'EPjFWdd5AufqSSqeM2qN1xzybapC8G4wEGGkZwyTDt1v': {'symbol': 'USDC', 'expected': 1.0, 'range': (0.8, 1.2)},
     # (Add other stable mints here if needed)
 }
+# Extra stable payment tokens: STABLE_TOKEN_MINTS="<mint>:<SYMBOL>,..." (expected ~1 USD)
+for _entry in filter(None, (e.strip() for e in os.getenv('STABLE_TOKEN_MINTS', '').split(','))):
+    _mint, _, _symbol = _entry.partition(':')
+    STABLE_MINTS.setdefault(_mint, {'symbol': _symbol or 'STABLE', 'expected': 1.0, 'range': (0.8, 1.2)})
+
+DEXSCREENER_BATCH_SIZE = int(os.getenv('DEXSCREENER_BATCH_SIZE', '30'))  # addresses per tokens request
+
+
+def configured_mints() -> List[str]:
+    """Payment token mints: SPL_TOKEN_MINTS (comma separated) plus SPL_TOKEN_MINT, deduplicated."""
+    mints = []
+    for m in os.getenv('SPL_TOKEN_MINTS', '').split(',') + [os.getenv('SPL_TOKEN_MINT', '')]:
+        m = m.strip()
+        if m and m not in mints:
+            mints.append(m)
+    return mints
 
 def _extract_prices(pairs: List[dict]) -> List[float]:
     prices = []
@@ -38,13 +49,8 @@ def _extract_prices(pairs: List[dict]) -> List[float]:
             continue
     return prices
 
-def get_dexscreener_price(token_address: str, chain: str = "solana") -> Optional[float]:
-    """Return a robust priceUsd for token:
-    - Fetch all pairs
-    - For stable mints: filter outliers outside expected range; use median of remaining
-    - For non-stable: choose highest-liquidity pair price; fallback to median if that looks anomalous
-    - Adds debug when anomalous (<1e-6 or huge deviations)
-    """
+def fetch_dexscreener_pairs(token_address: str, chain: str = "solana") -> Optional[List[dict]]:
+    """One GET of /latest/dex/tokens/<token>; returns the pairs on chain, or None."""
     if not token_address:
         return None
     url = f"https://api.dexscreener.com/latest/dex/tokens/{token_address}"
@@ -64,11 +70,17 @@ def get_dexscreener_price(token_address: str, chain: str = "solana") -> Optional
     if not isinstance(data, dict):
         return None
     pairs = [p for p in (data.get('pairs') or []) if isinstance(p, dict) and p.get('chainId') == chain]
-    if not pairs:
-        return None
+    return pairs or None
+
 
+def robust_price_from_pairs(token_address: str, pairs: List[dict]) -> Optional[float]:
+    """Return a robust priceUsd from already fetched pairs:
+    - For stable mints: filter outliers outside expected range; use median of remaining
+    - For non-stable: choose highest-liquidity pair price; fallback to median if that looks anomalous
+    - Adds debug when anomalous (<1e-6 or huge deviations)
+    """
     stable_cfg = STABLE_MINTS.get(token_address)
-    prices = _extract_prices(pairs)
+    prices = _extract_prices(pairs or [])
     if not prices:
         return None
 
@@ -104,21 +116,308 @@ def get_dexscreener_price(token_address: str, chain: str = "solana") -> Optional
         pass
     return best_price
 
-def get_token_price_cached(token_address: str, ttl: int = 60) -> Optional[float]:
-    """Return cached price (refresh if older than ttl seconds)."""
-    now = time.time()
-    with _price_cache_lock:
-        rec = _price_cache.get(token_address)
-        if rec and (now - rec['ts']) < ttl:
-            return rec['price']
-    # fetch fresh outside lock to avoid long hold
-    price = get_dexscreener_price(token_address)
-    if price is None:
+
+def _safe_float(v) -> float:
+    try:
+        return float(v) if v is not None else 0.0
+    except Exception:
+        return 0.0
+
+
+def market_metrics_from_pairs(token_address: str, pairs: List[dict]) -> Optional[Dict[str, float]]:
+    """Robust price plus market cap / fdv / liquidity / volume of the highest-liquidity pair."""
+    if not pairs:
+        return None
+    best = _pick_highest_liquidity_pair(pairs) or pairs[0]
+    return {
+        'price_usd': _safe_float(robust_price_from_pairs(token_address, pairs)),
+        'market_cap_usd': _safe_float(best.get('marketCap')),
+        'fdv_usd': _safe_float(best.get('fdv')),
+        'liquidity_usd': _safe_float((best.get('liquidity') or {}).get('usd')),
+        'volume24_usd': _safe_float((best.get('volume') or {}).get('h24')),
+    }
+
+
+def _attribute_pairs(pairs: List[dict], token_addresses) -> Dict[str, List[dict]]:
+    """Group pairs by baseToken.address (the token priceUsd refers to), keeping only the
+    requested tokens. Pairs where a token is only the quote side price the other token."""
+    wanted = set(token_addresses)
+    out: Dict[str, List[dict]] = {}
+    for p in pairs or []:
+        base = ((p.get('baseToken') or {}).get('address'))
+        if base in wanted:
+            out.setdefault(base, []).append(p)
+    return out
+
+
+def fetch_token_pairs(token_address: str, chain: str = "solana") -> Optional[List[dict]]:
+    """Pairs for one token, attributed like the batched path (see _attribute_pairs)."""
+    return _attribute_pairs(fetch_dexscreener_pairs(token_address, chain), [token_address]).get(token_address)
+
+
+def fetch_market_data(token_address: str, chain: str = "solana") -> Optional[Dict[str, float]]:
+    """Price and market metrics for token from a single Dexscreener request."""
+    return market_metrics_from_pairs(token_address, fetch_token_pairs(token_address, chain))
+
+
+def fetch_dexscreener_pairs_many(token_addresses: List[str], chain: str = "solana") -> Dict[str, List[dict]]:
+    """Pairs per token using comma-separated tokens requests of up to DEXSCREENER_BATCH_SIZE
+    addresses, attributed with _attribute_pairs."""
+    tokens = list(dict.fromkeys(t for t in token_addresses if t))
+    out: Dict[str, List[dict]] = {}
+    for i in range(0, len(tokens), max(1, DEXSCREENER_BATCH_SIZE)):
+        batch = tokens[i:i + DEXSCREENER_BATCH_SIZE]
+        out.update(_attribute_pairs(fetch_dexscreener_pairs(','.join(batch), chain), batch))
+    return out
+
+
+def get_dexscreener_price(token_address: str, chain: str = "solana") -> Optional[float]:
+    """Return a robust priceUsd for token (see robust_price_from_pairs)."""
+    pairs = fetch_token_pairs(token_address, chain)
+    if not pairs:
+        return None
+    return robust_price_from_pairs(token_address, pairs)
+
+
+def _price_is_sane(token_address: str, price) -> bool:
+    """False for stable mints priced outside their expected range."""
+    stable_cfg = STABLE_MINTS.get(token_address)
+    if not price or price <= 0:
+        return False
+    if stable_cfg:
+        lo, hi = stable_cfg['range']
+        return lo <= price <= hi
+    return True
+
+
+def _store_market_data(token_address: str, metrics: Dict[str, float]):
+    """Upsert metrics into configs_system_web3 (best effort)."""
+    try:
+        from db_module import get_shared_db  # lazy: keeps this module importable without a DB
+        get_shared_db().upsert_token_metrics(token_address, metrics)
+    except Exception as e:
+        print(f"[price] Failed to store metrics for {token_address}: {e}")
+
+
+def refresh_market_data(token_address: str) -> Optional[float]:
+    """Fetch the token payload once and publish it everywhere prices are read:
+    the returned price feeds the price service, the metrics go to configs_system_web3."""
+    metrics = fetch_market_data(token_address)
+    if not metrics:
+        return None
+    price = metrics.get('price_usd')
+    if not _price_is_sane(token_address, price):
+        print(f"[price][skip] Ignoring anomalous price {price} for {token_address}")
         return None
-    with _price_cache_lock:
-        _price_cache[token_address] = {'price': price, 'ts': now}
+    _store_market_data(token_address, metrics)
     return price
 
+
+def refresh_market_data_many(token_addresses: List[str], service=None) -> Dict[str, Dict[str, float]]:
+    """Batched refresh: one request per DEXSCREENER_BATCH_SIZE mints, prices published to the
+    price service and all metrics written with one multi-row configs_system_web3 upsert."""
+    pairs_by_token = fetch_dexscreener_pairs_many(token_addresses)
+    results = {}
+    for token_address, pairs in pairs_by_token.items():
+        metrics = market_metrics_from_pairs(token_address, pairs)
+        if not metrics or not _price_is_sane(token_address, metrics.get('price_usd')):
+            print(f"[price][skip] No usable price for {token_address} this cycle")
+            continue
+        results[token_address] = metrics
+    if results:
+        service = service or get_price_service()
+        for token_address, metrics in results.items():
+            service.publish(token_address, metrics['price_usd'])
+        try:
+            from db_module import get_shared_db  # lazy: keeps this module importable without a DB
+            get_shared_db().upsert_token_metrics_many(results)
+        except Exception as e:
+            print(f"[price] Failed to store metrics batch: {e}")
+    return results
+
+
+PRICE_TTL_SEC = float(os.getenv('PRICE_TTL_SEC', '60'))
+# Refresh in the background once a price is this fraction of its TTL old
+PRICE_REFRESH_AHEAD = float(os.getenv('PRICE_REFRESH_AHEAD', '0.75'))
+# How long a caller with no known price at all may wait for the in-flight fetch
+PRICE_COLD_WAIT_SEC = float(os.getenv('PRICE_COLD_WAIT_SEC', '5'))
+
+
+def _db_last_price(token_address: str) -> Optional[Dict[str, Any]]:
+    """Last stored price from configs_system_web3 as {'price', 'ts'}, or None."""
+    try:
+        from db_module import get_shared_db  # lazy: keeps this module importable without a DB
+        row = get_shared_db().fetch_token_metrics(token_address)
+    except Exception as e:
+        print(f"[price] DB fallback unavailable: {e}")
+        return None
+    if not row or not row.get('price_usd'):
+        return None
+    ts = time.time()
+    try:
+        from datetime import datetime
+        ts = datetime.fromisoformat(str(row.get('last_update'))).timestamp()
+    except Exception:
+        pass
+    return {'price': float(row['price_usd']), 'ts': ts}
+
+
+class PriceService:
+    """In-memory token prices with single-flight refresh and stale-while-revalidate.
+
+    ``get`` never calls Dexscreener itself: it returns the last good price (even
+    when stale) and, once the price is PRICE_REFRESH_AHEAD of its TTL old, kicks
+    off one background refresh per token no matter how many callers ask. A failed
+    refresh keeps the last good price. A refresh is one Dexscreener request
+    (refresh_market_data) that also upserts configs_system_web3; with no price in
+    memory that row is used until the first fetch lands.
+    """
+
+    def __init__(self, fetch=None, ttl: float = PRICE_TTL_SEC, refresh_ahead: float = PRICE_REFRESH_AHEAD,
+                 db_loader=_db_last_price):
+        self.fetch = fetch or refresh_market_data
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.db_loader = db_loader
+        self._lock = threading.Lock()
+        # token -> {'price', 'ts', 'source', 'last_attempt', 'last_error'}
+        self._quotes: Dict[str, Dict[str, Any]] = {}
+        self._inflight: Dict[str, threading.Event] = {}
+        # tokens kept fresh by the batched market data poller (update_charts)
+        self._polled = set()
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'fetches': 0, 'fetch_errors': 0, 'db_fallbacks': 0}
+
+    def _refresh(self, token_address: str, done: threading.Event):
+        price = None
+        error = None
+        try:
+            price = self.fetch(token_address)
+            if price is None:
+                error = 'no price returned'
+        except Exception as e:
+            error = str(e)
+        now = time.time()
+        with self._lock:
+            rec = self._quotes.setdefault(token_address, {'price': None, 'ts': 0.0, 'source': None})
+            rec['last_attempt'] = now
+            self._stats['fetches'] += 1
+            if price is not None and price > 0:
+                rec.update(price=float(price), ts=now, source='dexscreener', last_error=None)
+            else:
+                rec['last_error'] = error or 'non-positive price'
+                self._stats['fetch_errors'] += 1
+            self._inflight.pop(token_address, None)
+        done.set()
+        if error:
+            print(f"[price] refresh failed for {token_address}: {error}")
+
+    def mark_polled(self, tokens: List[str]):
+        """Tokens refreshed by an external poller: callers only trigger a refresh of their
+        own once the price is past its TTL (the poller is behind or failing)."""
+        with self._lock:
+            self._polled.update(t for t in tokens if t)
+
+    def publish(self, token_address: str, price: float, ts: Optional[float] = None):
+        """Record a price fetched elsewhere (e.g. by the batched market data poller)."""
+        if not price or price <= 0:
+            return
+        with self._lock:
+            rec = self._quotes.setdefault(token_address, {'price': None, 'ts': 0.0, 'source': None})
+            rec.update(price=float(price), ts=ts or time.time(), source='dexscreener', last_error=None)
+
+    def refresh_async(self, token_address: str) -> threading.Event:
+        """Start a refresh unless one is already running; returns the event it will set."""
+        with self._lock:
+            done = self._inflight.get(token_address)
+            if done is not None:
+                return done
+            done = self._inflight[token_address] = threading.Event()
+        threading.Thread(target=self._refresh, args=(token_address, done), daemon=True).start()
+        return done
+
+    def quote(self, token_address: str, wait: float = 0) -> Dict[str, Any]:
+        """{'price', 'age_sec', 'source', 'stale', 'last_error'} for token_address.
+        wait > 0 blocks up to that long, only when no price is known at all."""
+        if not token_address:
+            return {'price': None, 'age_sec': None, 'source': None, 'stale': True, 'last_error': 'no token'}
+        now = time.time()
+        with self._lock:
+            rec = self._quotes.setdefault(token_address, {'price': None, 'ts': 0.0, 'source': None})
+            # consult the DB row at most once per TTL while no price is known
+            check_db = not rec.get('price') and now - rec.get('db_checked', 0.0) >= self.ttl
+            if check_db:
+                rec['db_checked'] = now
+        if check_db and self.db_loader is not None:
+            row = self.db_loader(token_address)
+            if row:
+                with self._lock:
+                    if not rec.get('price'):
+                        rec.update(price=row['price'], ts=row['ts'], source='db')
+                        self._stats['db_fallbacks'] += 1
+        with self._lock:
+            rec = dict(self._quotes[token_address])
+            age = now - rec['ts'] if rec.get('price') else None
+            inflight = token_address in self._inflight
+            polled = token_address in self._polled
+            if age is None:
+                self._stats['misses'] += 1
+            elif age < self.ttl:
+                self._stats['hits'] += 1
+            else:
+                self._stats['stale_hits'] += 1
+        if polled:
+            # the poller refreshes ahead of the TTL in batches; step in only when it fell behind
+            needs_refresh = age is None or age >= self.ttl
+        else:
+            # a db-sourced price is always refreshed from the live source
+            needs_refresh = age is None or age >= self.ttl * self.refresh_ahead or rec.get('source') != 'dexscreener'
+        if not inflight and needs_refresh:
+            done = self.refresh_async(token_address)
+        else:
+            done = None
+        if age is None and wait > 0:
+            if done is None:
+                with self._lock:
+                    done = self._inflight.get(token_address)
+            if done is not None:
+                done.wait(wait)
+            return self.quote(token_address)
+        return {
+            'price': rec.get('price'),
+            'age_sec': round(age, 3) if age is not None else None,
+            'source': rec.get('source'),
+            'stale': age is None or age >= self.ttl,
+            'last_error': rec.get('last_error'),
+        }
+
+    def get(self, token_address: str, wait: float = 0) -> Optional[float]:
+        return self.quote(token_address, wait=wait)['price']
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, tokens=len(self._quotes), inflight=len(self._inflight))
+
+
+_price_service: Optional[PriceService] = None
+_price_service_lock = threading.Lock()
+
+
+def get_price_service() -> PriceService:
+    """Process-wide price service."""
+    global _price_service
+    if _price_service is not None:
+        return _price_service
+    with _price_service_lock:
+        if _price_service is None:
+            _price_service = PriceService()
+    return _price_service
+
+
+def get_token_price_cached(token_address: str, ttl: int = 60) -> Optional[float]:
+    """Last known price from the price service (never fetches on the caller's thread).
+    ttl is kept for compatibility; freshness is governed by PRICE_TTL_SEC."""
+    return get_price_service().get(token_address)
+
 def update_price_in_background(token_address: str, filepath: str, interval: int = 360):
     while True:
         price = get_dexscreener_price(token_address)
@@ -0,0 +1,1105 @@
+"""Asset localization for published websites.
+
+A page is parsed once into an ``AssetPlan`` (parser chosen by
+PUBLISH_HTML_PARSER, default html.parser; lxml when installed and selected): one walk over
+the tree collects every asset reference (img/srcset/lazy attributes,
+``url(...)`` in inline styles and <style> blocks, icons, audio/video src and
+poster, <source>). Pricing counts the plan's new files; ``localize_plan`` then
+fetches all distinct remote URLs concurrently on a shared, bounded worker pool
+with a pooled ``requests.Session`` and rewrites the same tree. Downloads stream to a temporary file
+and are renamed into place; per-host concurrency and an overall deadline keep
+one slow CDN from stalling /publish_website. The HTML is rewritten once all
+fetches have settled; anything not fetched in time keeps its original URL.
+
+Each site folder carries a small ``.asset_manifest.json`` (source -> file) so
+new-file counting, filename dedup and republish skips never list the folder.
+
+Asset bytes live once in a content-addressed store (``static/websites/.blobs``,
+SHA-256 names); site files are hardlinks to those blobs, so the link count is
+the reference count and ``gc_blobs`` drops blobs no site links to anymore.
+
+Builds are assembled in ``.staging`` and published by ``commit_site``: each
+site folder is a symlink into ``.builds`` that is swapped with a single rename.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import random
+import re
+import shutil
+import stat
+import string
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+import requests
+from bs4 import BeautifulSoup, FeatureNotFound
+from requests.adapters import HTTPAdapter
+
+from cache_module import LRUTTLStore
+
+FETCH_WORKERS = int(os.getenv('PUBLISH_FETCH_WORKERS', '8'))
+FETCH_PER_HOST = int(os.getenv('PUBLISH_FETCH_PER_HOST', '4'))
+FETCH_TIMEOUT_SEC = float(os.getenv('PUBLISH_FETCH_TIMEOUT_SEC', '15'))
+FETCH_DEADLINE_SEC = float(os.getenv('PUBLISH_FETCH_DEADLINE_SEC', '60'))
+FETCH_MAX_BYTES = int(os.getenv('PUBLISH_FETCH_MAX_BYTES', str(25 * 1024 * 1024)))
+JOB_WORKERS = int(os.getenv('PUBLISH_JOB_WORKERS', '4'))
+JOB_TTL_SEC = int(os.getenv('PUBLISH_JOB_TTL_SEC', '3600'))
+# Upper bound on a site reservation held on a shared backend (covers a crashed worker)
+RESERVE_TTL_SEC = int(os.getenv('PUBLISH_RESERVE_TTL_SEC', '1800'))
+BLOB_DIR = os.getenv('PUBLISH_BLOB_DIR', os.path.join('static', 'websites', '.blobs'))
+BLOB_GC_GRACE_SEC = int(os.getenv('PUBLISH_BLOB_GC_GRACE_SEC', '600'))
+# Requests that resolved the site link just before a swap still read the previous build for this long
+OLD_BUILD_GRACE_SEC = float(os.getenv('PUBLISH_OLD_BUILD_GRACE_SEC', '30'))
+URL_CACHE_DIR = os.getenv('PUBLISH_URL_CACHE_DIR', os.path.join('static', 'websites', '.url_cache'))
+URL_CACHE_MAX_BYTES = int(os.getenv('PUBLISH_URL_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+URL_CACHE_FRESH_SEC = int(os.getenv('PUBLISH_URL_CACHE_FRESH_SEC', str(24 * 3600)))
+HTML_PARSER = os.getenv('PUBLISH_HTML_PARSER', 'html.parser')
+_CHUNK = 64 * 1024
+MANIFEST_NAME = '.asset_manifest.json'
+
+_URL_RE = re.compile(r"url\(([^)]+)\)")
+_XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+_IMG_ATTRS = ('src', 'data-src', 'data-original', 'data-url', 'data-image', 'data-bg', 'data-background')
+_IMG_SRCSET_ATTRS = ('srcset', 'data-srcset', 'data-responsive-srcset')
+_parser_warned = False
+
+
+def _filename_from_url(u: str, default_prefix: str = 'asset') -> str:
+    try:
+        parsed = urlparse(u)
+        base = os.path.basename(parsed.path) if parsed.path else ''
+        if not base or '.' not in base:
+            base = f"{default_prefix}-" + ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+        return base
+    except Exception:
+        return f"{default_prefix}-" + ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+
+
+def _is_http_url(u: str) -> bool:
+    return isinstance(u, str) and (u.startswith('http://') or u.startswith('https://'))
+
+
+def _decode_data_uri(data_uri: str, default_prefix: str):
+    """Return (filename, bytes, sha256) for a base64/plain data URI; the name is <prefix>-<hash><ext>."""
+    header, payload = data_uri.split(',', 1)
+    mime = 'application/octet-stream'
+    if ';' in header and header.startswith('data:'):
+        mime = header.split(';')[0][5:]
+    ext = mimetypes.guess_extension(mime) or '.bin'
+    data = base64.b64decode(payload)
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{default_prefix}-{digest[:16]}{ext}", data, digest
+
+
+def _save_data_uri(data_uri: str, dest_dir: str, default_prefix: str):
+    """Decode a data URI into the blob store and link it into dest_dir. Returns (filename, created)."""
+    try:
+        fname, data, digest = _decode_data_uri(data_uri, default_prefix)
+        os.makedirs(dest_dir, exist_ok=True)
+        dest_path = os.path.join(dest_dir, fname)
+        if os.path.exists(dest_path):
+            return fname, False
+        link_blob(store_blob_bytes(data, digest), dest_path)
+        return fname, True
+    except Exception as e:
+        print(f"[publish] Failed to save data URI: {e}")
+        return None, False
+
+
+# --- Content-addressed blob store ---
+def _blob_path(digest: str) -> str:
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _pin_blob(blob: str):
+    """Protect blob from a concurrent GC until it is linked by bumping its ctime.
+    A same-mode chmod changes only the ctime: the mtime is shared by every site
+    hardlinking the blob and drives their ETags and precompressed siblings."""
+    os.chmod(blob, stat.S_IMODE(os.stat(blob).st_mode))
+
+
+def store_blob_file(path: str, digest: str | None = None) -> str:
+    """Move the file at path into the blob store (dropping it if the blob exists). Returns the blob path."""
+    digest = digest or _file_sha256(path)
+    blob = _blob_path(digest)
+    if os.path.exists(blob):
+        os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        shutil.move(path, blob)
+    _pin_blob(blob)
+    return blob
+
+
+def store_blob_bytes(data: bytes, digest: str | None = None) -> str:
+    digest = digest or hashlib.sha256(data).hexdigest()
+    blob = _blob_path(digest)
+    if not os.path.exists(blob):
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmp = f"{blob}.tmp-{threading.get_ident()}"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, blob)
+    _pin_blob(blob)
+    return blob
+
+
+def link_blob(blob: str, dest_path: str):
+    """Place blob at dest_path as a hardlink (a copy where the filesystem refuses links)."""
+    tmp = f"{dest_path}.lnk-{threading.get_ident()}"
+    try:
+        os.link(blob, tmp)
+    except OSError:
+        shutil.copy2(blob, tmp)
+    os.replace(tmp, dest_path)
+
+
+def gc_blobs(grace_sec: int = BLOB_GC_GRACE_SEC) -> int:
+    """Delete blobs no site links to (link count 1) whose inode has not changed for grace_sec
+    (ctime: set when the blob is stored, reused or linked/unlinked). Returns how many."""
+    removed = 0
+    cutoff = time.time() - grace_sec
+    try:
+        shards = os.listdir(BLOB_DIR)
+    except FileNotFoundError:
+        return 0
+    for shard in shards:
+        shard_dir = os.path.join(BLOB_DIR, shard)
+        try:
+            names = os.listdir(shard_dir)
+        except NotADirectoryError:
+            continue
+        for name in names:
+            path = os.path.join(shard_dir, name)
+            try:
+                st = os.stat(path)
+                if st.st_nlink <= 1 and st.st_ctime < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    if removed:
+        print(f"[publish] Blob GC removed {removed} unreferenced blob(s)")
+    return removed
+
+
+_gc_lock = threading.Lock()
+
+
+def schedule_blob_gc():
+    """Run gc_blobs on a background thread unless one is already running."""
+    if not _gc_lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            gc_blobs()
+        except Exception as e:
+            print(f"[publish] Blob GC failed: {e}")
+        finally:
+            _gc_lock.release()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def _resolve_temp_media_local_path(u: str) -> str | None:
+    """If the given URL points to /static/temp_media, return local filesystem path."""
+    try:
+        if not isinstance(u, str):
+            return None
+        # If absolute URL, extract path
+        path = u
+        if _is_http_url(u):
+            path = urlparse(u).path or ''
+        # Normalize potential prefixes
+        if path.startswith('/static/temp_media/'):
+            local_rel = path.lstrip('/')
+        elif path.startswith('static/temp_media/'):
+            local_rel = path
+        else:
+            return None
+        local_fs = os.path.join(*local_rel.split('/'))  # normalize separators
+        return local_fs if os.path.isfile(local_fs) else None
+    except Exception:
+        return None
+
+
+# --- Per-site asset manifest ---
+class AssetManifest:
+    """Which source produced which file in a site folder, persisted next to index.html."""
+
+    def __init__(self, site_folder: str):
+        self.site_folder = site_folder
+        self.path = os.path.join(site_folder, MANIFEST_NAME)
+        self.assets = {}    # source key -> filename
+        self.files = set()  # every asset filename known to be in the folder
+        self.created = []   # files created by the current publish
+        self._dirty = False
+
+    @classmethod
+    def load(cls, site_folder: str) -> 'AssetManifest':
+        """Read the manifest. Sites published before manifests existed are seeded from one listing."""
+        m = cls(site_folder)
+        try:
+            with open(m.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            m.assets = dict(data.get('assets') or {})
+            m.files = set(data.get('files') or []) | set(m.assets.values())
+        except FileNotFoundError:
+            if os.path.isdir(site_folder):
+                m.files = {n for n in os.listdir(site_folder) if n != 'index.html' and not n.startswith('.')}
+                m._dirty = bool(m.files)
+        except Exception as e:
+            print(f"[publish] Unreadable asset manifest {m.path}, rebuilding: {e}")
+            if os.path.isdir(site_folder):
+                m.files = {n for n in os.listdir(site_folder) if n != 'index.html' and not n.startswith('.')}
+            m._dirty = True
+        return m
+
+    @staticmethod
+    def key(src: str) -> str:
+        # data URIs can be megabytes; key them by content hash
+        if src.startswith('data:'):
+            return 'data:sha256:' + hashlib.sha256(src.encode('utf-8')).hexdigest()
+        return src
+
+    def lookup(self, src: str) -> str | None:
+        fname = self.assets.get(self.key(src))
+        return fname if fname in self.files else None
+
+    def has_file(self, fname: str) -> bool:
+        return fname in self.files
+
+    def record(self, src: str, fname: str, created: bool = False):
+        self.assets[self.key(src)] = fname
+        self.files.add(fname)
+        if created:
+            self.created.append(fname)
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp = f"{self.path}.tmp-{threading.get_ident()}"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'version': 1, 'assets': self.assets, 'files': sorted(self.files)}, f)
+            os.replace(tmp, self.path)
+            self._dirty = False
+        except Exception as e:
+            print(f"[publish] Failed to write asset manifest {self.path}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+# --- Download cache ---
+class UrlCache:
+    """On-disk cache of publish-time downloads keyed by URL.
+
+    Each entry is <root>/<aa>/<urlhash>.json (url, digest, validators, size, stored time)
+    next to <urlhash>.bin, a hardlink to the blob, so cached bytes outlive the sites
+    that used them. Entries younger than fresh_sec are reused without a request; older
+    ones are revalidated with If-None-Match / If-Modified-Since. Total size is bounded
+    by LRU eviction, where last use is the .json mtime.
+    """
+
+    def __init__(self, root: str = URL_CACHE_DIR, max_bytes: int = URL_CACHE_MAX_BYTES,
+                 fresh_sec: int = URL_CACHE_FRESH_SEC):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.fresh_sec = fresh_sec
+        self._lock = threading.Lock()
+        self._index = None  # OrderedDict urlhash -> size, least recently used first
+        self._bytes = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _paths(self, url: str):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.root, key[:2], key)
+        return key, base + '.json', base + '.bin'
+
+    def _ensure_index(self):
+        """Scan the cache once per process to rebuild the LRU order (caller holds the lock)."""
+        if self._index is not None:
+            return
+        entries = []
+        if os.path.isdir(self.root):
+            for shard in os.listdir(self.root):
+                shard_dir = os.path.join(self.root, shard)
+                if not os.path.isdir(shard_dir):
+                    continue
+                for name in os.listdir(shard_dir):
+                    if not name.endswith('.json'):
+                        continue
+                    key = name[:-5]
+                    try:
+                        used = os.stat(os.path.join(shard_dir, name)).st_mtime
+                        size = os.stat(os.path.join(shard_dir, key + '.bin')).st_size
+                    except FileNotFoundError:
+                        continue
+                    entries.append((used, key, size))
+        entries.sort()
+        self._index = OrderedDict((key, size) for _, key, size in entries)
+        self._bytes = sum(self._index.values())
+
+    def lookup(self, url: str):
+        """Cached entry for url as a dict (with 'body' path and 'fresh' flag), or None."""
+        if self.max_bytes <= 0:
+            return None
+        key, meta_path, body_path = self._paths(url)
+        with self._lock:
+            self._ensure_index()
+            if key not in self._index:
+                return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if meta.get('url') != url or not os.path.exists(body_path):
+            return None
+        meta['body'] = body_path
+        meta['fresh'] = (time.time() - meta.get('stored', 0)) < self.fresh_sec
+        return meta
+
+    def _touch(self, url: str, meta_path: str):
+        key = os.path.basename(meta_path)[:-5]
+        try:
+            os.utime(meta_path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            if self._index is not None and key in self._index:
+                self._index.move_to_end(key)
+
+    def record_hit(self, url: str, meta: dict, revalidated: bool = False):
+        _, meta_path, _ = self._paths(url)
+        if revalidated:
+            meta = {k: v for k, v in meta.items() if k not in ('body', 'fresh')}
+            meta['stored'] = time.time()
+            self._write_meta(meta_path, meta)
+        self._touch(url, meta_path)
+        with self._lock:
+            if revalidated:
+                self.revalidated += 1
+            else:
+                self.hits += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    @staticmethod
+    def _write_meta(meta_path: str, meta: dict):
+        tmp = f"{meta_path}.tmp-{threading.get_ident()}"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp, meta_path)
+
+    def store(self, url: str, blob: str, digest: str, size: int, etag=None, last_modified=None):
+        if self.max_bytes <= 0 or size > self.max_bytes:
+            return
+        key, meta_path, body_path = self._paths(url)
+        try:
+            os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+            link_blob(blob, body_path)
+            self._write_meta(meta_path, {'url': url, 'digest': digest, 'size': size, 'etag': etag,
+                                         'last_modified': last_modified, 'stored': time.time()})
+        except OSError as e:
+            print(f"[publish] Failed to cache {url}: {e}")
+            return
+        evicted = []
+        with self._lock:
+            self._ensure_index()
+            self._bytes += size - self._index.pop(key, 0)
+            self._index[key] = size
+            while self._bytes > self.max_bytes and len(self._index) > 1:
+                old_key, old_size = self._index.popitem(last=False)
+                self._bytes -= old_size
+                self.evictions += 1
+                evicted.append(old_key)
+        for old_key in evicted:
+            base = os.path.join(self.root, old_key[:2], old_key)
+            for path in (base + '.json', base + '.bin'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._index or {}),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'revalidated': self.revalidated,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# --- Pooled fetcher ---
+class AssetFetcher:
+    """Shared download pool: bounded workers, keep-alive session, per-host limits."""
+
+    def __init__(self, workers: int = FETCH_WORKERS, per_host: int = FETCH_PER_HOST,
+                 timeout: float = FETCH_TIMEOUT_SEC, max_bytes: int = FETCH_MAX_BYTES, cache: UrlCache | None = None):
+        self.cache = cache
+        self.per_host = max(1, per_host)
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(4, workers), pool_maxsize=max(4, workers))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='publish-fetch')
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        host = (urlparse(url).hostname or '').lower()
+        with self._hosts_lock:
+            sem = self._hosts.get(host)
+            if sem is None:
+                sem = self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return sem
+
+    def download(self, url: str, dest_path: str, deadline: float) -> bool:
+        """Link url's bytes at dest_path: from the URL cache when fresh (or revalidated with a 304),
+        otherwise streamed into the blob store, hashing as it goes. False on error, oversize or deadline."""
+        cached = self.cache.lookup(url) if self.cache else None
+        if cached and cached['fresh']:
+            try:
+                link_blob(cached['body'], dest_path)
+                self.cache.record_hit(url, cached)
+                return True
+            except OSError:
+                cached = None
+        sem = self._host_slot(url)
+        if not sem.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            print(f"[publish] Deadline reached waiting for host slot: {url}")
+            return False
+        tmp_path = f"{dest_path}.part-{threading.get_ident()}"
+        try:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            timeout = min(self.timeout, remaining)
+            headers = {}
+            if cached:
+                if cached.get('etag'):
+                    headers['If-None-Match'] = cached['etag']
+                if cached.get('last_modified'):
+                    headers['If-Modified-Since'] = cached['last_modified']
+            with self.session.get(url, stream=True, timeout=(timeout, timeout), headers=headers) as r:
+                if r.status_code == 304 and cached:
+                    link_blob(cached['body'], dest_path)
+                    self.cache.record_hit(url, cached, revalidated=True)
+                    return True
+                r.raise_for_status()
+                etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+                written = 0
+                h = hashlib.sha256()
+                with open(tmp_path, 'wb') as f:
+                    for chunk in r.iter_content(_CHUNK):
+                        written += len(chunk)
+                        if written > self.max_bytes:
+                            raise ValueError(f"asset larger than {self.max_bytes} bytes")
+                        if time.monotonic() > deadline:
+                            raise TimeoutError('publish fetch deadline reached')
+                        h.update(chunk)
+                        f.write(chunk)
+            digest = h.hexdigest()
+            blob = store_blob_file(tmp_path, digest)
+            link_blob(blob, dest_path)
+            if self.cache:
+                self.cache.record_miss()
+                self.cache.store(url, blob, digest, written, etag, last_modified)
+            return True
+        except Exception as e:
+            print(f"Failed to download {url}: {e}")
+            return False
+        finally:
+            sem.release()
+            if os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def fetch_many(self, jobs, deadline_sec: float = FETCH_DEADLINE_SEC, progress=None) -> set:
+        """jobs: {url: dest_path}. Fetch concurrently; return the set of urls that landed on disk.
+        progress(done, total) is called as each download settles."""
+        if not jobs:
+            return set()
+        deadline = time.monotonic() + deadline_sec
+        futures = {self.executor.submit(self.download, url, path, deadline): url for url, path in jobs.items()}
+        if progress is not None:
+            counter = {'done': 0}
+            counter_lock = threading.Lock()
+
+            def settled(_fut):
+                with counter_lock:
+                    counter['done'] += 1
+                    done_now = counter['done']
+                try:
+                    progress(done_now, len(futures))
+                except Exception as e:
+                    print(f"[publish] progress callback failed: {e}")
+            for fut in futures:
+                fut.add_done_callback(settled)
+        done, pending = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        for fut in pending:
+            fut.cancel()
+        if pending:
+            print(f"[publish] {len(pending)} asset(s) not fetched before the {deadline_sec}s deadline")
+        return {futures[f] for f in done if not f.cancelled() and f.exception() is None and f.result()}
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_asset_fetcher() -> AssetFetcher:
+    """Process-wide fetcher shared by all publish requests."""
+    global _fetcher
+    if _fetcher is not None:
+        return _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = AssetFetcher(cache=UrlCache())
+    return _fetcher
+
+
+def _is_already_site_url(src: str, public_prefix: str) -> bool:
+    if not isinstance(src, str) or not src:
+        return False
+    # Extract path for absolute URLs
+    path = src
+    if _is_http_url(src):
+        try:
+            path = urlparse(src).path or ''
+        except Exception:
+            path = src
+    # Normalize public prefix without leading slash
+    pp = public_prefix.lstrip('/') if isinstance(public_prefix, str) else ''
+    # Accept both with and without leading slash for the website folder
+    if path.startswith(public_prefix + '/') or path == public_prefix:
+        return True
+    if path.startswith(pp) or path.startswith('/' + pp):
+        return True
+    # Consider site-relative paths (e.g., images/foo.jpg, ./img/x.png, ../assets/y.webp)
+    # as already site content, as long as they are not explicitly temp_media or data URIs
+    if not _is_http_url(src) and not (path.startswith('/static/temp_media') or path.startswith('static/temp_media')):
+        if path.startswith('./') or path.startswith('../'):
+            return True
+        # No leading slash and not data/absolute => likely site-relative
+        if not path.startswith('/') and not src.startswith('data:'):
+            return True
+    return False
+
+
+def _parse_srcset(val: str) -> list:
+    """Split a srcset into (url, descriptor) candidates as the HTML spec does: the URL runs to the
+    next whitespace (so the commas of a data: URL stay in it), trailing commas end a candidate
+    early, and a descriptor runs to the next comma outside parentheses."""
+    s = val or ''
+    n = len(s)
+    i = 0
+    out = []
+    while i < n:
+        while i < n and (s[i].isspace() or s[i] == ','):
+            i += 1
+        j = i
+        while j < n and not s[j].isspace():
+            j += 1
+        url = s[i:j]
+        desc = ''
+        if url.endswith(','):
+            url = url.rstrip(',')
+        else:
+            depth = 0
+            k = j
+            while k < n and (depth or s[k] != ','):
+                if s[k] == '(':
+                    depth += 1
+                elif s[k] == ')' and depth:
+                    depth -= 1
+                k += 1
+            desc = ' '.join(s[j:k].split())
+            j = k + 1
+        if url:
+            out.append((url, desc))
+        i = j
+    return out
+
+
+def _collect_asset_refs(soup):
+    """Single walk over the soup. Returns (refs, edits):
+    refs  -- {src: default_prefix} for every distinct asset reference
+    edits -- callables taking a resolver (src -> new url or None) that rewrite the document
+    """
+    refs = {}
+    edits = []
+
+    def add(src, prefix):
+        if src:
+            refs.setdefault(src, prefix)
+
+    def style_urls(text):
+        return [m.group(1).strip().strip("'\"") for m in _URL_RE.finditer(text or '')]
+
+    def rewrite_style(text, resolve):
+        def repl(m):
+            url_inner = m.group(1).strip().strip("'\"")
+            return f"url('{resolve(url_inner) or url_inner}')"
+        return _URL_RE.sub(repl, text or '')
+
+    def rewrite_srcset(candidates, resolve):
+        return ', '.join((resolve(u) or u) + (f" {desc}" if desc else '') for u, desc in candidates)
+
+    def plain_attr(tag, attr, prefix):
+        val = tag.get(attr)
+        if not val or not isinstance(val, str):
+            return
+        add(val, prefix)
+
+        def edit(resolve, tag=tag, attr=attr, val=val):
+            new = resolve(val)
+            if new:
+                tag[attr] = new
+        edits.append(edit)
+
+    def srcset_attr(tag, attr):
+        val = tag.get(attr)
+        if not val or not isinstance(val, str):
+            return
+        # the refs (what is priced) and the rewrite come from this one parse
+        candidates = _parse_srcset(val)
+        for u, _desc in candidates:
+            add(u, 'img')
+        edits.append(lambda resolve, tag=tag, attr=attr, c=candidates: tag.__setitem__(attr, rewrite_srcset(c, resolve)))
+
+    for tag in soup.find_all(True):
+        name = tag.name
+        if name == 'img':
+            for a in _IMG_ATTRS:
+                plain_attr(tag, a, 'img')
+            for a in _IMG_SRCSET_ATTRS:
+                srcset_attr(tag, a)
+        elif name == 'source':
+            for a in ('srcset', 'data-srcset'):
+                srcset_attr(tag, a)
+            if tag.find_parent(['audio', 'video']) is not None:
+                plain_attr(tag, 'src', 'media')
+        elif name == 'image':
+            href = tag.get('href') or tag.get(_XLINK_HREF) or tag.get('xlink:href')
+            if href:
+                add(href, 'img')
+
+                def edit(resolve, tag=tag, href=href):
+                    new = resolve(href)
+                    if new:
+                        tag['href'] = new
+                        for a in (_XLINK_HREF, 'xlink:href'):
+                            if a in tag.attrs:
+                                tag[a] = new
+                edits.append(edit)
+        elif name == 'link':
+            rel = ' '.join(tag.get('rel') or []).lower()
+            as_attr = (tag.get('as') or '').lower()
+            if ('icon' in rel) or (as_attr == 'image'):
+                plain_attr(tag, 'href', 'img')
+        elif name in ('audio', 'video'):
+            plain_attr(tag, 'src', 'media')
+            plain_attr(tag, 'poster', 'poster')
+        elif name == 'style' and tag.string:
+            for u in style_urls(tag.string):
+                add(u, 'img')
+
+            def edit(resolve, node=tag.string):
+                try:
+                    node.replace_with(rewrite_style(str(node), resolve))
+                except Exception as e:
+                    print(f"Failed to rewrite <style> content urls: {e}")
+            edits.append(edit)
+
+        if tag.has_attr('style'):
+            val = tag.get('style', '')
+            for u in style_urls(val):
+                add(u, 'img')
+            edits.append(lambda resolve, tag=tag, val=val: tag.__setitem__('style', rewrite_style(val, resolve)))
+
+    return refs, edits
+
+
+def _make_soup(html: str):
+    """Parse with PUBLISH_HTML_PARSER (lxml, html5lib or html.parser), falling back to html.parser."""
+    global _parser_warned
+    try:
+        return BeautifulSoup(html or '', HTML_PARSER)
+    except FeatureNotFound:
+        if not _parser_warned:
+            print(f"[publish] HTML parser '{HTML_PARSER}' not installed; using html.parser")
+            _parser_warned = True
+        return BeautifulSoup(html or '', 'html.parser')
+
+
+class AssetPlan:
+    """One parse of a page: the tree, every asset reference, the rewrites and the site manifest.
+    Pricing (new_file_count) and localization (localize_plan) both work from the same plan."""
+
+    def __init__(self, soup, refs, edits, manifest: AssetManifest, site_folder: str, public_prefix: str):
+        self.soup = soup
+        self.refs = refs
+        self.edits = edits
+        self.manifest = manifest
+        self.site_folder = site_folder
+        self.public_prefix = public_prefix
+
+    def retarget(self, folder: str):
+        """Build into folder (a staging copy of site_folder) instead; URLs keep the public prefix."""
+        self.site_folder = folder
+        self.manifest.site_folder = folder
+        self.manifest.path = os.path.join(folder, MANIFEST_NAME)
+
+    def new_file_count(self) -> int:
+        """How many files localize_plan would create in site_folder (what the publish is charged for)."""
+        names = set()
+        count = 0
+        for src, prefix in self.refs.items():
+            if _is_already_site_url(src, self.public_prefix) or self.manifest.lookup(src):
+                continue
+            local_src = None if src.startswith('data:') else _resolve_temp_media_local_path(src)
+            if src.startswith('data:'):
+                try:
+                    fname = _decode_data_uri(src, prefix)[0]
+                except Exception:
+                    continue  # localize_plan cannot save it either
+            elif local_src:
+                fname = os.path.basename(local_src)
+            elif _is_http_url(src):
+                fname = _filename_from_url(src, prefix)
+            else:
+                continue
+            if fname not in names and not self.manifest.has_file(fname):
+                names.add(fname)
+                count += 1
+        return count
+
+
+def plan_assets(html: str, site_folder: str, public_prefix: str | None = None) -> AssetPlan:
+    """Parse html once and collect its assets. Read-only: MUST NOT create site_folder."""
+    if public_prefix is None:
+        public_prefix = f"/static/websites/{os.path.basename(os.path.normpath(site_folder))}"
+    soup = _make_soup(html)
+    refs, edits = _collect_asset_refs(soup)
+    return AssetPlan(soup, refs, edits, AssetManifest.load(site_folder), site_folder, public_prefix)
+
+
+def localize_plan(plan: AssetPlan, progress=None) -> tuple[str, int]:
+    """
+    Downloads/moves the plan's assets into its site folder and rewrites URLs to its public prefix.
+    Files referenced from /static/temp_media are moved into the site folder.
+    Returns (updated HTML string, new_files_count) where new_files_count is the number of files
+    that did not exist in the site folder before. progress(done, total) reports remote fetches.
+    """
+    manifest = plan.manifest
+    dest_dir = plan.site_folder
+    public_prefix = plan.public_prefix
+    try:
+        os.makedirs(dest_dir, exist_ok=True)
+
+        # Resolve local sources inline, queue remote ones for the pool
+        resolved = {}   # src -> filename in dest_dir
+        fetch_jobs = {}  # url -> dest path
+        claimed = {}     # filename -> url queued for it
+        sharing = []     # (url, owner url): same basename as a queued URL maps to the same file, as before
+        for src, prefix in plan.refs.items():
+            if _is_already_site_url(src, plan.public_prefix):
+                continue
+            known = manifest.lookup(src)
+            if known:
+                # Republish: this source was localized before
+                resolved[src] = known
+                continue
+            local_src = _resolve_temp_media_local_path(src)
+            if local_src:
+                try:
+                    orig_name = os.path.basename(local_src)
+                    created = not manifest.has_file(orig_name)
+                    if created:
+                        # Move from temp_media into the blob store so it won't be deleted at midnight
+                        link_blob(store_blob_file(local_src), os.path.join(dest_dir, orig_name))
+                    manifest.record(src, orig_name, created)
+                    resolved[src] = orig_name
+                except Exception as e:
+                    print(f"Failed to move from temp_media {local_src}: {e}")
+                continue
+            if src.startswith('data:'):
+                fname, created = _save_data_uri(src, dest_dir, prefix)
+                if fname:
+                    manifest.record(src, fname, created)
+                    resolved[src] = fname
+                continue
+            if _is_http_url(src):
+                fname = _filename_from_url(src, prefix)
+                if manifest.has_file(fname):
+                    manifest.record(src, fname)
+                    resolved[src] = fname
+                elif fname in claimed:
+                    sharing.append((src, claimed[fname]))
+                else:
+                    claimed[fname] = src
+                    fetch_jobs[src] = os.path.join(dest_dir, fname)
+
+        fetched = get_asset_fetcher().fetch_many(fetch_jobs, progress=progress)
+        for src, path in fetch_jobs.items():
+            if src in fetched:
+                manifest.record(src, os.path.basename(path), created=True)
+                resolved[src] = os.path.basename(path)
+        for src, owner in sharing:
+            if owner in fetched:
+                manifest.record(src, resolved[owner])
+                resolved[src] = resolved[owner]
+        if fetch_jobs:
+            fetcher = get_asset_fetcher()
+            cache_stats = fetcher.cache.stats() if fetcher.cache else {}
+            print(f"[publish] fetched {len(fetched)}/{len(fetch_jobs)} remote assets into {dest_dir} url_cache={cache_stats}")
+
+        # Rewrite the already-parsed tree
+        def resolve(src):
+            fname = resolved.get(src)
+            return f"{public_prefix}/{fname}" if fname else None
+
+        for edit in plan.edits:
+            edit(resolve)
+        manifest.save()
+        return str(plan.soup), len(manifest.created)
+    except Exception as e:
+        print(f"Error localizing multimedia: {e}")
+        manifest.save()
+        return None, len(manifest.created)
+
+
+# --- Atomic site writes ---
+def stage_site(site_folder: str, tag: str) -> str:
+    """Create a staging folder next to the live sites, pre-filled with hardlinks to site_folder's files."""
+    staging_root = os.path.join(os.path.dirname(os.path.normpath(site_folder)), '.staging')
+    os.makedirs(staging_root, exist_ok=True)
+    staging = os.path.join(staging_root, f"{os.path.basename(os.path.normpath(site_folder))}-{tag}")
+    if os.path.isdir(site_folder):
+        def link_or_copy(src, dst):
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+        shutil.copytree(site_folder, staging, copy_function=link_or_copy)
+    else:
+        os.makedirs(staging)
+    return staging
+
+
+def write_file_atomic(path: str, text: str):
+    tmp = f"{path}.tmp-{threading.get_ident()}"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def _builds_root(site_folder: str) -> str:
+    return os.path.join(os.path.dirname(os.path.normpath(site_folder)), '.builds')
+
+
+def commit_site(staging: str, site_folder: str):
+    """Make the staged build live with one rename.
+
+    site_folder is a symlink into .builds/; the build moves there, a new link is created next to
+    site_folder and renamed over it, so readers see the old or the new site and never a missing
+    one. A site still stored as a plain folder (published before builds were linked) is moved
+    aside first; that one conversion is the only swap with a gap.
+    """
+    site_folder = os.path.normpath(site_folder)
+    builds_root = _builds_root(site_folder)
+    os.makedirs(builds_root, exist_ok=True)
+    build = os.path.join(builds_root, os.path.basename(staging))
+    os.replace(staging, build)
+    old = None
+    if os.path.islink(site_folder):
+        old = os.path.join(os.path.dirname(site_folder), os.readlink(site_folder))
+    elif os.path.isdir(site_folder):
+        old = f"{build}.old"
+        os.replace(site_folder, old)
+    link_tmp = f"{site_folder}.link-{threading.get_ident()}"
+    os.symlink(os.path.relpath(build, os.path.dirname(site_folder)), link_tmp)
+    os.replace(link_tmp, site_folder)
+    if old and os.path.normpath(old) != build:
+        t = threading.Timer(OLD_BUILD_GRACE_SEC, shutil.rmtree, args=(old,), kwargs={'ignore_errors': True})
+        t.daemon = True
+        t.start()
+
+
+def remove_site(site_folder: str):
+    """Delete a published site: the link and the build it points to (or a legacy plain folder)."""
+    site_folder = os.path.normpath(site_folder)
+    if os.path.islink(site_folder):
+        target = os.path.join(os.path.dirname(site_folder), os.readlink(site_folder))
+        os.remove(site_folder)
+        shutil.rmtree(target, ignore_errors=True)
+    elif os.path.isdir(site_folder):
+        shutil.rmtree(site_folder)
+
+
+# --- Publish job queue ---
+class PublishJobQueue:
+    """Runs publish builds off the request thread and keeps their status for polling.
+
+    Jobs are plain dicts: {'id', 'user_id', 'site', 'status' (queued|running|done|failed),
+    'stage', 'assets_done', 'assets_total', 'result', 'error', 'created', 'updated'}.
+    A site name is reserved from submit() until its job finishes so two publishes
+    of the same folder never race.
+
+    With a shared state backend (state_backend, STATE_BACKEND=redis) job status and
+    site reservations live there too, so any worker can answer a status poll and
+    reservations exclude publishes running on other workers.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, ttl: int = JOB_TTL_SEC, backend=None):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='publish-job')
+        self.jobs = LRUTTLStore('publish_jobs', max_entries=10000, ttl=ttl)
+        self.ttl = ttl
+        self.backend = backend if (backend is not None and getattr(backend, 'shared', False)) else None
+        self._lock = threading.Lock()
+        self._reserved = {}  # site -> job id (local backend only)
+        self._last_write = {}  # job id -> last shared write, to throttle progress updates
+
+    @staticmethod
+    def _site_key(site: str) -> str:
+        return f"publish:site:{site}"
+
+    @staticmethod
+    def _job_key(job_id: str) -> str:
+        return f"publish:job:{job_id}"
+
+    def reserve(self, site: str):
+        """Reserve site for a new job. Returns the job id, or None if a job for it is in flight."""
+        job_id = uuid.uuid4().hex
+        if self.backend is not None:
+            # TTL bounds a reservation left behind by a worker that died mid-build
+            if self.backend.set(self._site_key(site), job_id, ttl=RESERVE_TTL_SEC, nx=True):
+                return job_id
+            return None
+        with self._lock:
+            if site in self._reserved:
+                return None
+            self._reserved[site] = job_id
+            return job_id
+
+    def release(self, site: str, job_id: str):
+        if self.backend is not None:
+            self.backend.delete_if(self._site_key(site), job_id)
+            return
+        with self._lock:
+            if self._reserved.get(site) == job_id:
+                del self._reserved[site]
+
+    def is_reserved(self, site: str) -> bool:
+        if self.backend is not None:
+            return self.backend.get(self._site_key(site)) is not None
+        with self._lock:
+            return site in self._reserved
+
+    def _publish(self, job: dict, force: bool = True):
+        if self.backend is None:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_write.get(job['id'], 0.0) < 0.5:
+                return
+            self._last_write[job['id']] = now
+            if job['status'] in ('done', 'failed'):
+                self._last_write.pop(job['id'], None)
+        try:
+            self.backend.set(self._job_key(job['id']), json.dumps(job, default=str), ttl=self.ttl)
+        except Exception as e:
+            print(f"[publish_job] Failed to share status of {job['id']}: {e}")
+
+    def submit(self, job_id: str, user_id, site: str, fn, *args) -> dict:
+        """Queue fn(job, *args). fn returns the result dict or raises; the reservation is released after."""
+        now = time.time()
+        job = {'id': job_id, 'user_id': user_id, 'site': site, 'status': 'queued', 'stage': 'queued',
+               'assets_done': 0, 'assets_total': 0, 'result': None, 'error': None, 'created': now, 'updated': now}
+        self.jobs[job_id] = job
+        self._publish(job)
+
+        def run():
+            self.update(job, status='running', stage='starting')
+            try:
+                result = fn(job, *args)
+                self.update(job, status='done', stage='done', result=result)
+            except Exception as e:
+                print(f"[publish_job] {job_id} site={site} failed: {e}")
+                self.update(job, status='failed', stage='failed', error=str(e))
+            finally:
+                self.release(site, job_id)
+
+        try:
+            self.executor.submit(run)
+        except Exception:
+            self.release(site, job_id)
+            raise
+        return job
+
+    def update(self, job: dict, **fields):
+        fields['updated'] = time.time()
+        job.update(fields)
+        self.jobs.touch(job['id'])
+        # progress-only updates (asset counters) are throttled on the shared store
+        self._publish(job, force=bool(set(fields) - {'updated', 'assets_done', 'assets_total'}))
+
+    def get(self, job_id: str):
+        job = self.jobs.get(job_id)
+        if job is None and self.backend is not None:
+            raw = self.backend.get(self._job_key(job_id))
+            if raw:
+                try:
+                    job = json.loads(raw)
+                except ValueError:
+                    job = None
+        return job
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_publish_queue(backend=None) -> PublishJobQueue:
+    """Process-wide publish job queue (job status shared through backend when it is shared)."""
+    global _job_queue
+    if _job_queue is not None:
+        return _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = PublishJobQueue(backend=backend)
+    return _job_queue
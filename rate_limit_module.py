@@ -0,0 +1,222 @@
+"""Per-key request rate limiting (used for published websites).
+
+State is split across shards, each with its own lock, so requests for
+different keys rarely contend. Three algorithms are available:
+
+- ``fixed``: counter per aligned window (the historical behaviour)
+- ``sliding``: sliding-window counter, blending the previous window's count
+- ``token_bucket``: refills ``limit`` tokens per window, burst up to ``burst``
+
+Idle entries are dropped by an amortized per-shard sweep, so the tables stay
+bounded by the number of recently active keys.
+
+With a shared state backend (see state_backend) ``SharedRateLimiter`` keeps
+the window counters there instead, so N workers enforce one limit rather than
+N. Counters are atomic increments that expire with their window.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+import zlib
+
+ALGORITHMS = ('fixed', 'sliding', 'token_bucket')
+
+
+class RateLimiter:
+    def __init__(self, limit: int, window_sec: float = 3600, algorithm: str = 'fixed', shards: int = 16,
+                 burst: int | None = None, sweep_every_sec: float = 60):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"unknown rate limit algorithm {algorithm!r}; expected one of {ALGORITHMS}")
+        self.limit = int(limit)
+        self.window = float(window_sec)
+        self.algorithm = algorithm
+        self.burst = int(burst) if burst else self.limit
+        self.sweep_every = sweep_every_sec
+        n = max(1, int(shards))
+        self._locks = [threading.Lock() for _ in range(n)]
+        self._tables = [{} for _ in range(n)]
+        self._next_sweep = [0.0] * n
+        self._allowed = [0] * n
+        self._rejected = [0] * n
+
+    def _shard(self, key) -> int:
+        return zlib.crc32(str(key).encode('utf-8')) % len(self._tables)
+
+    def allow(self, key, now: float | None = None) -> bool:
+        """Count one request for key. Returns False when it is over the limit."""
+        if not key:
+            return True
+        now = time.time() if now is None else now
+        i = self._shard(key)
+        with self._locks[i]:
+            table = self._tables[i]
+            if now >= self._next_sweep[i]:
+                self._sweep_locked(table, now)
+                self._next_sweep[i] = now + self.sweep_every
+            ok = getattr(self, f"_allow_{self.algorithm}")(table, key, now)
+            if ok:
+                self._allowed[i] += 1
+            else:
+                self._rejected[i] += 1
+            return ok
+
+    # --- algorithms (caller holds the shard lock); records are small lists mutated in place ---
+    def _allow_fixed(self, table, key, now) -> bool:
+        window = now - (now % self.window)
+        rec = table.get(key)
+        if rec is None or rec[0] != window:
+            rec = table[key] = [window, 0]
+        if rec[1] >= self.limit:
+            return False
+        rec[1] += 1
+        return True
+
+    def _allow_sliding(self, table, key, now) -> bool:
+        window = now - (now % self.window)
+        rec = table.get(key)  # [window_start, count, previous_window_count]
+        if rec is None:
+            rec = table[key] = [window, 0, 0]
+        elif rec[0] != window:
+            prev = rec[1] if rec[0] == window - self.window else 0
+            rec[0], rec[1], rec[2] = window, 0, prev
+        weight = 1.0 - (now - window) / self.window
+        if rec[2] * weight + rec[1] >= self.limit:
+            return False
+        rec[1] += 1
+        return True
+
+    def _allow_token_bucket(self, table, key, now) -> bool:
+        rate = self.limit / self.window
+        rec = table.get(key)  # [tokens, last_refill]
+        if rec is None:
+            rec = table[key] = [float(self.burst), now]
+        else:
+            rec[0] = min(float(self.burst), rec[0] + (now - rec[1]) * rate)
+            rec[1] = now
+        if rec[0] < 1.0:
+            return False
+        rec[0] -= 1.0
+        return True
+
+    # --- expiry ---
+    def _idle(self, rec, now) -> bool:
+        if self.algorithm == 'token_bucket':
+            # a bucket that would have refilled completely carries no state
+            return rec[0] + (now - rec[1]) * (self.limit / self.window) >= self.burst
+        # fixed: the window is over; sliding: the window no longer weighs on the next one
+        horizon = 2 * self.window if self.algorithm == 'sliding' else self.window
+        return now - rec[0] >= horizon
+
+    def _sweep_locked(self, table, now) -> int:
+        stale = [k for k, rec in table.items() if self._idle(rec, now)]
+        for k in stale:
+            del table[k]
+        return len(stale)
+
+    def sweep(self) -> int:
+        """Drop idle entries in every shard. Returns how many were removed."""
+        now = time.time()
+        removed = 0
+        for i, lock in enumerate(self._locks):
+            with lock:
+                removed += self._sweep_locked(self._tables[i], now)
+        return removed
+
+    def stats(self) -> dict:
+        keys = allowed = rejected = 0
+        for i, lock in enumerate(self._locks):
+            with lock:
+                keys += len(self._tables[i])
+                allowed += self._allowed[i]
+                rejected += self._rejected[i]
+        return {'algorithm': self.algorithm, 'limit': self.limit, 'window_sec': self.window,
+                'keys': keys, 'allowed': allowed, 'rejected': rejected}
+
+
+class SharedRateLimiter:
+    """Fixed or sliding window limiter whose counters live on a shared state backend.
+    Token buckets need read-modify-write state, so they are approximated by the sliding window."""
+
+    def __init__(self, backend, name: str, limit: int, window_sec: float = 3600, algorithm: str = 'fixed'):
+        if algorithm == 'token_bucket':
+            print("[rate_limit] token_bucket is not available on a shared backend; using 'sliding'")
+            algorithm = 'sliding'
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"unknown rate limit algorithm {algorithm!r}; expected one of {ALGORITHMS}")
+        self.backend = backend
+        self.name = name
+        self.limit = int(limit)
+        self.window = float(window_sec)
+        self.algorithm = algorithm
+        self._lock = threading.Lock()
+        self._allowed = 0
+        self._rejected = 0
+        self._errors = 0
+
+    def _key(self, key, window) -> str:
+        return f"rl:{self.name}:{key}:{int(window)}"
+
+    def allow(self, key, now: float | None = None) -> bool:
+        if not key:
+            return True
+        now = time.time() if now is None else now
+        window = now - (now % self.window)
+        try:
+            # keep the counter through the next window so a sliding estimate can still read it
+            count = self.backend.incr(self._key(key, window), 1, ttl=2 * self.window + 60)
+            if self.algorithm == 'sliding':
+                prev = int(self.backend.get(self._key(key, window - self.window)) or 0)
+                weight = 1.0 - (now - window) / self.window
+                ok = prev * weight + count <= self.limit
+            else:
+                ok = count <= self.limit
+        except Exception as e:
+            # fail open: a backend outage must not take published sites down
+            print(f"[rate_limit] shared counter error for {key}: {e}")
+            with self._lock:
+                self._errors += 1
+            return True
+        with self._lock:
+            if ok:
+                self._allowed += 1
+            else:
+                self._rejected += 1
+        return ok
+
+    def sweep(self) -> int:
+        return 0  # counters expire on the backend
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'algorithm': self.algorithm, 'limit': self.limit, 'window_sec': self.window,
+                    'backend': self.backend.name, 'allowed': self._allowed, 'rejected': self._rejected,
+                    'errors': self._errors}
+
+
+def website_rate_limiter_from_env(backend=None):
+    """Limiter for /static/websites, configured once from the environment.
+    WEBSITE_HOURLY_LIMIT (fallback MAX_REQUESTS_PER_HOUR_WEBSITE, default 1000) requests per
+    WEBSITE_RATE_WINDOW_SEC (3600), using WEBSITE_RATE_ALGORITHM (fixed|sliding|token_bucket).
+    A shared backend (state_backend) makes the limit global across workers.
+    """
+    try:
+        limit = int(os.getenv('WEBSITE_HOURLY_LIMIT', os.getenv('MAX_REQUESTS_PER_HOUR_WEBSITE', '1000')))
+    except Exception:
+        limit = 1000
+    algorithm = os.getenv('WEBSITE_RATE_ALGORITHM', 'fixed').strip().lower()
+    if algorithm not in ALGORITHMS:
+        print(f"[rate_limit] Unknown WEBSITE_RATE_ALGORITHM={algorithm!r}, using 'fixed'")
+        algorithm = 'fixed'
+    window_sec = float(os.getenv('WEBSITE_RATE_WINDOW_SEC', '3600'))
+    if backend is not None and getattr(backend, 'shared', False):
+        return SharedRateLimiter(backend, 'web', limit, window_sec, algorithm)
+    return RateLimiter(
+        limit=limit,
+        window_sec=window_sec,
+        algorithm=algorithm,
+        shards=int(os.getenv('WEBSITE_RATE_SHARDS', '16')),
+        burst=int(os.getenv('WEBSITE_RATE_BURST', '0')) or None,
+    )
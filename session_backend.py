@@ -0,0 +1,183 @@
+"""Selectable Flask session storage.
+
+SESSION_BACKEND picks where sessions live:
+
+- ``cookie``: Flask's signed cookie (default). The session only holds
+  user_id/username/hashchat, so there is no server-side storage at all.
+- ``filesystem``: Flask-Session files (the previous behaviour), with a
+  sweeper that deletes files past PERMANENT_SESSION_LIFETIME.
+- ``redis``: Flask-Session on the shared state backend's Redis client (or
+  REDIS_URL).
+
+Whatever the backend, sessions are opened lazily (storage is only read when a
+handler touches ``session``), saved only when modified, and never opened for
+public website traffic under /static/websites/.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections.abc import MutableMapping
+
+from flask.sessions import SessionInterface
+
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', '').strip().lower()
+SESSION_SWEEP_INTERVAL_SEC = int(os.getenv('SESSION_SWEEP_INTERVAL_SEC', '3600'))
+SKIP_PREFIXES = ('/static/websites/',)
+
+
+class _LazySession(MutableMapping):
+    """Stands in for the real session until a handler first uses it."""
+
+    def __init__(self, loader):
+        object.__setattr__(self, '_loader', loader)
+        object.__setattr__(self, '_real', None)
+
+    def _load(self):
+        real = object.__getattribute__(self, '_real')
+        if real is None:
+            real = object.__getattribute__(self, '_loader')()
+            object.__setattr__(self, '_real', real)
+        return real
+
+    @property
+    def loaded(self) -> bool:
+        return object.__getattribute__(self, '_real') is not None
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+
+    def __delitem__(self, key):
+        del self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def get(self, key, default=None):
+        return self._load().get(key, default)
+
+    def pop(self, key, *default):
+        return self._load().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        return self._load().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._load().update(*args, **kwargs)
+
+    def clear(self):
+        self._load().clear()
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+
+class LazySessionInterface(SessionInterface):
+    """Wraps another session interface: skips public paths and defers the storage read."""
+
+    def __init__(self, inner: SessionInterface, skip_prefixes=SKIP_PREFIXES):
+        self.inner = inner
+        self.skip_prefixes = tuple(skip_prefixes)
+
+    def open_session(self, app, request):
+        if request.path.startswith(self.skip_prefixes):
+            return self.make_null_session(app)
+        return _LazySession(lambda: self._open(app, request))
+
+    def _open(self, app, request):
+        session = self.inner.open_session(app, request)
+        return self.inner.make_null_session(app) if session is None else session
+
+    def save_session(self, app, session, response):
+        if isinstance(session, _LazySession):
+            if not session.loaded:
+                return  # never touched: nothing to read back or write
+            session = session._load()
+        if self.inner.is_null_session(session):
+            return
+        self.inner.save_session(app, session, response)
+
+
+def _sweep_session_files(directory: str, lifetime_sec: float) -> int:
+    """Delete session files whose last write is older than the session lifetime."""
+    removed = 0
+    cutoff = time.time() - lifetime_sec
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            if os.path.isfile(path) and os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        print(f"[sessions] Swept {removed} expired session file(s) from {directory}")
+    return removed
+
+
+def start_session_file_sweeper(directory: str, lifetime_sec: float, interval: int = SESSION_SWEEP_INTERVAL_SEC):
+    def worker():
+        while True:
+            try:
+                _sweep_session_files(directory, lifetime_sec)
+            except Exception as e:
+                print(f"[sessions] Sweep error: {e}")
+            time.sleep(interval)
+
+    t = threading.Thread(target=worker, daemon=True)
+    t.start()
+    return t
+
+
+def configure_sessions(app, state_backend=None) -> str:
+    """Install the session interface selected by SESSION_BACKEND. Returns the backend name.
+    Defaults to redis when the shared state backend is Redis, else to signed cookies."""
+    kind = SESSION_BACKEND or ('redis' if state_backend is not None and state_backend.shared else 'cookie')
+    # Persist only when a handler changed the session, not on every request
+    app.config['SESSION_REFRESH_EACH_REQUEST'] = False
+
+    if kind == 'redis':
+        client = state_backend.client if (state_backend is not None and state_backend.shared) else None
+        try:
+            if client is None:
+                import redis  # optional dependency
+                client = redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+            from flask_session import Session
+            app.config['SESSION_TYPE'] = 'redis'
+            app.config['SESSION_REDIS'] = client
+            Session(app)
+        except Exception as e:
+            print(f"[sessions] Redis sessions unavailable ({e}); using signed cookies")
+            kind = 'cookie'
+    elif kind == 'filesystem':
+        from flask_session import Session
+        app.config['SESSION_TYPE'] = 'filesystem'
+        Session(app)
+        directory = app.config.get('SESSION_FILE_DIR') or os.path.join(os.getcwd(), 'flask_session')
+        start_session_file_sweeper(directory, app.permanent_session_lifetime.total_seconds())
+    elif kind != 'cookie':
+        print(f"[sessions] Unknown SESSION_BACKEND={kind!r}; using signed cookies")
+        kind = 'cookie'
+
+    # 'cookie' keeps Flask's default SecureCookieSessionInterface
+    app.session_interface = LazySessionInterface(app.session_interface)
+    print(f"[sessions] backend={kind}")
+    return kind
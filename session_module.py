@@ -62,7 +62,27 @@ class flow_login_session:
             print(f"Error creating OpenAI session: {e}")
             return None
 
-    def try_login_session(self, initial_msg, user_id):
+    def resume_session(self, thread_id, user_id):
+        """Reattach to an existing thread (e.g. one started by another worker for the same chat)."""
+        try:
+            thread = client.beta.threads.retrieve(thread_id)
+            json_path = os.path.join(route_mount, f'json_files/templates_structures/gpt_configs/{self.chat_select}.json')
+            with open(json_path, 'r') as f:
+                data = json.load(f)
+            return {
+                'session_thread': thread,
+                'configs_gpts': data,
+                'user_id': user_id
+            }
+        except Exception as e:
+            print(f"Error resuming OpenAI thread {thread_id}: {e}")
+            return None
+
+    def try_login_session(self, initial_msg, user_id, thread_id=None):
+        if thread_id:
+            resumed = self.resume_session(thread_id, user_id)
+            if resumed is not None:
+                return resumed
         instance_created = self.instance_session(initial_msg, user_id)
         if instance_created is not None:
             return instance_created
@@ -0,0 +1,233 @@
+"""Cache-friendly serving of published websites (static/websites/<site>/...).
+
+At publish time ``precompress_site`` writes ``.gz`` (and ``.br`` when the
+``brotli`` package is installed) next to index.html and other text assets.
+``SiteFileServer`` negotiates Accept-Encoding against those siblings, sends
+strong ETags (content hash per representation) and answers If-None-Match with
+304. Content-hashed asset names get immutable caching; pages revalidate.
+Small files are served from a bounded in-memory hot set; large ones stream
+through werkzeug's send_file (which also handles Range).
+
+``PublishedSiteMiddleware`` answers /static/websites/ in front of the Flask
+app: rate limit check plus file response, with no session, request hooks,
+template context or DB access on that path.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+from werkzeug.wrappers import Request, Response
+
+from cache_module import LRUTTLStore
+
+try:
+    import brotli as _brotli  # optional
+except ImportError:
+    _brotli = None
+
+HOT_CACHE_MAX_BYTES = int(os.getenv('SITE_HOT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+HOT_FILE_MAX_BYTES = int(os.getenv('SITE_HOT_FILE_MAX_BYTES', str(256 * 1024)))
+IMMUTABLE_MAX_AGE = int(os.getenv('SITE_IMMUTABLE_MAX_AGE', '31536000'))
+ASSET_MAX_AGE = int(os.getenv('SITE_ASSET_MAX_AGE', '3600'))
+
+COMPRESSIBLE_EXTS = {'.html', '.htm', '.css', '.js', '.mjs', '.json', '.svg', '.txt', '.xml', '.map', '.ico'}
+# (Accept-Encoding token, sibling suffix) in preference order
+_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# Names that embed a content hash (e.g. img-<hash16>.png from data URIs) never change
+_HASHED_NAME = re.compile(r'[-_.][0-9a-f]{16,64}\.[A-Za-z0-9]+$')
+_MIN_SAVING = 0.9  # keep a compressed sibling only if it is < 90% of the original
+
+
+def _is_compressible(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTS
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = f"{path}.tmp-{threading.get_ident()}"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def precompress_file(path: str) -> int:
+    """(Re)write path.gz / path.br when missing or older than path. Returns how many were written."""
+    written = 0
+    try:
+        src_mtime = os.stat(path).st_mtime_ns
+        raw = None
+        for enc, suffix in _ENCODINGS:
+            if enc == 'br' and _brotli is None:
+                continue
+            sibling = path + suffix
+            try:
+                if os.stat(sibling).st_mtime_ns >= src_mtime:
+                    continue
+            except FileNotFoundError:
+                pass
+            if raw is None:
+                with open(path, 'rb') as f:
+                    raw = f.read()
+            body = _brotli.compress(raw, quality=11) if enc == 'br' else gzip.compress(raw, compresslevel=9, mtime=0)
+            if len(body) < len(raw) * _MIN_SAVING:
+                _write_atomic(sibling, body)
+                written += 1
+            elif os.path.exists(sibling):
+                os.remove(sibling)
+    except Exception as e:
+        print(f"[site_serving] Failed to precompress {path}: {e}")
+    return written
+
+
+def precompress_site(folder: str) -> int:
+    """Precompress index.html and text assets of a (staged) site folder."""
+    written = 0
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name.startswith('.') or not os.path.isfile(path) or not _is_compressible(name):
+            continue
+        written += precompress_file(path)
+    return written
+
+
+class SiteFileServer:
+    def __init__(self, root: str = os.path.join('static', 'websites'), hot_max_bytes: int = HOT_CACHE_MAX_BYTES,
+                 hot_file_max_bytes: int = HOT_FILE_MAX_BYTES):
+        self.root = root
+        self.hot_file_max_bytes = hot_file_max_bytes
+        # (path, mtime_ns, size) -> file bytes, for small hot files
+        self._hot = LRUTTLStore('site_hot_files', max_bytes=hot_max_bytes)
+        # (path, mtime_ns, size) -> content digest
+        self._digests = LRUTTLStore('site_etags', max_entries=50000)
+
+    def _digest(self, path: str, st) -> str:
+        key = (path, st.st_mtime_ns, st.st_size)
+        digest = self._digests.get(key)
+        if digest is None:
+            if st.st_size <= self.hot_file_max_bytes:
+                digest = hashlib.sha256(self._read(path, st)).hexdigest()[:32]
+            else:
+                # Hashing large media on the request path is not worth it; identity is inode state
+                digest = f"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"
+            self._digests[key] = digest
+        return digest
+
+    def _read(self, path: str, st) -> bytes:
+        key = (path, st.st_mtime_ns, st.st_size)
+        body = self._hot.get(key)
+        if body is None:
+            with open(path, 'rb') as f:
+                body = f.read()
+            self._hot[key] = body
+        return body
+
+    @staticmethod
+    def _cache_control(filename: str) -> str:
+        name = os.path.basename(filename)
+        if name.lower().endswith(('.html', '.htm')):
+            return 'public, max-age=0, must-revalidate'
+        if _HASHED_NAME.search(name):
+            return f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        return f'public, max-age={ASSET_MAX_AGE}'
+
+    def response(self, filename: str, request) -> Response:
+        """Response for static/websites/<filename> given a werkzeug/Flask request."""
+        if any(part.startswith('.') for part in filename.split('/')):
+            return Response('Not Found', status=404)
+        path = safe_join(self.root, filename)
+        if path is None:
+            return Response('Not Found', status=404)
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return Response('Not Found', status=404)
+        if not os.path.isfile(path):
+            return Response('Not Found', status=404)
+
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        serve_path, serve_st, encoding = path, st, None
+        compressible = _is_compressible(path)
+        if compressible:
+            for enc, suffix in _ENCODINGS:
+                if not request.accept_encodings[enc]:
+                    continue
+                try:
+                    sst = os.stat(path + suffix)
+                except FileNotFoundError:
+                    continue
+                if sst.st_mtime_ns >= st.st_mtime_ns:
+                    serve_path, serve_st, encoding = path + suffix, sst, enc
+                    break
+
+        etag = self._digest(path, st) + (f"-{encoding}" if encoding else '')
+        headers = {'Cache-Control': self._cache_control(filename)}
+        if compressible:
+            headers['Vary'] = 'Accept-Encoding'
+        if encoding:
+            headers['Content-Encoding'] = encoding
+
+        if serve_st.st_size > self.hot_file_max_bytes:
+            resp = send_file(serve_path, request.environ, mimetype=mimetype, conditional=True, etag=etag)
+            resp.headers.update(headers)
+            return resp
+
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+        else:
+            resp = Response(self._read(serve_path, serve_st), mimetype=mimetype)
+        resp.set_etag(etag)
+        resp.headers.update(headers)
+        return resp
+
+    def stats(self) -> dict:
+        return {'hot': self._hot.stats(), 'etags': self._digests.stats()}
+
+
+class PublishedSiteMiddleware:
+    """WSGI middleware serving published sites before the wrapped (Flask) app sees the request.
+    Each request is counted once against its site's limiter."""
+
+    def __init__(self, app, server: SiteFileServer, limiter, prefix: str = '/static/websites/'):
+        self.app = app
+        self.server = server
+        self.limiter = limiter
+        self.prefix = prefix
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO') or ''
+        if not path.startswith(self.prefix):
+            return self.app(environ, start_response)
+        resp = self.handle(Request(environ), path[len(self.prefix):])
+        return resp(environ, start_response)
+
+    def handle(self, request, filename: str) -> Response:
+        if request.method not in ('GET', 'HEAD'):
+            return Response('Method Not Allowed', status=405, headers={'Allow': 'GET, HEAD'})
+        site = filename.split('/', 1)[0]
+        if not site:
+            return Response('Not Found', status=404)
+        if not self.limiter.allow(site):
+            return Response('Rate limit exceeded for this website. Try again later.', status=429)
+        return self.server.response(filename, request)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def get_site_server() -> SiteFileServer:
+    """Process-wide server for static/websites."""
+    global _server
+    if _server is not None:
+        return _server
+    with _server_lock:
+        if _server is None:
+            _server = SiteFileServer()
+    return _server
@@ -0,0 +1,174 @@
+"""Content-addressed, compressed storage for generated HTML pages.
+
+Every page produced in a chat (CreateNewDocument, edit_current_document, ...)
+is stored once in ``html_snapshots`` under its SHA-256, compressed with zstd
+when the ``zstandard`` package is installed and gzip otherwise. With
+SNAPSHOT_DIFFS=1 a page may instead be stored as a line diff against the
+previous snapshot of the same chat when that is smaller. Chat history entries
+only keep the hash (``deploy_ref``).
+"""
+
+from __future__ import annotations
+
+import difflib
+import gzip
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+from cache_module import LRUTTLStore
+
+try:
+    import zstandard as _zstd  # optional
+except ImportError:
+    _zstd = None
+
+SNAPSHOT_DIFFS = os.getenv('SNAPSHOT_DIFFS', '0').lower() in ('1', 'true', 'yes')
+SNAPSHOT_MAX_DIFF_DEPTH = int(os.getenv('SNAPSHOT_MAX_DIFF_DEPTH', '8'))
+SNAPSHOT_CACHE_MAX_BYTES = int(os.getenv('SNAPSHOT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+
+def snapshot_hash(html: str) -> str:
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+
+def _compress(data: bytes):
+    if _zstd is not None:
+        return 'zstd', _zstd.ZstdCompressor(level=10).compress(data)
+    return 'gzip', gzip.compress(data, compresslevel=6)
+
+
+def _decompress(codec: str, body: bytes) -> bytes:
+    if codec == 'zstd':
+        if _zstd is None:
+            raise RuntimeError('snapshot stored with zstd but zstandard is not installed')
+        return _zstd.ZstdDecompressor().decompress(body)
+    if codec == 'gzip':
+        return gzip.decompress(body)
+    raise ValueError(f'unknown snapshot codec {codec}')
+
+
+def _make_diff(base: str, new: str) -> str:
+    """Line diff as JSON ops: [i1, i2] copies base lines i1:i2, a string inserts text."""
+    a = base.splitlines(keepends=True)
+    b = new.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(b[j1:j2]))
+    return json.dumps(ops)
+
+
+def _apply_diff(base: str, diff: str) -> str:
+    a = base.splitlines(keepends=True)
+    return ''.join(''.join(a[op[0]:op[1]]) if isinstance(op, list) else op for op in json.loads(diff))
+
+
+class SnapshotStore:
+    def __init__(self, db, diffs: bool = SNAPSHOT_DIFFS, max_diff_depth: int = SNAPSHOT_MAX_DIFF_DEPTH,
+                 cache_max_bytes: int = SNAPSHOT_CACHE_MAX_BYTES):
+        self.db = db
+        self.diffs = diffs
+        self.max_diff_depth = max_diff_depth
+        # hash -> decompressed HTML for recently used pages
+        self._cache = LRUTTLStore('html_snapshots', max_bytes=cache_max_bytes)
+        # hash -> diff depth, for snapshots known to be persisted
+        self._known = LRUTTLStore('html_snapshot_index', max_entries=100000)
+
+    def put(self, html: str, hashchat: Optional[str] = None, base_hash: Optional[str] = None) -> Optional[str]:
+        """Store html (if new) and return its hash. Identical pages are stored once.
+        Returns None when the snapshot could not be persisted; callers then keep the HTML inline."""
+        digest = snapshot_hash(html)
+        if digest in self._known:
+            self._cache[digest] = html
+            return digest
+        raw = html.encode('utf-8')
+        codec, body = _compress(raw)
+        stored_base, depth = None, 0
+        if self.diffs and base_hash and base_hash != digest:
+            base_html = self.get(base_hash)
+            base_depth = self._known.get(base_hash, self.max_diff_depth)
+            if base_html is not None and base_depth < self.max_diff_depth:
+                diff_codec, diff_body = _compress(_make_diff(base_html, html).encode('utf-8'))
+                if len(diff_body) < len(body):
+                    codec, body = f'diff+{diff_codec}', diff_body
+                    stored_base, depth = base_hash, base_depth + 1
+        try:
+            ok = self.db.insert_html_snapshot(digest, hashchat, codec, stored_base, depth, len(raw), body)
+        except Exception as e:
+            print(f"[snapshots] insert error for {digest}: {e}")
+            ok = False
+        if not ok:
+            print(f"[snapshots] Failed to persist snapshot {digest}; keeping the HTML inline")
+            return None
+        self._known[digest] = depth
+        self._cache[digest] = html
+        return digest
+
+    def get(self, digest: str) -> Optional[str]:
+        """Return the HTML for digest, rebuilding diff chains as needed. None if unknown."""
+        if not digest:
+            return None
+        html = self._cache.get(digest)
+        if html is not None:
+            return html
+        row = self.db.fetch_html_snapshot(digest)
+        if not row:
+            return None
+        codec = row['codec']
+        try:
+            if codec.startswith('diff+'):
+                base_html = self.get(row['base_hash'])
+                if base_html is None:
+                    print(f"[snapshots] Missing base {row['base_hash']} for {digest}")
+                    return None
+                html = _apply_diff(base_html, _decompress(codec[5:], row['body']).decode('utf-8'))
+            else:
+                html = _decompress(codec, row['body']).decode('utf-8')
+        except Exception as e:
+            print(f"[snapshots] Failed to decode snapshot {digest}: {e}")
+            return None
+        self._known[digest] = row['depth']
+        self._cache[digest] = html
+        return html
+
+    def intern_history(self, history, hashchat: Optional[str] = None) -> list:
+        """Move inline deploy_item HTML of (legacy) history entries into the store, keeping only refs.
+        Entries whose HTML cannot be persisted keep it inline under its content-hash ref.
+        Returns the entries that now hold only a ref, so the caller can write them back."""
+        last_ref = None
+        interned = []
+        for entry in history:
+            if not entry.get('deploy_item'):
+                continue
+            html = entry.get('message')
+            if html:
+                ref = self.put(html, hashchat, base_hash=last_ref)
+                if ref:
+                    entry.pop('message', None)
+                    entry['deploy_ref'] = ref
+                    interned.append(entry)
+                else:
+                    entry['deploy_ref'] = snapshot_hash(html)
+            last_ref = entry.get('deploy_ref') or last_ref
+        return interned
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_snapshot_store() -> SnapshotStore:
+    """Process-wide snapshot store on the shared DB."""
+    global _store
+    if _store is not None:
+        return _store
+    with _store_lock:
+        if _store is None:
+            from db_module import get_shared_db
+            _store = SnapshotStore(get_shared_db())
+    return _store
@@ -1,6 +1,8 @@
 """Solana utility functions (clean implementation).
 
 Provides defensive helpers for:
+ - A keep-alive JSON-RPC client (SolanaRPC) with batching, 429 backoff and
+   per-method latency histograms
  - Fetching SPL token balance for an owner (aggregates all token accounts)
  - Verifying a transfer delivered tokens to the treasury
 All failures are logged (if SOLANA_DEBUG enabled) and return safe defaults.
@@ -8,28 +10,25 @@ All failures are logged (if SOLANA_DEBUG enabled) and return safe defaults.
 
 from __future__ import annotations
 
-import os, json
+import os, json, random, threading, time
 from decimal import Decimal
 import requests
-from typing import Optional, Any
+from requests.adapters import HTTPAdapter
+from typing import Optional, Any, Dict, List, Tuple
 
-try:  # Prefer solders
-    from solders.pubkey import Pubkey as PublicKey  # type: ignore
-except Exception:
-    try:
-        from solana.publickey import PublicKey  # type: ignore
-    except Exception:
-        PublicKey = None  # type: ignore
-try:
-    from solana.rpc.api import Client  # type: ignore
-except Exception:
-    Client = None  # type: ignore
+from cache_module import LRUTTLStore
 
 RPC_URL = os.getenv('SOLANA_RPC_URL', '')
 SPL_TOKEN_MINT = os.getenv('SPL_TOKEN_MINT', '')
 TREASURY = os.getenv('PLATFORM_TREASURY_WALLET', '')
 LOG_DEBUG = os.getenv('SOLANA_DEBUG', '1') not in ('0', 'false', 'False', '')
-client = Client(RPC_URL) if (RPC_URL and Client) else None
+RPC_TIMEOUT_SEC = float(os.getenv('SOLANA_RPC_TIMEOUT_SEC', '12'))
+RPC_MAX_RETRIES = int(os.getenv('SOLANA_RPC_MAX_RETRIES', '3'))
+RPC_POOL_SIZE = int(os.getenv('SOLANA_RPC_POOL_SIZE', '16'))
+TOKEN_PROGRAM_ID = 'TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA'
+BALANCE_TTL_SEC = float(os.getenv('SOLANA_BALANCE_TTL_SEC', '5'))
+BALANCE_CACHE_MAX = int(os.getenv('SOLANA_BALANCE_CACHE_MAX', '10000'))
+INVALID_OWNER_TTL_SEC = float(os.getenv('SOLANA_INVALID_OWNER_TTL_SEC', '600'))
 
 
 def _d(msg: str, **kv: Any):
@@ -52,65 +51,155 @@ def _is_plausible_base58(s: str) -> bool:
     return ok
 
 
-def _to_pubkey(maybe_key: str) -> Optional[PublicKey]:
-    if not PublicKey:
-        _d('PublicKey class unavailable')
-        return None
-    if not maybe_key or not _is_plausible_base58(maybe_key):
-        return None
-    try:
-        if hasattr(PublicKey, 'from_string'):
-            return PublicKey.from_string(maybe_key)  # type: ignore[attr-defined]
-        if hasattr(PublicKey, 'from_base58'):
-            return PublicKey.from_base58(maybe_key)  # type: ignore[attr-defined]
-        return PublicKey(maybe_key)
-    except Exception as e:
-        _d('Pubkey construct error', err=str(e))
-        return None
+# Latency histogram bucket upper bounds in milliseconds (last bucket is open ended)
+_LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
 
 
-def _rpc_raw(method: str, params_list):
-    """Low level raw RPC using requests (bypass solana-py mismatches)."""
-    if not RPC_URL or 'your-quicknode-endpoint' in RPC_URL:
-        _d('SOLANA_RPC_URL not configured correctamente', value=RPC_URL)
-        return None
-    payload = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params_list}
-    try:
-        r = requests.post(RPC_URL, json=payload, timeout=12)
-        if r.status_code != 200:
-            _d('raw rpc http status', status=r.status_code)
+class SolanaRPC:
+    """JSON-RPC client on one keep-alive requests.Session.
+
+    ``call`` sends a single request and ``batch`` sends several in one POST
+    (a JSON-RPC array). Both return the raw response dicts (or None per call).
+    HTTP 429/503 are retried with exponential backoff and jitter, honouring
+    Retry-After. Latencies are recorded per method in fixed buckets.
+    """
+
+    def __init__(self, url: str = RPC_URL, timeout: float = RPC_TIMEOUT_SEC, max_retries: int = RPC_MAX_RETRIES,
+                 pool_size: int = RPC_POOL_SIZE):
+        self.url = url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        # method -> {'count', 'errors', 'total_ms', 'buckets': [..]}
+        self._latency: Dict[str, Dict[str, Any]] = {}
+        self._retries = 0
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.url) and 'your-quicknode-endpoint' not in self.url
+
+    def _ids(self, n: int) -> List[int]:
+        with self._lock:
+            start = self._next_id
+            self._next_id += n
+        return list(range(start + 1, start + n + 1))
+
+    def _record(self, methods: List[str], elapsed_ms: float, ok: bool):
+        with self._lock:
+            for method in methods:
+                h = self._latency.get(method)
+                if h is None:
+                    h = self._latency[method] = {'count': 0, 'errors': 0, 'total_ms': 0.0,
+                                                 'buckets': [0] * (len(_LATENCY_BUCKETS_MS) + 1)}
+                h['count'] += 1
+                h['total_ms'] += elapsed_ms
+                if not ok:
+                    h['errors'] += 1
+                i = 0
+                while i < len(_LATENCY_BUCKETS_MS) and elapsed_ms > _LATENCY_BUCKETS_MS[i]:
+                    i += 1
+                h['buckets'][i] += 1
+
+    def _post(self, payload, methods: List[str]):
+        """POST payload; returns the decoded JSON body or None."""
+        if not self.configured:
+            _d('SOLANA_RPC_URL not configured correctamente', value=self.url)
             return None
-        return r.json()
-    except Exception as e:
-        _d('raw rpc network error', err=str(e))
+        label = list(dict.fromkeys(methods))  # a batch counts once per distinct method
+        for attempt in range(self.max_retries + 1):
+            t0 = time.perf_counter()
+            try:
+                r = self.session.post(self.url, json=payload, timeout=self.timeout)
+            except Exception as e:
+                self._record(label, (time.perf_counter() - t0) * 1000, False)
+                _d('raw rpc network error', err=str(e))
+                return None
+            elapsed_ms = (time.perf_counter() - t0) * 1000
+            if r.status_code in (429, 503) and attempt < self.max_retries:
+                self._record(label, elapsed_ms, False)
+                with self._lock:
+                    self._retries += 1
+                try:
+                    delay = float(r.headers.get('Retry-After', ''))
+                except ValueError:
+                    delay = 0.25 * (2 ** attempt)
+                time.sleep(min(delay, 10.0) * (1 + random.uniform(0, 0.25)))
+                continue
+            if r.status_code != 200:
+                self._record(label, elapsed_ms, False)
+                _d('raw rpc http status', status=r.status_code)
+                return None
+            self._record(label, elapsed_ms, True)
+            try:
+                return r.json()
+            except Exception as e:
+                _d('raw rpc decode error', err=str(e))
+                return None
         return None
 
+    def call(self, method: str, params_list):
+        payload = {"jsonrpc": "2.0", "id": self._ids(1)[0], "method": method, "params": params_list}
+        return self._post(payload, [method])
 
-def get_token_balance_owner(owner_address: str) -> Decimal:
-    """Fetch SPL token balance via direct JSON-RPC (mint filter first, fallback programId).
+    def batch(self, calls: List[Tuple[str, list]]) -> List[Optional[dict]]:
+        """Send [(method, params), ...] in one POST; responses come back in call order."""
+        if not calls:
+            return []
+        ids = self._ids(len(calls))
+        payload = [{"jsonrpc": "2.0", "id": i, "method": m, "params": p} for i, (m, p) in zip(ids, calls)]
+        body = self._post(payload, [m for m, _ in calls])
+        if not isinstance(body, list):
+            return [None] * len(calls)
+        by_id = {item.get('id'): item for item in body if isinstance(item, dict)}
+        return [by_id.get(i) for i in ids]
 
-    Elimina los errores de versiones mixtas ('Pubkey' no tiene 'encoding')
-    usando strings base58 en el payload.
-    """
-    if not SPL_TOKEN_MINT or not owner_address:
-        return Decimal('0')
-    if not _is_plausible_base58(owner_address) or not _is_plausible_base58(SPL_TOKEN_MINT):
-        return Decimal('0')
-
-    # 1) Mint filter
-    resp = _rpc_raw("getTokenAccountsByOwner", [owner_address, {"mint": SPL_TOKEN_MINT}, {"encoding": "jsonParsed"}])
-    # 2) ProgramId filter fallback
-    if not resp or 'result' not in resp:
-        resp = _rpc_raw("getTokenAccountsByOwner", [owner_address, {"programId": "TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA"}, {"encoding": "jsonParsed"}])
+    def stats(self) -> dict:
+        with self._lock:
+            methods = {
+                m: {'count': h['count'], 'errors': h['errors'],
+                    'avg_ms': round(h['total_ms'] / h['count'], 2) if h['count'] else 0.0,
+                    'buckets_ms': dict(zip([str(b) for b in _LATENCY_BUCKETS_MS] + ['inf'], h['buckets']))}
+                for m, h in self._latency.items()
+            }
+            return {'url_configured': self.configured, 'retries': self._retries, 'methods': methods}
+
+
+_rpc = None
+_rpc_lock = threading.Lock()
+
+
+def get_rpc() -> SolanaRPC:
+    """Process-wide RPC client for SOLANA_RPC_URL."""
+    global _rpc
+    if _rpc is not None:
+        return _rpc
+    with _rpc_lock:
+        if _rpc is None:
+            _rpc = SolanaRPC()
+    return _rpc
+
+
+def _rpc_raw(method: str, params_list):
+    """Low level raw RPC (bypass solana-py mismatches), over the shared keep-alive client."""
+    return get_rpc().call(method, params_list)
+
+
+def _sum_mint_balance(resp, mint: str) -> Optional[Decimal]:
+    """Total ui balance of mint in a getTokenAccountsByOwner response; None if the response is unusable."""
     if not resp or 'result' not in resp:
-        return Decimal('0')
+        return None
     try:
         value = (resp.get('result') or {}).get('value') or []
         total = Decimal('0')
         for acc in value:
             try:
                 info = acc['account']['data']['parsed']['info']
-                if info.get('mint') != SPL_TOKEN_MINT:
+                if info.get('mint') != mint:
                     continue
                 amount_raw = info['tokenAmount']['amount']
                 decimals = info['tokenAmount']['decimals']
@@ -120,54 +209,239 @@ def get_token_balance_owner(owner_address: str) -> Decimal:
         return total
     except Exception as e:
         _d('parse error', err=str(e))
-        return Decimal('0')
+        return None
+
+
+def _fetch_balances(owners: List[str], mint: str) -> Dict[str, Optional[Decimal]]:
+    """Balances of mint for plausible owners in exactly one batch round-trip; None marks an
+    owner the RPC could not answer.
+
+    Each owner's token accounts are listed by programId and summed for mint locally, which
+    also covers the cases the old mint-filter-then-programId sequence needed a second call for.
+    """
+    responses = get_rpc().batch([
+        ("getTokenAccountsByOwner", [owner, {"programId": TOKEN_PROGRAM_ID}, {"encoding": "jsonParsed"}])
+        for owner in owners
+    ])
+    return {owner: _sum_mint_balance(resp, mint) for owner, resp in zip(owners, responses)}
+
+
+def get_token_balances_owners(owner_addresses: List[str], mint: str = SPL_TOKEN_MINT) -> Dict[str, Decimal]:
+    """SPL balances of mint for several owners in one JSON-RPC batch round-trip (uncached).
+    Invalid owners and RPC failures map to 0."""
+    out = {o: Decimal('0') for o in owner_addresses}
+    if not mint or not _is_plausible_base58(mint):
+        return out
+    owners = [o for o in dict.fromkeys(owner_addresses) if o and _is_plausible_base58(o)]
+    if not owners:
+        return out
+    for owner, total in _fetch_balances(owners, mint).items():
+        out[owner] = total if total is not None else Decimal('0')
+    return out
+
+
+class OwnerBalanceCache:
+    """Owner -> balance for SPL_TOKEN_MINT, fresh for BALANCE_TTL_SEC.
+
+    Bounded LRU of recent owners; concurrent lookups of the same owner share one
+    RPC round-trip; addresses that are not plausible base58 are remembered in a
+    negative cache and never reach the RPC. RPC failures are not cached.
+    """
+
+    def __init__(self, mint: str = SPL_TOKEN_MINT, ttl: float = BALANCE_TTL_SEC, max_entries: int = BALANCE_CACHE_MAX,
+                 invalid_ttl: float = INVALID_OWNER_TTL_SEC, fetch=_fetch_balances):
+        self.mint = mint if (mint and _is_plausible_base58(mint)) else ''
+        self.ttl = ttl
+        self.fetch = fetch
+        self._values = LRUTTLStore('solana_balances', max_entries=max_entries)  # owner -> (balance, fetched_at)
+        self._invalid = LRUTTLStore('solana_invalid_owners', max_entries=max_entries, ttl=invalid_ttl)
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, Dict[str, Any]] = {}
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'invalid': 0, 'rpc_calls': 0, 'rpc_errors': 0}
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, owner: str) -> Decimal:
+        if not self.mint or not owner:
+            return Decimal('0')
+        if self._invalid.get(owner) or not _is_plausible_base58(owner):
+            self._invalid[owner] = True
+            self._count('invalid')
+            return Decimal('0')
+        rec = self._values.get(owner)
+        if rec is not None and time.time() - rec[1] < self.ttl:
+            self._count('hits')
+            return rec[0]
+
+        with self._lock:
+            flight = self._inflight.get(owner)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[owner] = {'event': threading.Event(), 'value': None}
+                self._stats['misses'] += 1
+            else:
+                self._stats['coalesced'] += 1
+        if not leader:
+            flight['event'].wait(RPC_TIMEOUT_SEC * (RPC_MAX_RETRIES + 1))
+            return flight['value'] if flight['value'] is not None else Decimal('0')
+
+        value = None
+        try:
+            self._count('rpc_calls')
+            value = self.fetch([owner], self.mint).get(owner)
+            if value is None:
+                self._count('rpc_errors')
+            else:
+                self._values[owner] = (value, time.time())
+        except Exception as e:
+            self._count('rpc_errors')
+            _d('balance lookup error', err=str(e))
+        finally:
+            flight['value'] = value
+            with self._lock:
+                self._inflight.pop(owner, None)
+            flight['event'].set()
+        return value if value is not None else Decimal('0')
+
+    def stats(self) -> dict:
+        with self._lock:
+            st = dict(self._stats)
+        lookups = st['hits'] + st['misses'] + st['coalesced']
+        st['hit_ratio'] = round((st['hits'] + st['coalesced']) / lookups, 4) if lookups else 0.0
+        st['entries'] = len(self._values)
+        st['invalid_entries'] = len(self._invalid)
+        return st
+
+
+_balance_cache = None
+_balance_cache_lock = threading.Lock()
+
+
+def get_balance_cache() -> OwnerBalanceCache:
+    """Process-wide owner balance cache for SPL_TOKEN_MINT."""
+    global _balance_cache
+    if _balance_cache is not None:
+        return _balance_cache
+    with _balance_cache_lock:
+        if _balance_cache is None:
+            _balance_cache = OwnerBalanceCache()
+    return _balance_cache
+
+
+def get_token_balance_owner(owner_address: str) -> Decimal:
+    """Fetch SPL token balance via direct JSON-RPC (one programId query, summed for the mint).
+
+    Elimina los errores de versiones mixtas ('Pubkey' no tiene 'encoding')
+    usando strings base58 en el payload. Answers are shared for a few seconds
+    through the owner balance cache.
+    """
+    return get_balance_cache().get(owner_address)
+
+
+VERIFY_CACHE_MAX = int(os.getenv('SOLANA_VERIFY_CACHE_MAX', '10000'))
+# Definitive outcomes of finalized transactions; anything else (not found yet, RPC errors) is retried
+_FINAL_ERRORS = ('No tokens delivered', 'Transaction failed', 'Missing meta')
+_verified = LRUTTLStore('verified_transactions', max_entries=VERIFY_CACHE_MAX)
+
+
+def _ui_amount(balance) -> Decimal:
+    s = ((balance or {}).get('uiTokenAmount') or {}).get('uiAmountString')
+    return Decimal(s) if s else Decimal('0')
+
+
+def _treasury_delta(meta: dict, mint: str, treasury: str):
+    """(amount delivered to treasury, sender) from pre/postTokenBalances, matched by accountIndex."""
+    pre_by_index = {b.get('accountIndex'): b for b in (meta.get('preTokenBalances') or [])}
+    amount_to_treasury = Decimal('0')
+    sender = None
+    for pb in meta.get('postTokenBalances') or []:
+        try:
+            if pb.get('mint') != mint:
+                continue
+            delta = _ui_amount(pb) - _ui_amount(pre_by_index.get(pb.get('accountIndex')))
+            owner = pb.get('owner')
+            if owner == treasury and delta > 0:
+                amount_to_treasury += delta
+            if delta < 0:
+                sender = owner
+        except Exception:
+            continue
+    return amount_to_treasury, sender
+
+
+def _load_verification(signature: str):
+    """Cached result for signature (memory, then verified_transactions), if it matches the current config."""
+    cached = _verified.get(signature)
+    if cached is not None:
+        return dict(cached)
+    try:
+        from db_module import get_shared_db  # lazy: keeps this module importable without a DB
+        row = get_shared_db().fetch_verified_transaction(signature)
+    except Exception as e:
+        _d('verification cache read error', err=str(e))
+        return None
+    if not row or row['mint_address'] != SPL_TOKEN_MINT or row['treasury'] != TREASURY:
+        return None
+    if row['success']:
+        result = {'success': True, 'amount_tokens': row['amount_tokens'], 'sender': row['sender']}
+    else:
+        result = {'success': False, 'error': row['error']}
+    _verified[signature] = result
+    return dict(result)
+
+
+def _store_verification(signature: str, result: dict):
+    _verified[signature] = dict(result)
+    try:
+        from db_module import get_shared_db
+        get_shared_db().save_verified_transaction(signature, SPL_TOKEN_MINT, TREASURY, result)
+    except Exception as e:
+        _d('verification cache write error', err=str(e))
 
 
 def verify_transfer_signature(signature: str):
+    """Check that a finalized transaction delivered SPL_TOKEN_MINT to the treasury.
+
+    Finalized transactions never change, so definitive results are memoized in
+    memory and in verified_transactions: repeated checks of a signature cost no
+    RPC call. 'Not found' and RPC errors are not cached (the transaction may not
+    be finalized yet).
+    """
     if not signature or len(signature) < 20:
         return {'success': False, 'error': 'Invalid signature'}
-    if not client or not PublicKey:
+    if not get_rpc().configured:
         return {'success': False, 'error': 'RPC not configured'}
     if not TREASURY:
         return {'success': False, 'error': 'Treasury unset'}
-    tr_pk = _to_pubkey(TREASURY)
-    if tr_pk is None:
+    if not _is_plausible_base58(TREASURY):
         return {'success': False, 'error': 'Invalid treasury'}
-    try:
-        tx = client.get_transaction(signature, max_supported_transaction_version=0)
-    except Exception as e:
-        _d('get_transaction error', err=str(e))
+    cached = _load_verification(signature)
+    if cached is not None:
+        return cached
+    tx = _rpc_raw("getTransaction", [signature, {"encoding": "json", "commitment": "finalized",
+                                                 "maxSupportedTransactionVersion": 0}])
+    if tx is None or 'error' in tx:
+        _d('get_transaction error', err=(tx or {}).get('error'))
         return {'success': False, 'error': 'RPC error'}
-    if not tx or not tx.get('result'):
+    if not tx.get('result'):
         return {'success': False, 'error': 'Transaction not found'}
     try:
-        meta = tx['result']['meta']
+        meta = tx['result'].get('meta')
         if not meta:
-            return {'success': False, 'error': 'Missing meta'}
-        post_bal = meta.get('postTokenBalances', [])
-        pre_bal = meta.get('preTokenBalances', [])
-        amount_to_treasury = Decimal('0')
-        sender = None
-        for pb in post_bal:
-            try:
-                if pb.get('mint') != SPL_TOKEN_MINT:
-                    continue
-                ui_post_s = (pb.get('uiTokenAmount') or {}).get('uiAmountString')
-                ui_post = Decimal(ui_post_s) if ui_post_s else Decimal('0')
-                match_pre = next((b for b in pre_bal if b.get('accountIndex') == pb.get('accountIndex')), None)
-                ui_pre_s = (match_pre.get('uiTokenAmount') if match_pre else {}).get('uiAmountString') if match_pre else None
-                ui_pre = Decimal(ui_pre_s) if ui_pre_s else Decimal('0')
-                delta = ui_post - ui_pre
-                owner = pb.get('owner')
-                if owner == TREASURY and delta > 0:
-                    amount_to_treasury += delta
-                if delta < 0:
-                    sender = owner
-            except Exception:
-                continue
-        if amount_to_treasury <= 0:
-            return {'success': False, 'error': 'No tokens delivered'}
-        return {'success': True, 'amount_tokens': float(amount_to_treasury), 'sender': sender}
+            result = {'success': False, 'error': 'Missing meta'}
+        elif meta.get('err'):
+            result = {'success': False, 'error': 'Transaction failed'}
+        else:
+            amount_to_treasury, sender = _treasury_delta(meta, SPL_TOKEN_MINT, TREASURY)
+            if amount_to_treasury <= 0:
+                result = {'success': False, 'error': 'No tokens delivered'}
+            else:
+                result = {'success': True, 'amount_tokens': float(amount_to_treasury), 'sender': sender}
     except Exception as e:
         _d('verify parse error', err=str(e))
         return {'success': False, 'error': 'Verification failed'}
+    if result['success'] or result['error'] in _FINAL_ERRORS:
+        _store_verification(signature, result)
+    return result
@@ -0,0 +1,203 @@
+"""Pluggable key/value state shared by the app's per-request structures.
+
+``LocalStateBackend`` keeps everything in this process (the default, and what
+a single worker needs). ``RedisStateBackend`` shares the same keys across
+gunicorn workers and hosts; its client is injectable, so tests can hand it a
+``fakeredis.FakeRedis()`` instead of a server.
+
+Counters are atomic increments whose TTL is set when the key is created.
+Locks are SET NX with a TTL and are released only by their owner token.
+
+Env: STATE_BACKEND (local|redis, default local), REDIS_URL (redis://localhost:6379/0),
+STATE_KEY_PREFIX (chgp:).
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+import uuid
+
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'local').strip().lower()
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+KEY_PREFIX = os.getenv('STATE_KEY_PREFIX', 'chgp:')
+
+
+class LocalStateBackend:
+    """In-process backend: a dict of (value, expires_at) under one lock."""
+    shared = False
+    name = 'local'
+
+    def __init__(self, sweep_every_sec: float = 60):
+        self._lock = threading.Lock()
+        self._data = {}
+        self._sweep_every = sweep_every_sec
+        self._next_sweep = 0.0
+
+    def _live(self, key, now):
+        rec = self._data.get(key)
+        if rec is None:
+            return None
+        if rec[1] is not None and rec[1] <= now:
+            del self._data[key]
+            return None
+        return rec
+
+    def _maybe_sweep(self, now):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self._sweep_every
+        for k in [k for k, rec in self._data.items() if rec[1] is not None and rec[1] <= now]:
+            del self._data[k]
+
+    def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        now = time.time()
+        with self._lock:
+            self._maybe_sweep(now)
+            rec = self._live(key, now)
+            if rec is None:
+                rec = self._data[key] = [0, (now + ttl) if ttl else None]
+            rec[0] = int(rec[0]) + amount
+            return rec[0]
+
+    def get(self, key: str):
+        with self._lock:
+            rec = self._live(key, time.time())
+            return None if rec is None else str(rec[0])
+
+    def set(self, key: str, value, ttl: float | None = None, nx: bool = False) -> bool:
+        now = time.time()
+        with self._lock:
+            self._maybe_sweep(now)
+            if nx and self._live(key, now) is not None:
+                return False
+            self._data[key] = [value, (now + ttl) if ttl else None]
+            return True
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_if(self, key: str, value) -> bool:
+        with self._lock:
+            rec = self._live(key, time.time())
+            if rec is not None and str(rec[0]) == str(value):
+                del self._data[key]
+                return True
+            return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'backend': self.name, 'keys': len(self._data)}
+
+
+class RedisStateBackend:
+    """Shared backend on Redis (or any client with the redis-py API, e.g. fakeredis)."""
+    shared = True
+    name = 'redis'
+
+    def __init__(self, client, prefix: str = KEY_PREFIX):
+        self.client = client
+        self.prefix = prefix
+
+    def _k(self, key: str) -> str:
+        return self.prefix + key
+
+    def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        k = self._k(key)
+        if not ttl:
+            return int(self.client.incrby(k, amount))
+        # MULTI: create with TTL only if missing, then increment -- both applied atomically
+        pipe = self.client.pipeline(transaction=True)
+        pipe.set(k, 0, ex=max(1, int(ttl)), nx=True)
+        pipe.incrby(k, amount)
+        return int(pipe.execute()[1])
+
+    def get(self, key: str):
+        v = self.client.get(self._k(key))
+        if v is None:
+            return None
+        return v.decode('utf-8') if isinstance(v, bytes) else str(v)
+
+    def set(self, key: str, value, ttl: float | None = None, nx: bool = False) -> bool:
+        ex = max(1, int(ttl)) if ttl else None
+        return bool(self.client.set(self._k(key), value, ex=ex, nx=nx))
+
+    def delete(self, key: str):
+        self.client.delete(self._k(key))
+
+    def delete_if(self, key: str, value) -> bool:
+        """Delete key only while it still holds value (WATCH/MULTI compare-and-delete)."""
+        k = self._k(key)
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(k)
+                current = pipe.get(k)
+                if current is None or (current.decode('utf-8') if isinstance(current, bytes) else str(current)) != str(value):
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.delete(k)
+                pipe.execute()
+                return True
+            except Exception as e:
+                print(f"[state] compare-and-delete of {key} failed: {e}")
+                return False
+
+    def stats(self) -> dict:
+        return {'backend': self.name, 'prefix': self.prefix}
+
+
+class SharedLock:
+    """Best-effort cross-process mutex on a state backend (SET NX + TTL, owner-checked release)."""
+
+    def __init__(self, backend, key: str, ttl: float = 300):
+        self.backend = backend
+        self.key = key
+        self.ttl = ttl
+        self.token = None
+
+    def acquire(self) -> bool:
+        token = uuid.uuid4().hex
+        if self.backend.set(self.key, token, ttl=self.ttl, nx=True):
+            self.token = token
+            return True
+        return False
+
+    def release(self):
+        if self.token is not None:
+            self.backend.delete_if(self.key, self.token)
+            self.token = None
+
+
+def make_state_backend(kind: str = STATE_BACKEND, client=None):
+    """Build a backend. kind='redis' uses client if given, else connects to REDIS_URL.
+    Falls back to the local backend (with a log line) when Redis is unavailable."""
+    if kind == 'redis':
+        try:
+            if client is None:
+                import redis  # optional dependency
+                client = redis.Redis.from_url(REDIS_URL)
+                client.ping()
+            return RedisStateBackend(client)
+        except Exception as e:
+            print(f"[state] Redis backend unavailable ({e}); falling back to in-process state")
+    elif kind != 'local':
+        print(f"[state] Unknown STATE_BACKEND={kind!r}; using in-process state")
+    return LocalStateBackend()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_state_backend():
+    """Process-wide backend selected by STATE_BACKEND."""
+    global _backend
+    if _backend is not None:
+        return _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = make_state_backend()
+    return _backend
@@ -235,6 +235,34 @@ function addDeleteEventListeners() {
 }
 
 
+// Poll a publish job until it finishes; returns the final status payload.
+async function waitForPublishJob(statusUrl) {
+    const publishingText = (window.i18n && i18n.t) ? i18n.t('publishing') : 'Publishing...';
+    Swal.fire({
+        title: publishingText,
+        html: '<span id="publish-progress"></span>',
+        allowOutsideClick: false,
+        didOpen: () => Swal.showLoading()
+    });
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        let status;
+        try {
+            const res = await fetch(statusUrl, { cache: 'no-store' });
+            status = await res.json();
+            if (!res.ok) return status;
+        } catch (e) {
+            console.warn('Publish status poll failed, retrying', e);
+            continue;
+        }
+        if (status.status === 'done' || status.status === 'failed') return status;
+        const progressEl = document.getElementById('publish-progress');
+        if (progressEl && status.assets_total) {
+            progressEl.textContent = `${status.assets_done}/${status.assets_total}`;
+        }
+    }
+}
+
 async function publishWebsite(republish = false, url = null, name = null) {
     let htmlContent;
     let websiteName;
@@ -291,7 +319,10 @@ async function publishWebsite(republish = false, url = null, name = null) {
             body: JSON.stringify({ html_content: htmlContent, website_name: websiteName, republish: !!republish })
         });
 
-        const data = await response.json();
+        let data = await response.json();
+        if (data.success && data.pending && data.status_url) {
+            data = await waitForPublishJob(data.status_url);
+        }
 
         if (data.success) {
             Swal.fire({
@@ -400,16 +431,16 @@ document.addEventListener('DOMContentLoaded', function() {
         if (chatHistory) {
             if (pendingImageUrls.length > 0) {
                 const imgs = pendingImageUrls.map(u => `<img src="${u}" class="inline-block w-16 h-16 object-cover rounded mr-1 mb-1 border border-gray-600" />`).join('');
-                chatHistory.innerHTML += `<div class="text-right my-2"><div class="inline-block bg-blue-600 p-2 rounded-lg">${imgs}${userVisible ? `<div class='mt-1'>${userVisible.replace(/</g,'&lt;')}</div>` : ''}</div></div>`;
+                chatHistory.innerHTML += `<div class="text-right my-2" data-pending="1"><div class="inline-block bg-blue-600 p-2 rounded-lg">${imgs}${userVisible ? `<div class='mt-1'>${userVisible.replace(/</g,'&lt;')}</div>` : ''}</div></div>`;
             } else if (userVisible) {
-                chatHistory.innerHTML += `<div class="text-right my-2"><span class="bg-blue-600 p-2 rounded-lg inline-block">${userVisible.replace(/</g,'&lt;')}</span></div>`;
+                chatHistory.innerHTML += `<div class="text-right my-2" data-pending="1"><span class="bg-blue-600 p-2 rounded-lg inline-block">${userVisible.replace(/</g,'&lt;')}</span></div>`;
             }
         }
         scrollToBottom();
         if (aiLoadingIndicator) aiLoadingIndicator.style.display = 'flex';
 
         try {
-            const response = await fetch('/chat/message', {
+            const response = await fetch('/chat/message/stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
@@ -421,26 +452,19 @@ document.addEventListener('DOMContentLoaded', function() {
                 }),
             });
 
-            const data = await response.json();
-            if (data.success) {
-                pendingImageUrls.length = 0;
-                const cont = document.getElementById('pending-previews');
-                if (cont) cont.remove();
-                updateChatHistory();
-            } else {
-                let errorMsg = `${(window.i18n && i18n.t) ? i18n.t('error_title') : 'Error'}: ${data.error}`;
-                if (chatHistory) {
-                    if (data.recharge_url) {
-                        chatHistory.innerHTML += `<div class="text-left my-2"><span class="bg-red-700 p-2 rounded-lg inline-block">${errorMsg} <a href="${data.recharge_url}" target="_blank" class="text-white underline">${(window.i18n && i18n.t) ? i18n.t('recharge_balance') : 'Recharge Balance'}</a></span></div>`;
-                    } else {
-                        chatHistory.innerHTML += `<div class="text-left my-2"><span class="bg-red-700 p-2 rounded-lg inline-block">${errorMsg}</span></div>`;
-                    }
-                }
-
-                if (data.error === 'Unauthorized') {
-                    window.location.href = '/login';
-                }
+            const contentType = response.headers.get('Content-Type') || '';
+            if (!contentType.startsWith('text/event-stream')) {
+                // Validation errors (401/402/500) still come back as JSON
+                const data = await response.json();
+                showChatError(data);
+                return;
             }
+
+            pendingImageUrls.length = 0;
+            const cont = document.getElementById('pending-previews');
+            if (cont) cont.remove();
+            await consumeChatStream(response);
+            updateChatHistory();
         } catch (error) {
             console.error('Error sending message:', error);
             if (chatHistory) chatHistory.innerHTML += `<div class="text-left my-2"><span class="bg-red-700 p-2 rounded-lg inline-block">${(window.i18n && i18n.t) ? i18n.t('connection_error') : 'Connection error.'}</span></div>`;
@@ -450,39 +474,120 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    function showChatError(data) {
+        let errorMsg = `${(window.i18n && i18n.t) ? i18n.t('error_title') : 'Error'}: ${data.error}`;
+        if (chatHistory) {
+            if (data.recharge_url) {
+                chatHistory.innerHTML += `<div class="text-left my-2"><span class="bg-red-700 p-2 rounded-lg inline-block">${errorMsg} <a href="${data.recharge_url}" target="_blank" class="text-white underline">${(window.i18n && i18n.t) ? i18n.t('recharge_balance') : 'Recharge Balance'}</a></span></div>`;
+            } else {
+                chatHistory.innerHTML += `<div class="text-left my-2"><span class="bg-red-700 p-2 rounded-lg inline-block">${errorMsg}</span></div>`;
+            }
+        }
+
+        if (data.error === 'Unauthorized') {
+            window.location.href = '/login';
+        }
+    }
+
+    function writeToWebFrame(html) {
+        const webFrame = document.getElementById('webFrame');
+        if (!webFrame) return;
+        const doc = webFrame.contentDocument || webFrame.contentWindow.document;
+        doc.open();
+        doc.write(html);
+        doc.close();
+    }
+
+    // Reads the Server-Sent Events body of /chat/message/stream and renders it live.
+    async function consumeChatStream(response) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let liveBubble = null;
+
+        const handle = (name, payload) => {
+            if (name === 'delta') {
+                if (!liveBubble && chatHistory) {
+                    const wrap = document.createElement('div');
+                    wrap.className = 'text-left my-2';
+                    wrap.dataset.pending = '1';
+                    liveBubble = document.createElement('span');
+                    liveBubble.className = 'bg-gray-700 p-2 rounded-lg inline-block';
+                    wrap.appendChild(liveBubble);
+                    chatHistory.appendChild(wrap);
+                }
+                if (liveBubble) liveBubble.textContent += payload.text;
+                if (aiLoadingIndicator) aiLoadingIndicator.style.display = 'none';
+                scrollToBottom();
+            } else if (name === 'tool') {
+                if (aiLoadingIndicator) aiLoadingIndicator.style.display = payload.status === 'started' ? 'flex' : 'none';
+            } else if (name === 'deploy_item') {
+                writeToWebFrame(payload.html);
+            } else if (name === 'error') {
+                showChatError({ error: payload.message });
+            }
+        };
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let sep;
+            while ((sep = buffer.indexOf('\n\n')) !== -1) {
+                const frame = buffer.slice(0, sep);
+                buffer = buffer.slice(sep + 2);
+                let name = 'message';
+                const dataLines = [];
+                frame.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) name = line.slice(6).trim();
+                    else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+                });
+                if (!dataLines.length) continue;
+                try {
+                    handle(name, JSON.parse(dataLines.join('\n')));
+                } catch (e) {
+                    console.error('Bad stream frame:', e);
+                }
+            }
+        }
+    }
+
+    // Highest history seq already rendered; the server only sends entries after it.
+    let historyCursor = 0;
+
     async function updateChatHistory() {
         const chatHistory = document.getElementById('chat-history');
-        if (!chatHistory) return;
+        if (!chatHistory || typeof HASHCHAT === 'undefined' || !HASHCHAT) return;
         try {
-            const response = await fetch('/update_messages_history', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ hashsesion: typeof HASHCHAT !== 'undefined' ? HASHCHAT : '', len_list_history: chatHistory.children.length }),
-            });
-            const messages = await response.json();
-            if (messages.error && messages.error === 'Unauthorized') {
+            const response = await fetch(`/chat/${encodeURIComponent(HASHCHAT)}/messages?after=${historyCursor}`, { cache: 'no-cache' });
+            if (response.status === 401) {
                 window.location.href = '/login';
                 return;
             }
-            if (messages.message !== "not_update_history_chat") {
-                chatHistory.innerHTML = '';
-                messages.forEach(msg => {
-                    if (msg.deploy_item) {
-                        const webFrame = document.getElementById('webFrame');
-                        const doc = webFrame.contentDocument || webFrame.contentWindow.document;
-                        doc.open();
-                        doc.write(msg.message);
-                        doc.close();
-                    } else {
-                        if (msg.role === 'user') {
-                            chatHistory.innerHTML += `<div class="text-right my-2"><span class="bg-blue-600 p-2 rounded-lg inline-block">${msg.message}</span></div>`;
-                        } else {
-                            chatHistory.innerHTML += `<div class="text-left my-2"><span class="bg-gray-700 p-2 rounded-lg inline-block">${msg.message}</span></div>`;
-                        }
-                    }
-                });
-                scrollToBottom();
+            if (!response.ok) return;
+            const data = await response.json();
+            const fresh = (data.messages || []).filter(msg => msg.seq > historyCursor);
+            if (!fresh.length) return;
+
+            // Optimistic bubbles from sendMessage are replaced by the persisted entries
+            chatHistory.querySelectorAll('[data-pending]').forEach(el => el.remove());
+            let latestDeploy = null;
+            fresh.forEach(msg => {
+                if (msg.deploy_item) {
+                    latestDeploy = msg.deploy_ref;
+                } else if (msg.role === 'user') {
+                    chatHistory.innerHTML += `<div class="text-right my-2"><span class="bg-blue-600 p-2 rounded-lg inline-block">${msg.message}</span></div>`;
+                } else {
+                    chatHistory.innerHTML += `<div class="text-left my-2"><span class="bg-gray-700 p-2 rounded-lg inline-block">${msg.message}</span></div>`;
+                }
+            });
+            historyCursor = Math.max(historyCursor, data.cursor || 0);
+            // Only the newest page snapshot is needed for the preview
+            if (latestDeploy) {
+                const html = await fetch(`/chat/${encodeURIComponent(HASHCHAT)}/deploy/${latestDeploy}`).then(r => r.ok ? r.text() : null);
+                if (html !== null) writeToWebFrame(html);
             }
+            scrollToBottom();
         } catch (error) {
             console.error('Error updating chat history:', error);
         }
@@ -550,4 +655,5 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Initial loads
     loadHistory();
+    updateChatHistory();
 });
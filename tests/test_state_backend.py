@@ -0,0 +1,203 @@
+"""Shared state backend, lock and rate limiter against an in-process Redis stand-in.
+
+Run with: python -m pytest -q tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from state_backend import RedisStateBackend, SharedLock  # noqa: E402
+from rate_limit_module import SharedRateLimiter  # noqa: E402
+
+
+class FakeRedisServer:
+    """The keyspace several clients (workers) share, with a clock the tests move."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.data = {}     # key -> (bytes value, expires_at or None)
+        self.versions = {}  # key -> write count, for WATCH
+
+    def live(self, key):
+        rec = self.data.get(key)
+        if rec is not None and rec[1] is not None and rec[1] <= self.now:
+            self.drop(key)
+            return None
+        return rec
+
+    def write(self, key, value, expires_at):
+        self.data[key] = (str(value).encode('utf-8'), expires_at)
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def drop(self, key):
+        if self.data.pop(key, None) is not None:
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+
+class FakeRedis:
+    """The subset of the redis-py client RedisStateBackend uses."""
+
+    def __init__(self, server):
+        self.server = server
+
+    def get(self, key):
+        rec = self.server.live(key)
+        return None if rec is None else rec[0]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and self.server.live(key) is not None:
+            return None
+        self.server.write(key, value, (self.server.now + ex) if ex else None)
+        return True
+
+    def incrby(self, key, amount):
+        rec = self.server.live(key)
+        value = int(rec[0]) + amount if rec else amount
+        self.server.write(key, value, rec[1] if rec else None)
+        return value
+
+    def delete(self, key):
+        self.server.drop(key)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.queued = []
+        self.watched = {}
+        self.buffering = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def watch(self, key):
+        self.watched[key] = self.client.server.versions.get(key, 0)
+
+    def unwatch(self):
+        self.watched = {}
+
+    def multi(self):
+        self.buffering = True
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+
+        def call(*args, **kwargs):
+            if self.watched and not self.buffering:
+                return command(*args, **kwargs)  # immediate mode between WATCH and MULTI
+            self.queued.append((command, args, kwargs))
+            return self
+        return call
+
+    def execute(self):
+        server = self.client.server
+        if any(server.versions.get(k, 0) != v for k, v in self.watched.items()):
+            raise RuntimeError('WatchError')
+        results = [command(*args, **kwargs) for command, args, kwargs in self.queued]
+        self.queued, self.watched, self.buffering = [], {}, False
+        return results
+
+
+class SharedStateTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedisServer()
+        # two gunicorn workers: separate clients and backends, one keyspace
+        self.worker_a = RedisStateBackend(FakeRedis(self.server), prefix='t:')
+        self.worker_b = RedisStateBackend(FakeRedis(self.server), prefix='t:')
+
+    def test_incr_sets_ttl_only_on_create(self):
+        self.assertEqual(self.worker_a.incr('c', ttl=10), 1)
+        self.server.now += 6
+        self.assertEqual(self.worker_b.incr('c', ttl=10), 2)
+        self.server.now += 5  # expires 10s after creation, not after the last increment
+        self.assertIsNone(self.worker_a.get('c'))
+        self.assertEqual(self.worker_a.incr('c', ttl=10), 1)
+
+    def test_lock_is_exclusive_across_workers(self):
+        lock_a = SharedLock(self.worker_a, 'chat:h:turn', ttl=30)
+        lock_b = SharedLock(self.worker_b, 'chat:h:turn', ttl=30)
+        self.assertTrue(lock_a.acquire())
+        self.assertFalse(lock_b.acquire())
+        lock_a.release()
+        self.assertTrue(lock_b.acquire())
+
+    def test_lock_expires_after_ttl(self):
+        lock_a = SharedLock(self.worker_a, 'chat:h:turn', ttl=30)
+        lock_b = SharedLock(self.worker_b, 'chat:h:turn', ttl=30)
+        self.assertTrue(lock_a.acquire())
+        self.server.now += 29
+        self.assertFalse(lock_b.acquire())
+        self.server.now += 2
+        self.assertTrue(lock_b.acquire())
+
+    def test_release_only_deletes_own_lock(self):
+        lock_a = SharedLock(self.worker_a, 'chat:h:turn', ttl=30)
+        lock_b = SharedLock(self.worker_b, 'chat:h:turn', ttl=30)
+        self.assertTrue(lock_a.acquire())
+        self.server.now += 31  # a's lock expired and b took it
+        self.assertTrue(lock_b.acquire())
+        lock_a.release()  # late release from the stale owner
+        self.assertEqual(self.worker_a.get('chat:h:turn'), lock_b.token)
+        self.assertFalse(SharedLock(self.worker_a, 'chat:h:turn', ttl=30).acquire())
+        lock_b.release()
+        self.assertIsNone(self.worker_a.get('chat:h:turn'))
+
+    def test_delete_if_gives_up_when_value_changes_under_watch(self):
+        self.worker_a.set('k', 'one')
+        client = self.worker_a.client
+        real_pipeline = client.pipeline
+
+        def racing_pipeline(transaction=True):
+            pipe = real_pipeline(transaction)
+            real_multi = pipe.multi
+
+            def multi():
+                self.worker_b.set('k', 'two')  # another worker writes between GET and MULTI
+                real_multi()
+            pipe.multi = multi
+            return pipe
+        client.pipeline = racing_pipeline
+        self.assertFalse(self.worker_a.delete_if('k', 'one'))
+        self.assertEqual(self.worker_b.get('k'), 'two')
+
+    def test_rate_limit_is_global_across_workers(self):
+        limiter_a = SharedRateLimiter(self.worker_a, 'web', limit=5, window_sec=60)
+        limiter_b = SharedRateLimiter(self.worker_b, 'web', limit=5, window_sec=60)
+        now = 1020.0
+        results = [(limiter_a if i % 2 else limiter_b).allow('site', now=now) for i in range(8)]
+        self.assertEqual(results, [True] * 5 + [False] * 3)
+        self.assertTrue(limiter_a.allow('other-site', now=now))
+        # next window starts fresh
+        self.assertTrue(limiter_b.allow('site', now=now + 60))
+
+    def test_sliding_window_counts_previous_window(self):
+        limiter_a = SharedRateLimiter(self.worker_a, 'web', limit=4, window_sec=60, algorithm='sliding')
+        limiter_b = SharedRateLimiter(self.worker_b, 'web', limit=4, window_sec=60, algorithm='sliding')
+        for _ in range(4):
+            self.assertTrue(limiter_a.allow('site', now=1020.0))
+        # 15s into the next window: 4 * 0.75 = 3 carried over, one more request fits
+        self.assertTrue(limiter_b.allow('site', now=1095.0))
+        self.assertFalse(limiter_a.allow('site', now=1095.0))
+
+    def test_limiter_fails_open_on_backend_errors(self):
+        class Broken:
+            name = 'broken'
+
+            def incr(self, *a, **kw):
+                raise ConnectionError('down')
+        limiter = SharedRateLimiter(Broken(), 'web', limit=1, window_sec=60)
+        self.assertTrue(limiter.allow('site'))
+        self.assertEqual(limiter.stats()['errors'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
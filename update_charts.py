@@ -9,109 +9,68 @@ messages so the main Flask app can still start.
 from __future__ import annotations
 
 import os
-import requests
-import time
+import random
 import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from db_module import AccountsDBTools
-from pricin_update import get_dexscreener_price  # reuse robust logic
+from pricin_update import (refresh_market_data_many, configured_mints, get_price_service,
+                           PRICE_TTL_SEC, PRICE_REFRESH_AHEAD)
 
-TOKEN_ADDRESS_ENV = 'SPL_TOKEN_MINT'
 UPDATE_INTERVAL = int(os.getenv('TOKEN_PRICE_UPDATE_INTERVAL_SEC', '120'))
+# Each mint's next refresh comes up to this fraction of the interval early (never late,
+# so the poller stays ahead of the price TTL)
+UPDATE_JITTER = float(os.getenv('TOKEN_PRICE_UPDATE_JITTER', '0.2'))
 
 
-def get_dexscreener_data(token_address: str, chain: str = 'solana'):
-    """Fetch summary metrics for a token from Dexscreener.
+def _refresh_interval() -> float:
+    # refresh before the price service would consider a price stale
+    return max(5.0, min(UPDATE_INTERVAL, PRICE_TTL_SEC * PRICE_REFRESH_AHEAD))
 
-    Returns dict or None. Never raises.
-    """
-    if not token_address:
-        return None
-    try:
-        url = f"https://api.dexscreener.com/latest/dex/tokens/{token_address}"
-        r = requests.get(url, timeout=15)
-        if r.status_code != 200:
-            return None
-        data = r.json()
-        pairs = [p for p in data.get('pairs', []) if isinstance(p, dict) and p.get('chainId') == chain]
-        if not pairs:
-            return None
-        # Use robust price function (already filters outliers for stables)
-        robust_price = get_dexscreener_price(token_address, chain)
-        def safe_float(v):
-            try:
-                return float(v) if v is not None else 0.0
-            except Exception:
-                return 0.0
-        # Pick highest liquidity for other metrics
-        def liq_usd(p):
-            try:
-                return float((p.get('liquidity') or {}).get('usd') or 0)
-            except Exception:
-                return 0.0
-        best = max(pairs, key=liq_usd)
-        metrics = {
-            'price_usd': safe_float(robust_price),
-            'market_cap_usd': safe_float(best.get('marketCap')),
-            'fdv_usd': safe_float(best.get('fdv')),
-            'liquidity_usd': safe_float((best.get('liquidity') or {}).get('usd')),
-            'volume24_usd': safe_float((best.get('volume') or {}).get('h24')),
-        }
-        # Debug anomaly for USDC expected ~1
-        if token_address == 'EPjFWdd5AufqSSqeM2qN1xzybapC8G4wEGGkZwyTDt1v' and (metrics['price_usd'] < 0.8 or metrics['price_usd'] > 1.2):
-            print(f"[token_updater][warn] USDC price anomaly stored={metrics['price_usd']} raw_pairs={len(pairs)}")
-        return metrics
-    except Exception as e:
-        print('[token_updater] dexscreener fetch error', e)
-        return None
+
+def _next_due(now: float, interval: float) -> float:
+    return now + interval * (1 - random.uniform(0, UPDATE_JITTER))
 
 
-def _updater_loop(db: AccountsDBTools):
-    token_address = os.getenv(TOKEN_ADDRESS_ENV, '')
-    if not token_address:
-        print('[token_updater] No SPL_TOKEN_MINT set; updater disabled.')
-        return
+def _updater_loop(mints: list):
+    interval = _refresh_interval()
+    due = {m: 0.0 for m in mints}  # everything on the first cycle
     while True:
-        metrics = get_dexscreener_data(token_address)
-        if metrics and metrics.get('price_usd'):
-            p = metrics['price_usd']
-            # Stablecoin guard for USDC
-            if token_address == 'EPjFWdd5AufqSSqeM2qN1xzybapC8G4wEGGkZwyTDt1v' and (p < 0.8 or p > 1.2):
-                print(f"[token_updater][skip] Ignoring anomalous USDC price {p}")
-            else:
-                try:
-                    db.upsert_token_metrics(token_address, metrics)
-                    print(f"[token_updater] Updated metrics price={metrics['price_usd']}")
-                except Exception as e:
-                    print('[token_updater] Failed to upsert metrics', e)
-        else:
-            print('[token_updater] Metrics unavailable this cycle')
-        time.sleep(UPDATE_INTERVAL)
+        now = time.time()
+        # batch every mint due now or within the jitter window
+        horizon = now + interval * UPDATE_JITTER
+        ready = [m for m, t in due.items() if t <= horizon]
+        if ready:
+            try:
+                results = refresh_market_data_many(ready)
+                print(f"[token_updater] Updated {len(results)}/{len(ready)} mint(s)")
+            except Exception as e:
+                print('[token_updater] Batch refresh failed', e)
+            for m in ready:
+                due[m] = _next_due(now, interval)
+        time.sleep(max(1.0, min(due.values()) - time.time()))
 
 
 def start_background_updater():
     """Start background thread that periodically refreshes token metrics.
 
-    Safe to call multiple times (subsequent calls are ignored once started).
+    Tracks every configured mint (SPL_TOKEN_MINTS / SPL_TOKEN_MINT). Each cycle
+    fetches the due mints with batched Dexscreener requests, publishes prices to
+    the in-process price service and writes all metrics with one multi-row
+    configs_system_web3 upsert. Safe to call multiple times.
     """
     # Use attribute sentinel on function to avoid duplicate threads
     if getattr(start_background_updater, '_started', False):  # type: ignore[attr-defined]
         return None
-    try:
-        db = AccountsDBTools(
-            user_db=os.getenv('USERDB'),
-            password_db=os.getenv('PASSWORDDB'),
-            host_db=os.getenv('DBHOST'),
-            port_db=os.getenv('PORTDB'),
-            database='strawberry_platform'
-        )
-    except Exception as e:
-        print('[token_updater] Skipping start (DB init failed):', e)
+    mints = configured_mints()
+    if not mints:
+        print('[token_updater] No SPL_TOKEN_MINT(S) set; updater disabled.')
         return None
-    t = threading.Thread(target=_updater_loop, args=(db,), daemon=True)
+    # request-path refreshes of these mints would bypass the batch
+    get_price_service().mark_polled(mints)
+    t = threading.Thread(target=_updater_loop, args=(mints,), daemon=True)
     t.start()
     start_background_updater._started = True  # type: ignore[attr-defined]
     return t